@@ -68,6 +68,9 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     # サービスの登録
     await async_setup_services(hass, entry)
 
+    # 攻撃・ブロックイベントの購読を開始（非対応のエージェントではポーリングのみ）
+    coordinator.async_start_event_stream()
+
     _LOGGER.info("HA IP Monitor統合のセットアップが完了しました")
     return True
 
@@ -81,7 +84,8 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 
     if unload_ok:
         # データのクリーンアップ
-        hass.data[DOMAIN].pop(entry.entry_id)
+        coordinator = hass.data[DOMAIN].pop(entry.entry_id)
+        await coordinator.async_stop_event_stream()
 
         # 最後のエントリーの場合、サービスを削除
         if not hass.data[DOMAIN]:
@@ -117,7 +121,10 @@ async def async_setup_services(hass: HomeAssistant, entry: ConfigEntry) -> None:
         for entry_id, coordinator in coordinators.items():
             if isinstance(coordinator, HAIPMonitorDataUpdateCoordinator):
                 try:
-                    await coordinator.async_block_ip(ip_address)
+                    # サービスの期間は分、APIは秒で指定する
+                    await coordinator.async_block_ip(
+                        ip_address, duration * 60 if duration else None
+                    )
                     _LOGGER.info(f"成功封禁IP地址: {ip_address}")
 
                     # データを更新して状態を反映
@@ -55,7 +55,19 @@ UPDATE_INTERVAL = 60
 # タイムアウト（秒）
 TIMEOUT = 10
 
+# イベントストリーム接続中のポーリング間隔（秒、取りこぼしの補正用）
+EVENT_STREAM_POLL_INTERVAL = 300
+
+# イベントストリームの再接続間隔（秒）
+EVENT_STREAM_RETRY_INTERVAL = 30
+
+# イベントストリームの無通信タイムアウト（秒、キープアライブが届かなければ切断）
+EVENT_STREAM_READ_TIMEOUT = 60
+
 # API エンドポイント
+API_ENDPOINT_HEALTH = "/health"
+API_ENDPOINT_SNAPSHOT = "/api/snapshot"
+API_ENDPOINT_EVENTS = "/api/events"
 API_ENDPOINT_STATUS = "/api/status"
 API_ENDPOINT_THREATS = "/api/threats"
 API_ENDPOINT_BLOCK_IP = "/api/block"
@@ -63,3 +75,11 @@ API_ENDPOINT_UNBLOCK_IP = "/api/unblock"
 API_ENDPOINT_WHITELIST = "/api/whitelist"
 API_ENDPOINT_IP_INFO = "/api/ip_info"
 API_ENDPOINT_EMERGENCY = "/api/emergency"
+
+# エージェントが /health で通知する対応機能
+CAPABILITY_SNAPSHOT = "snapshot"
+CAPABILITY_THREATS_DELTA = "threats_delta"
+CAPABILITY_EVENTS = "events"
+
+# エージェントとのバイナリ形式
+CONTENT_TYPE_MSGPACK = "application/msgpack"
@@ -5,15 +5,19 @@
 最終更新: 2025-11-13
 """
 import asyncio
+import json
 import logging
+from contextlib import suppress
 from datetime import timedelta
 from typing import Any
+from urllib.parse import urlencode
 
 import aiohttp
 import async_timeout
+import msgpack
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
     UpdateFailed,
@@ -29,8 +33,22 @@ from .const import (
     DEFAULT_API_PORT,
     UPDATE_INTERVAL,
     TIMEOUT,
+    EVENT_STREAM_POLL_INTERVAL,
+    EVENT_STREAM_RETRY_INTERVAL,
+    EVENT_STREAM_READ_TIMEOUT,
+    API_ENDPOINT_HEALTH,
+    API_ENDPOINT_SNAPSHOT,
+    API_ENDPOINT_EVENTS,
     API_ENDPOINT_STATUS,
     API_ENDPOINT_THREATS,
+    CAPABILITY_SNAPSHOT,
+    CAPABILITY_THREATS_DELTA,
+    CAPABILITY_EVENTS,
+    CONTENT_TYPE_MSGPACK,
+    THREAT_LEVEL_LOW,
+    THREAT_LEVEL_MEDIUM,
+    THREAT_LEVEL_HIGH,
+    THREAT_LEVEL_CRITICAL,
 )
 
 _LOGGER = logging.getLogger(__name__)
@@ -57,6 +75,23 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         # APIベースURLの構築
         self.api_base_url = f"http://{self.vps_host}:{self.api_port}"
 
+        # エージェントの対応機能（未検出の場合はNone）
+        self.capabilities: set[str] | None = None
+
+        # 条件付きリクエスト用: URLごとのETagと前回のパース済みレスポンス
+        self._etags: dict[str, str] = {}
+        self._payloads: dict[str, dict[str, Any]] = {}
+        self._modified = False
+
+        # 差分同期用: エージェントから受け取った脅威レコードとカーソル
+        self._threat_table: dict[str, dict[str, Any]] = {}
+        self._threat_cursor: str | None = None
+        self._snapshot_url: str | None = None
+
+        # イベントストリームの購読タスクと最後に受け取ったイベントID
+        self._event_task: asyncio.Task | None = None
+        self._last_event_id: str | None = None
+
         _LOGGER.info(
             f"コーディネーターを初期化しました - VPS: {self.vps_host}:{self.api_port}"
         )
@@ -67,6 +102,8 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
             _LOGGER,
             name=DOMAIN,
             update_interval=timedelta(seconds=UPDATE_INTERVAL),
+            # データが変わらなければエンティティの状態を書き込まない
+            always_update=False,
         )
 
     async def _async_update_data(self) -> dict[str, Any]:
@@ -84,10 +121,24 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         _LOGGER.debug("VPSデータの更新を開始します")
 
         try:
-            # VPSステータスと脅威データを並行取得
+            self._modified = False
+
             async with async_timeout.timeout(TIMEOUT):
-                status_data = await self._fetch_vps_status()
-                threats_data = await self._fetch_threats()
+                if self.capabilities is None:
+                    self.capabilities = await self._fetch_capabilities()
+
+                if CAPABILITY_SNAPSHOT in self.capabilities:
+                    # ステータスと脅威データを1回のリクエストで取得
+                    status_data, threats_data = await self._fetch_snapshot()
+                else:
+                    # 旧バージョンのエージェント: 個別に取得
+                    status_data = await self._fetch_vps_status()
+                    threats_data = await self._fetch_threats()
+
+            if not self._modified and self.data is not None:
+                # すべて 304 Not Modified: 前回のデータをそのまま返す
+                _LOGGER.debug("VPSデータに変更はありません")
+                return self.data
 
             # データを統合して返す
             updated_data = {
@@ -101,14 +152,84 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
 
         except aiohttp.ClientError as err:
             _LOGGER.error(f"VPS API通信エラー: {err}")
+            # エージェントが更新された可能性があるため、次回は対応機能を再検出する
+            self.capabilities = None
             raise UpdateFailed(f"VPS通信に失敗しました: {err}")
         except asyncio.TimeoutError:
             _LOGGER.error(f"VPS API接続タイムアウト ({TIMEOUT}秒)")
+            self.capabilities = None
             raise UpdateFailed("VPS接続がタイムアウトしました")
         except Exception as err:
             _LOGGER.exception(f"予期しないエラーが発生しました: {err}")
+            self.capabilities = None
             raise UpdateFailed(f"データ更新エラー: {err}")
 
+    async def _fetch_capabilities(self) -> set[str]:
+        """エージェントの対応機能を /health から取得
+
+        Returns:
+            set: 対応機能名のセット（旧バージョンのエージェントでは空）
+        """
+        url = f"{self.api_base_url}{API_ENDPOINT_HEALTH}"
+        data = await self._make_api_request(url)
+        capabilities = set(data.get("capabilities", []))
+
+        _LOGGER.info(f"エージェントの対応機能: {sorted(capabilities) or 'なし'}")
+        return capabilities
+
+    async def _fetch_snapshot(self) -> tuple[dict[str, Any], dict[str, Any]]:
+        """ステータスと脅威データを同一スナップショットから取得
+
+        Returns:
+            tuple: (システムステータスデータ, 脅威データ)
+        """
+        url = f"{self.api_base_url}{API_ENDPOINT_SNAPSHOT}"
+        if CAPABILITY_THREATS_DELTA in self.capabilities:
+            # 前回のカーソル以降の差分だけを受け取る（初回は全件）
+            url = f"{url}?{urlencode({'since': self._threat_cursor or ''})}"
+
+        if self._snapshot_url not in (None, url):
+            # カーソルが進んだので古いURLのETagは不要
+            self._etags.pop(self._snapshot_url, None)
+            self._payloads.pop(self._snapshot_url, None)
+        self._snapshot_url = url
+
+        data = await self._make_api_request(url)
+
+        if "threats_delta" in data:
+            threats_data = self._apply_threats_delta(data["threats_delta"])
+        else:
+            threats_data = self._parse_threats(data.get("threats", {}))
+
+        return self._parse_status(data.get("status", {})), threats_data
+
+    def _apply_threats_delta(self, delta: dict[str, Any]) -> dict[str, Any]:
+        """脅威の差分を手元のテーブルに反映
+
+        Args:
+            delta: APIレスポンスの threats_delta 部分
+
+        Returns:
+            dict: 差分反映後の脅威データ
+        """
+        if delta.get("full"):
+            self._threat_table = {}
+
+        for record in delta.get("upserts", []):
+            self._threat_table[record["ip_address"]] = record
+        for ip_address in delta.get("removed", []):
+            self._threat_table.pop(ip_address, None)
+
+        self._threat_cursor = delta.get("cursor")
+
+        threats = dict(delta)
+        threats["threat_list"] = sorted(
+            self._threat_table.values(),
+            key=lambda record: record.get("attack_count", 0),
+            reverse=True,
+        )
+        return self._parse_threats(threats)
+
     async def _fetch_vps_status(self) -> dict[str, Any]:
         """VPSシステムステータスを取得
 
@@ -117,7 +238,18 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         """
         url = f"{self.api_base_url}{API_ENDPOINT_STATUS}"
         data = await self._make_api_request(url)
+        return self._parse_status(data)
+
+    @staticmethod
+    def _parse_status(data: dict[str, Any]) -> dict[str, Any]:
+        """ステータスレスポンスを正規化
+
+        Args:
+            data: APIレスポンスのステータス部分
 
+        Returns:
+            dict: システムステータスデータ
+        """
         # デフォルト値を含むステータスデータを返す
         return {
             "blocked_ips_today": data.get("blocked_ips_today", 0),
@@ -138,7 +270,18 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         """
         url = f"{self.api_base_url}{API_ENDPOINT_THREATS}"
         data = await self._make_api_request(url)
+        return self._parse_threats(data)
+
+    @staticmethod
+    def _parse_threats(data: dict[str, Any]) -> dict[str, Any]:
+        """脅威レスポンスを正規化
+
+        Args:
+            data: APIレスポンスの脅威部分
 
+        Returns:
+            dict: 脅威データ（IPリスト、統計など）
+        """
         # デフォルト値を含む脅威データを返す
         return {
             "threat_level": data.get("threat_level", "low"),
@@ -167,15 +310,23 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json",
+            # 圧縮レスポンスはaiohttpが透過的に展開する
+            "Accept-Encoding": "gzip, deflate",
+            # 対応エージェントにはデコードの軽いmsgpackで返してもらう
+            "Accept": f"{CONTENT_TYPE_MSGPACK}, application/json;q=0.9",
         }
 
+        # 前回のETagがあれば条件付きリクエストにする
+        if method == "GET" and url in self._etags:
+            headers["If-None-Match"] = self._etags[url]
+
         _LOGGER.debug(f"API リクエスト: {method} {url}")
 
         try:
             async with aiohttp.ClientSession() as session:
                 if method == "GET":
                     async with session.get(url, headers=headers) as response:
-                        return await self._handle_response(response)
+                        return await self._handle_response(response, url)
                 elif method == "POST":
                     async with session.post(url, headers=headers, json=json_data) as response:
                         return await self._handle_response(response)
@@ -186,14 +337,17 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
             _LOGGER.error(f"HTTP リクエストエラー: {err}")
             raise UpdateFailed(f"API通信エラー: {err}")
 
-    async def _handle_response(self, response: aiohttp.ClientResponse) -> dict[str, Any]:
+    async def _handle_response(
+        self, response: aiohttp.ClientResponse, url: str | None = None
+    ) -> dict[str, Any]:
         """APIレスポンスを処理
 
         Args:
             response: aiohttpレスポンスオブジェクト
+            url: 条件付きGETのキャッシュキー（オプション）
 
         Returns:
-            dict: パースされたJSONデータ
+            dict: パースされたJSONデータ（304の場合は前回のデータ）
 
         Raises:
             ConfigEntryAuthFailed: 認証エラー
@@ -207,19 +361,206 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
             _LOGGER.error("API認証エラー: アクセスが拒否されました")
             raise ConfigEntryAuthFailed("APIアクセスが拒否されました")
 
+        if response.status == 304 and url in self._payloads:
+            # 変更なし: JSONのデコードを省略して前回のデータを再利用
+            _LOGGER.debug(f"API レスポンス未変更: {url}")
+            return self._payloads[url]
+
         if response.status != 200:
             error_text = await response.text()
             _LOGGER.error(f"APIエラー {response.status}: {error_text}")
             raise UpdateFailed(f"API エラー ({response.status}): {error_text}")
 
         try:
-            data = await response.json()
+            if response.content_type == CONTENT_TYPE_MSGPACK:
+                data = msgpack.unpackb(await response.read(), raw=False)
+            else:
+                # 旧バージョンのエージェントはJSONのみ
+                data = await response.json()
             _LOGGER.debug(f"API レスポンス成功: {response.status}")
-            return data
         except Exception as err:
             _LOGGER.error(f"JSONパースエラー: {err}")
             raise UpdateFailed(f"レスポンスのパースに失敗しました: {err}")
 
+        self._modified = True
+        etag = response.headers.get("ETag") if url else None
+        if etag:
+            self._etags[url] = etag
+            self._payloads[url] = data
+        return data
+
+    @callback
+    def async_start_event_stream(self) -> None:
+        """イベントストリームの購読を開始
+
+        エージェントが対応していない間は何もせず、定期的に再確認する。
+        """
+        if self._event_task is None:
+            self._event_task = self.hass.async_create_background_task(
+                self._async_event_stream(), f"{DOMAIN} event stream"
+            )
+
+    async def async_stop_event_stream(self) -> None:
+        """イベントストリームの購読を停止"""
+        if self._event_task is not None:
+            self._event_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._event_task
+            self._event_task = None
+
+    async def _async_event_stream(self) -> None:
+        """イベントストリームを購読し続ける
+
+        切断された場合は通常のポーリング間隔に戻し、取りこぼした分を
+        再取得してから再接続する。
+        """
+        while True:
+            if self.capabilities and CAPABILITY_EVENTS in self.capabilities:
+                try:
+                    await self._async_consume_events()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    _LOGGER.warning(f"イベントストリームが切断されました: {err}")
+                except Exception as err:
+                    _LOGGER.exception(f"イベントストリームでエラーが発生しました: {err}")
+                finally:
+                    self.update_interval = timedelta(seconds=UPDATE_INTERVAL)
+
+                await self.async_request_refresh()
+
+            await asyncio.sleep(EVENT_STREAM_RETRY_INTERVAL)
+
+    async def _async_consume_events(self) -> None:
+        """イベントストリームに接続し、受信したイベントを反映する"""
+        url = f"{self.api_base_url}{API_ENDPOINT_EVENTS}"
+        headers = {"Authorization": f"Bearer {self.api_token}"}
+        if self._last_event_id:
+            headers["Last-Event-ID"] = self._last_event_id
+
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=TIMEOUT, sock_read=EVENT_STREAM_READ_TIMEOUT
+        )
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(url, headers=headers) as response:
+                if response.status != 200:
+                    _LOGGER.warning(f"イベントストリームに接続できません: {response.status}")
+                    return
+
+                _LOGGER.info("イベントストリームに接続しました")
+                # 接続中はイベントで更新されるため、ポーリングは補正用に間引く
+                self.update_interval = timedelta(seconds=EVENT_STREAM_POLL_INTERVAL)
+
+                event_type, event_id, data_lines = "message", None, []
+                async for raw in response.content:
+                    line = raw.decode("utf-8").rstrip("\r\n")
+
+                    if not line:
+                        # 空行でイベントが確定する
+                        if data_lines:
+                            self._handle_event(event_type, event_id, "\n".join(data_lines))
+                        event_type, event_id, data_lines = "message", None, []
+                    elif line.startswith(":"):
+                        continue  # コメント（キープアライブ）
+                    else:
+                        field, _, value = line.partition(":")
+                        value = value[1:] if value.startswith(" ") else value
+                        if field == "event":
+                            event_type = value
+                        elif field == "id":
+                            event_id = value
+                        elif field == "data":
+                            data_lines.append(value)
+
+    def _handle_event(self, event_type: str, event_id: str | None, payload: str) -> None:
+        """受信したイベントを反映してエンティティに通知
+
+        Args:
+            event_type: イベント種別
+            event_id: イベントID
+            payload: JSON形式のイベントデータ
+        """
+        if event_id:
+            self._last_event_id = event_id
+
+        try:
+            event = json.loads(payload)
+        except ValueError as err:
+            _LOGGER.error(f"イベントのパースエラー: {err}")
+            return
+
+        _LOGGER.debug(f"イベント受信: {event_type} {event.get('ip_address')}")
+        updated_data = self._apply_event(event_type, event)
+        if updated_data is not None:
+            # async_set_updated_data() は次回のポーリングを延期してしまい、
+            # 攻撃が続く間は補正用のポーリングが実行されなくなるため使わない
+            self.data = updated_data
+            self.async_update_listeners()
+
+    @staticmethod
+    def _calculate_threat_level(attack_count: int) -> str:
+        """攻撃回数から全体の脅威レベルを計算（エージェントと同じ基準）
+
+        Args:
+            attack_count: 今日の総攻撃回数
+
+        Returns:
+            str: 脅威レベル
+        """
+        if attack_count < 10:
+            return THREAT_LEVEL_LOW
+        elif attack_count < 50:
+            return THREAT_LEVEL_MEDIUM
+        elif attack_count < 200:
+            return THREAT_LEVEL_HIGH
+        return THREAT_LEVEL_CRITICAL
+
+    def _apply_event(self, event_type: str, event: dict[str, Any]) -> dict[str, Any] | None:
+        """イベントを現在のデータに反映した新しいデータを作成
+
+        差分同期用のテーブルは変更しない（次回のポーリングで正しい内容に揃う）。
+
+        Args:
+            event_type: イベント種別（attack, block, unblock）
+            event: イベントデータ
+
+        Returns:
+            dict: 更新後のデータ（反映できない場合はNone）
+        """
+        if self.data is None:
+            return None
+
+        status = dict(self.data["status"])
+        threats = dict(self.data["threats"])
+        threat_list = threats.get("threat_list", [])
+        ip_address = event.get("ip_address")
+
+        if event_type == "attack":
+            status["ssh_attacks_today"] = event.get("ssh_attacks_today", status["ssh_attacks_today"])
+            status["vpn_attacks_today"] = event.get("vpn_attacks_today", status["vpn_attacks_today"])
+            threat_list = [t for t in threat_list if t.get("ip_address") != ip_address]
+            threat_list.append(event["threat"])
+            threat_list.sort(key=lambda record: record.get("attack_count", 0), reverse=True)
+            threats["total_threats"] = len(threat_list)
+            threats["threat_level"] = self._calculate_threat_level(
+                status["ssh_attacks_today"] + status["vpn_attacks_today"]
+            )
+        elif event_type in ("block", "unblock"):
+            blocked = event_type == "block"
+            threat_list = [
+                {**t, "blocked": blocked} if t.get("ip_address") == ip_address else t
+                for t in threat_list
+            ]
+        else:
+            return None
+
+        threats["threat_list"] = threat_list
+        return {
+            **self.data,
+            "status": status,
+            "threats": threats,
+            "last_update": dt.utcnow().isoformat(),
+        }
+
     async def async_block_ip(self, ip_address: str, duration: int = None) -> bool:
         """IPアドレスをブロック
 
@@ -285,3 +626,34 @@ class HAIPMonitorDataUpdateCoordinator(DataUpdateCoordinator):
         except Exception as err:
             _LOGGER.error(f"IPブロック解除エラー: {err}")
             return False
+
+    async def async_emergency_lockdown(self, reason: str) -> bool:
+        """緊急ロックダウンを開始（ホワイトリスト以外からの新規接続を拒否）
+
+        Args:
+            reason: ロックダウンの理由
+
+        Returns:
+            bool: 成功した場合True
+        """
+        from .const import API_ENDPOINT_EMERGENCY
+
+        url = f"{self.api_base_url}{API_ENDPOINT_EMERGENCY}"
+
+        try:
+            _LOGGER.warning(f"緊急ロックダウン要求: {reason}")
+            result = await self._make_api_request(url, method="POST", json_data={"reason": reason})
+
+            if result.get("success"):
+                _LOGGER.warning(
+                    f"緊急ロックダウンを開始しました（許可: {len(result.get('allowed', []))} 件）"
+                )
+                await self.async_request_refresh()
+                return True
+            else:
+                _LOGGER.error(f"緊急ロックダウン失敗: {result.get('error')}")
+                return False
+
+        except Exception as err:
+            _LOGGER.error(f"緊急ロックダウンエラー: {err}")
+            return False
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ファイル名: benchmark_vps_api.py
+説明: VPS監視APIのベンチマーク
+作成日: 2026-10-18
+最終更新: 2026-10-18
+
+使用方法:
+    python dev_tools/benchmark_vps_api.py system_stats [--iterations N]
+    python dev_tools/benchmark_vps_api.py compression [--records N] [--bandwidth-kbps K] [--rtt-ms R]
+    python dev_tools/benchmark_vps_api.py compression --url http://VPS:5001/api/threats --token TOKEN
+    python dev_tools/benchmark_vps_api.py formats [--sizes 50,1000,10000]
+    python dev_tools/benchmark_vps_api.py log_time [--iterations N]
+    python dev_tools/benchmark_vps_api.py load [--server waitress|flask] [--concurrency N] [--writers W]
+    python dev_tools/benchmark_vps_api.py load --url http://VPS:5001 --token TOKEN
+
+説明:
+    remote_scripts/vps_monitor_api.py の処理性能を計測します。
+    VPS上、またはLinux開発環境で実行してください。
+"""
+import sys
+import io
+
+# Windows環境でUnicode出力を有効化
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+# VPS側スクリプトをインポート（ログはファイルに書かない）
+os.environ.setdefault('LOG_FILE', os.devnull)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'remote_scripts'))
+
+import vps_monitor_api  # noqa: E402
+
+
+def measure(func, iterations):
+    """
+    関数の実行時間を計測
+
+    Args:
+        func: 計測する関数
+        iterations: 実行回数
+
+    Returns:
+        list: 各回の実行時間（ミリ秒）
+    """
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def print_result(name, timings):
+    """計測結果を表示"""
+    if not timings:
+        print(f"  {name:<24} (計測なし)")
+        return
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(
+        f"  {name:<24} mean={statistics.mean(timings):9.3f}ms "
+        f"median={statistics.median(timings):9.3f}ms p99={p99:9.3f}ms"
+    )
+
+
+def make_threats_payload(records):
+    """
+    指定件数の攻撃IPを含む /api/threats 相当のレスポンスを生成
+
+    Args:
+        records: 攻撃IPの件数
+
+    Returns:
+        dict: 脅威リストレスポンス
+    """
+    rng = random.Random(records)
+    attack_ips = []
+    for index in range(records):
+        ssh = rng.randint(1, 500)
+        vpn = rng.randint(0, 20)
+        last_seen = datetime.now().replace(microsecond=0) - timedelta(seconds=rng.randint(0, 86400))
+        attack_ips.append({
+            'ip_address': f"{rng.randint(1, 223)}.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+            'ssh_attempts': ssh,
+            'vpn_attempts': vpn,
+            'total_attempts': ssh + vpn,
+            'first_seen': (last_seen - timedelta(seconds=rng.randint(0, 3600))).isoformat(),
+            'last_seen': last_seen.isoformat(),
+        })
+    attack_ips.sort(key=lambda x: x['total_attempts'], reverse=True)
+
+    auth_stats = {
+        'ssh_attacks_today': sum(a['ssh_attempts'] for a in attack_ips),
+        'vpn_attacks_today': sum(a['vpn_attempts'] for a in attack_ips),
+        'attack_ips': attack_ips,
+        'unique_attackers': len(attack_ips),
+    }
+    ufw_status = {'blocked_ips': [a['ip_address'] for a in attack_ips[::3]]}
+    return vps_monitor_api.build_threats_payload(datetime.now(), ufw_status, auth_stats)
+
+
+def bench_compression(args):
+    """レスポンス圧縮: 方式ごとのサイズとエンドツーエンドの所要時間"""
+    if args.url:
+        bench_compression_url(args)
+        return
+
+    body = json.dumps(make_threats_payload(args.records)).encode()
+    decoders = {
+        'gzip': vps_monitor_api.gzip.decompress,
+        'deflate': vps_monitor_api.zlib.decompress,
+    }
+    if vps_monitor_api.brotli is not None:
+        decoders['br'] = vps_monitor_api.brotli.decompress
+    if vps_monitor_api.zstandard is not None:
+        decoders['zstd'] = vps_monitor_api.zstandard.ZstdDecompressor().decompress
+
+    print(
+        f"compression ({args.records}件, {args.iterations}回, "
+        f"回線 {args.bandwidth_kbps}kbps / RTT {args.rtt_ms}ms を想定)"
+    )
+
+    def transfer_ms(size):
+        return args.rtt_ms + size * 8 / args.bandwidth_kbps
+
+    print(f"  {'identity':<10} size={len(body):9d}B  e2e={transfer_ms(len(body)):9.1f}ms")
+    for name, compress in vps_monitor_api.COMPRESSORS.items():
+        compressed = compress(body)
+        encode = statistics.mean(measure(lambda: compress(body), args.iterations))
+        decode = statistics.mean(measure(lambda: decoders[name](compressed), args.iterations))
+        e2e = encode + transfer_ms(len(compressed)) + decode
+        print(
+            f"  {name:<10} size={len(compressed):9d}B ({len(compressed) / len(body):6.1%}) "
+            f"e2e={e2e:9.1f}ms  (圧縮 {encode:.2f}ms, 展開 {decode:.2f}ms)"
+        )
+
+
+def bench_compression_url(args):
+    """実際のエージェントに対して方式ごとの転送量と応答時間を計測"""
+    print(f"compression {args.url} ({args.iterations}回)")
+
+    for encoding in ['identity'] + list(vps_monitor_api.COMPRESSORS):
+        sizes = []
+
+        def fetch():
+            req = urllib.request.Request(args.url, headers={
+                'Authorization': f"Bearer {args.token}",
+                'Accept-Encoding': encoding,
+            })
+            with urllib.request.urlopen(req) as response:
+                sizes.append(len(response.read()))
+
+        timings = measure(fetch, args.iterations)
+        print_result(f"{encoding} ({sizes[-1]}B)", timings)
+
+
+def bench_formats(args):
+    """レスポンス形式: JSON / msgpack / CBOR のエンコード・デコード時間とサイズ"""
+    codecs = {'json': (lambda p: json.dumps(p).encode(), json.loads)}
+    if vps_monitor_api.msgpack is not None:
+        msgpack = vps_monitor_api.msgpack
+        codecs['msgpack'] = (vps_monitor_api.SERIALIZERS['application/msgpack'],
+                             lambda data: msgpack.unpackb(data, raw=False))
+    if vps_monitor_api.cbor2 is not None:
+        codecs['cbor'] = (vps_monitor_api.cbor2.dumps, vps_monitor_api.cbor2.loads)
+
+    for records in (int(size) for size in args.sizes.split(',')):
+        payload = make_threats_payload(records)
+        print(f"formats ({records}件, {args.iterations}回)")
+
+        for name, (encode, decode) in codecs.items():
+            data = encode(payload)
+            encode_ms = statistics.mean(measure(lambda: encode(payload), args.iterations))
+            decode_ms = statistics.mean(measure(lambda: decode(data), args.iterations))
+            print(
+                f"  {name:<8} size={len(data):9d}B  "
+                f"encode={encode_ms:8.3f}ms  decode={decode_ms:8.3f}ms"
+            )
+
+
+def bench_log_time(args):
+    """ログ時刻の解析: 固定幅の切り出し vs strptime（1万行あたり）"""
+    lines = [
+        "2025-11-13T05:56:27.584544+09:00 vps sshd[1234]: Failed password for root from 1.2.3.4 port 22 ssh2",
+        "Nov 13 05:56:27 vps sshd[1234]: Failed password for root from 1.2.3.4 port 22 ssh2",
+    ]
+    year = datetime.now().year
+
+    def strptime_parse(line):
+        if 'T' in line[:30]:
+            return datetime.strptime(line[:19], "%Y-%m-%dT%H:%M:%S")
+        return datetime.strptime(f"{year} {' '.join(line.split()[:3])}", "%Y %b %d %H:%M:%S")
+
+    print(f"log_time (1万行 x {args.iterations}回)")
+    for line in lines:
+        label = 'ISO 8601' if line[10] == 'T' else 'syslog'
+        sliced = measure(lambda: [vps_monitor_api.parse_log_time(line) for _ in range(10000)], args.iterations)
+        legacy = measure(lambda: [strptime_parse(line) for _ in range(10000)], args.iterations)
+        print_result(f"{label} slicing", sliced)
+        print_result(f"{label} strptime", legacy)
+        print(f"  速度比: {statistics.mean(legacy) / statistics.mean(sliced):.1f}x")
+
+
+class SlowFirewallBackend(vps_monitor_api.FirewallBackend):
+    """ufwの遅さを模したメモリ上のファイアウォール（loadベンチマーク用）"""
+
+    name = 'slow'
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.blocked = set()
+
+    def read_status(self):
+        return {'firewall_active': True, 'blocked_ips': sorted(self.blocked)}
+
+    def block_many(self, ip_addresses):
+        time.sleep(self.delay)
+        self.blocked.update(ip_addresses)
+        return True, ''
+
+    def unblock_many(self, ip_addresses):
+        time.sleep(self.delay)
+        self.blocked.difference_update(ip_addresses)
+        return True, ''
+
+
+def start_local_server(server, threads, block_delay):
+    """
+    遅いファイアウォールを差し込んだエージェントをこのプロセス内で起動
+
+    Args:
+        server: waitress または flask
+        threads: waitressの処理スレッド数
+        block_delay: ブロック操作1回あたりの所要時間（秒）
+
+    Returns:
+        str: サーバーのURL
+    """
+    api = vps_monitor_api
+    # リクエストごとのログ出力は計測を歪めるため抑える
+    for name in ('vps_monitor_api', 'werkzeug', 'waitress'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    api._firewall = SlowFirewallBackend(block_delay)
+    api._firewall_state = api.FirewallStateCache(api._firewall.read_status, reconcile_interval=3600)
+    api._collector.refresh()
+
+    if server == 'waitress':
+        from waitress.server import create_server
+        httpd = create_server(api.app, host='127.0.0.1', port=0, threads=threads)
+        port = httpd.effective_port
+        target = httpd.run
+    else:
+        from werkzeug.serving import make_server
+        httpd = make_server('127.0.0.1', 0, api.app, threaded=True)
+        port = httpd.server_port
+        target = httpd.serve_forever
+
+    threading.Thread(target=target, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def bench_load(args):
+    """同時ポーリング時のスループットとp99遅延（遅いブロック操作と並行）"""
+    if args.url:
+        base_url, token = args.url, args.token
+        label = args.url
+    else:
+        if args.server == 'waitress' and vps_monitor_api.waitress is None:
+            print("waitressがインストールされていないため、このベンチマークはスキップします")
+            return
+        base_url = start_local_server(args.server, args.threads, args.block_delay_ms / 1000)
+        token = vps_monitor_api.API_TOKEN
+        label = f"{args.server}, ブロック操作 {args.block_delay_ms}ms"
+
+    url = urllib.parse.urlsplit(base_url)
+    headers = {'Authorization': f"Bearer {token}", 'Accept-Encoding': 'gzip'}
+    deadline = time.perf_counter() + args.duration
+    reads, writes = [], []
+
+    def worker(results, method, path, body_for):
+        # Home Assistantと同じく接続を使い回す
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        index = 0
+        while time.perf_counter() < deadline:
+            body = body_for(index)
+            request_headers = dict(headers, **({'Content-Type': 'application/json'} if body else {}))
+            start = time.perf_counter()
+            conn.request(method, path, body=body, headers=request_headers)
+            conn.getresponse().read()
+            results.append((time.perf_counter() - start) * 1000)
+            index += 1
+        conn.close()
+
+    threads = [
+        threading.Thread(target=worker, args=(reads, 'GET', '/api/snapshot', lambda i: None))
+        for _ in range(args.concurrency)
+    ]
+    threads += [
+        threading.Thread(target=worker, args=(
+            writes, 'POST', '/api/block',
+            lambda i, w=w: json.dumps({'ip_address': f"198.18.{w}.{i % 256}"}),
+        ))
+        for w in range(args.writers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(
+        f"load ({label}, 参照 {args.concurrency}並列 + ブロック {args.writers}並列, "
+        f"{args.duration}秒)"
+    )
+    print(f"  参照スループット: {len(reads) / args.duration:9.1f} req/s")
+    print_result('GET /api/snapshot', reads)
+    print_result('POST /api/block', writes)
+
+
+def bench_system_stats(args):
+    """get_system_stats: /procサンプラー vs 外部コマンド"""
+    sampler = vps_monitor_api.ProcSampler()
+    if not sampler.available():
+        print("/procが利用できないため、このベンチマークはスキップします")
+        return
+
+    print(f"system_stats ({args.iterations}回)")
+    proc = measure(sampler.sample, args.iterations)
+    subprocess_path = measure(vps_monitor_api.get_system_stats_subprocess, args.iterations)
+
+    print_result("/proc sampler", proc)
+    print_result("subprocess (top/free...)", subprocess_path)
+    print(f"  速度比: {statistics.mean(subprocess_path) / statistics.mean(proc):.0f}x")
+
+
+BENCHMARKS = {
+    'system_stats': bench_system_stats,
+    'compression': bench_compression,
+    'formats': bench_formats,
+    'log_time': bench_log_time,
+    'load': bench_load,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VPS監視APIベンチマーク')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--records', type=int, default=500, help='生成する攻撃IPの件数')
+    parser.add_argument('--bandwidth-kbps', type=float, default=1000, help='想定する回線速度')
+    parser.add_argument('--rtt-ms', type=float, default=100, help='想定する往復遅延')
+    parser.add_argument('--sizes', default='50,1000,10000', help='formatsで比較する件数（カンマ区切り）')
+    parser.add_argument('--url', help='計測対象のエージェントURL（指定時は実測）')
+    parser.add_argument('--server', choices=['waitress', 'flask'], default='waitress',
+                        help='loadでプロセス内に起動するサーバー')
+    parser.add_argument('--threads', type=int, default=vps_monitor_api.SERVER_THREADS,
+                        help='loadで起動するwaitressの処理スレッド数')
+    parser.add_argument('--concurrency', type=int, default=20, help='loadで同時にポーリングする数')
+    parser.add_argument('--writers', type=int, default=2, help='loadで同時にブロック操作を行う数')
+    parser.add_argument('--block-delay-ms', type=float, default=500, help='loadで模すブロック操作の所要時間')
+    parser.add_argument('--duration', type=float, default=5, help='loadの計測時間（秒）')
+    parser.add_argument('--token', default=os.environ.get('API_TOKEN', ''), help='APIトークン')
+    args = parser.parse_args()
+
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    for name in names:
+        BENCHMARKS[name](args)
+        print()
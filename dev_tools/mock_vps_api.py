@@ -90,17 +90,14 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "version": "0.2.0-mock"
+        "version": "0.2.0-mock",
+        "capabilities": ["snapshot"]
     })
 
 
-@app.route('/api/status', methods=['GET'])
-@require_auth
-def get_status():
-    """システムステータスを取得"""
-    logger.info("ステータス要求")
-
-    status_data = {
+def generate_mock_status():
+    """モックステータスデータを生成"""
+    return {
         "blocked_ips_today": random.randint(10, 50),
         "ssh_attacks_today": random.randint(100, 500),
         "vpn_attacks_today": random.randint(20, 100),
@@ -111,15 +108,9 @@ def get_status():
         "uptime": f"{random.randint(1, 30)} days, {random.randint(0, 23)}:{random.randint(0, 59)}:{random.randint(0, 59)}",
     }
 
-    return jsonify(status_data)
-
-
-@app.route('/api/threats', methods=['GET'])
-@require_auth
-def get_threats():
-    """脅威リストを取得"""
-    logger.info("脅威データ要求")
 
+def generate_mock_threats_data():
+    """モック脅威リストデータを生成"""
     threat_list = generate_mock_threats()
     total_threats = len(threat_list)
 
@@ -150,7 +141,36 @@ def get_threats():
         "attack_trend": [random.randint(5, 30) for _ in range(24)],  # 24時間のトレンド
     }
 
-    return jsonify(threats_data)
+    return threats_data
+
+
+@app.route('/api/status', methods=['GET'])
+@require_auth
+def get_status():
+    """システムステータスを取得"""
+    logger.info("ステータス要求")
+    return jsonify(generate_mock_status())
+
+
+@app.route('/api/threats', methods=['GET'])
+@require_auth
+def get_threats():
+    """脅威リストを取得"""
+    logger.info("脅威データ要求")
+    return jsonify(generate_mock_threats_data())
+
+
+@app.route('/api/snapshot', methods=['GET'])
+@require_auth
+def get_snapshot():
+    """ステータスと脅威リストをまとめて取得"""
+    logger.info("スナップショット要求")
+    return jsonify({
+        "generation": 1,
+        "timestamp": datetime.now().isoformat(),
+        "status": generate_mock_status(),
+        "threats": generate_mock_threats_data(),
+    })
 
 
 @app.route('/api/block', methods=['POST'])
@@ -259,13 +279,13 @@ def emergency_lockdown():
 
     return jsonify({
         "success": True,
-        "message": "緊急ロックダウンを実行しました",
-        "locked_at": datetime.now().isoformat(),
-        "actions": [
-            "すべての新規接続をブロック",
-            "既存の接続を監視",
-            "管理者に通知"
-        ]
+        "message": "Emergency lockdown activated",
+        "timestamp": datetime.now().isoformat(),
+        "duration_ms": round(random.uniform(5, 30), 1),
+        "active": True,
+        "activated_at": datetime.now().isoformat(),
+        "reason": (request.get_json(silent=True) or {}).get("reason", "manual"),
+        "allowed": [request.remote_addr],
     })
 
 
@@ -292,6 +312,7 @@ if __name__ == '__main__':
     print("  GET  /health                  - ヘルスチェック（認証不要）")
     print("  GET  /api/status              - システムステータス")
     print("  GET  /api/threats             - 脅威リスト")
+    print("  GET  /api/snapshot            - ステータス+脅威リスト")
     print("  POST /api/block               - IPブロック")
     print("  POST /api/unblock             - IPブロック解除")
     print("  *    /api/whitelist           - ホワイトリスト管理")
@@ -17,13 +17,61 @@
 import os
 import sys
 import re
+import json
+import gzip
+import zlib
+import hashlib
+import heapq
+import math
+import ipaddress
+import uuid
+from array import array
+import sqlite3
 import subprocess
 import logging
+import threading
+import time
+import queue
+from collections import namedtuple, OrderedDict, deque
 from datetime import datetime, timedelta
 from collections import defaultdict, Counter
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from functools import wraps
 
+# 任意の圧縮ライブラリ（インストールされていれば Accept-Encoding で選択可能）
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# GeoIPデータベースの読み込み（国別統計に必要。ない場合は起動時に警告する）
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+# 任意のバイナリ形式（インストールされていれば Accept で選択可能）
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# 本番用WSGIサーバー（インストールされていれば既定で使用）
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
 # Windows環境対応（開発用）
 if sys.platform == 'win32':
     import io
@@ -35,7 +83,7 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
     handlers=[
-        logging.FileHandler('/var/log/ha_monitor_api.log'),
+        logging.FileHandler(os.environ.get('LOG_FILE', '/var/log/ha_monitor_api.log')),
         logging.StreamHandler()
     ]
 )
@@ -47,27 +95,131 @@ app = Flask(__name__)
 # 設定
 API_TOKEN = os.environ.get('API_TOKEN', 'your-secure-token-here')
 API_PORT = int(os.environ.get('API_PORT', 5001))
-AUTH_LOG_PATH = '/var/log/auth.log'
+AUTH_LOG_PATH = os.environ.get('AUTH_LOG_PATH', '/var/log/auth.log')
 WHITELIST_FILE = '/etc/ha_monitor/whitelist.conf'
-EMERGENCY_MODE_FILE = '/tmp/ha_monitor_emergency.lock'
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/ha_monitor')
+AUTH_LOG_STATE_FILE = os.path.join(STATE_DIR, 'auth_log_state.json')
+# 緊急ロックダウンの状態（ロックダウン前のルールセットを含むため所有者のみ読み書き可）
+EMERGENCY_MODE_FILE = os.path.join(STATE_DIR, 'emergency_lockdown.json')
 
-# 統計データのキャッシュ
-_cache = {
-    'last_update': None,
-    'stats': None
-}
-CACHE_DURATION = 30  # 秒
+# IPごとの攻撃履歴（SQLite）と保持日数
+HISTORY_DB = os.environ.get('HISTORY_DB', os.path.join(STATE_DIR, 'attack_history.db'))
+HISTORY_RETENTION_DAYS = int(os.environ.get('HISTORY_RETENTION_DAYS', 90))
+
+# /health で通知するエージェントの対応機能
+API_CAPABILITIES = ['snapshot', 'threats_delta', 'events']
+
+# 起動ごとに変わるID（差分同期のカーソルが再起動をまたいで使われないように）
+BOOT_ID = uuid.uuid4().hex[:8]
+
+# 差分同期のために保持する削除済みIPの最大数
+THREAT_TOMBSTONE_LIMIT = int(os.environ.get('THREAT_TOMBSTONE_LIMIT', 10000))
+
+# スナップショットの更新間隔（秒）
+COLLECT_INTERVAL = int(os.environ.get('COLLECT_INTERVAL', 30))
+
+# CPU・メモリ使用率などの変動する値をETagに反映する間隔（秒）。
+# 収集ごとにETagが変わって304が返せなくなるのを防ぐため、これより短い変動は無視する
+SYSTEM_STATS_ETAG_INTERVAL = int(os.environ.get('SYSTEM_STATS_ETAG_INTERVAL', 300))
+
+# スナップショットを新鮮とみなす時間（秒）。これを過ぎたら再収集する
+SNAPSHOT_TTL = int(os.environ.get('SNAPSHOT_TTL', COLLECT_INTERVAL * 2))
+
+# TTL切れ後も古いスナップショットを返しつつ裏で再収集する猶予（秒）
+# （stale-while-revalidate）。これも過ぎたら呼び出し側で再収集を待つ
+SNAPSHOT_STALE_TTL = int(os.environ.get('SNAPSHOT_STALE_TTL', 300))
+
+# WSGIサーバー: waitress（本番用）または flask（開発用サーバー）
+SERVER = os.environ.get('SERVER', 'waitress')
+
+# リクエスト処理スレッド数（イベントストリームの接続も1本ずつ占有する）
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 16))
+
+# UFWルールセットを実際の状態と再照合する間隔（秒）
+UFW_RECONCILE_INTERVAL = int(os.environ.get('UFW_RECONCILE_INTERVAL', 300))
+
+# ファイアウォールバックエンド: ufw, ipset, nftables
+FIREWALL_BACKEND = os.environ.get('FIREWALL_BACKEND', 'ufw')
+
+# ipset/nftablesバックエンドで使うセット名
+BLOCK_SET_NAME = os.environ.get('BLOCK_SET_NAME', 'ha_monitor_blocked')
+
+# 一括ブロックで直接編集するUFWのユーザールールファイル
+UFW_USER_RULES = os.environ.get('UFW_USER_RULES', '/etc/ufw/user.rules')
+
+# 一括ブロック/解除で一度に受け付けるIPの最大数
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+
+# 自動ブロック: AUTO_BLOCK_WINDOW 秒以内にこの回数の攻撃があったIPをブロック（0で無効）
+AUTO_BLOCK_MAX_RETRY = int(os.environ.get('AUTO_BLOCK_MAX_RETRY', 0))
+
+# 自動ブロックの判定に使う時間窓（秒）
+AUTO_BLOCK_WINDOW = int(os.environ.get('AUTO_BLOCK_WINDOW', 600))
+
+# 自動ブロックの期間（秒、0で無期限）
+AUTO_BLOCK_DURATION = int(os.environ.get('AUTO_BLOCK_DURATION', 0))
+
+# 自動ブロックの理由の保存先
+AUTO_BLOCK_STATE_FILE = os.path.join(STATE_DIR, 'auto_block.json')
+
+# 期限付きブロックの最長期間（秒）
+MAX_BLOCK_DURATION = int(os.environ.get('MAX_BLOCK_DURATION', 30 * 86400))
+
+# 期限がこの秒数以内に重なるブロックは1回のトランザクションでまとめて解除する
+BLOCK_EXPIRY_BATCH_WINDOW = float(os.environ.get('BLOCK_EXPIRY_BATCH_WINDOW', 1))
+
+# 期限付きブロックの解除予定の保存先
+BLOCK_EXPIRY_STATE_FILE = os.path.join(STATE_DIR, 'block_expiry.json')
+
+# ブロック済みIPのサブネット集約: off（無効）, propose（提案のみ）, apply（自動適用）
+AGGREGATE_MODE = os.environ.get('AGGREGATE_MODE', 'propose')
+
+# 集約の単位となるIPv4プレフィックス長
+AGGREGATE_PREFIX = int(os.environ.get('AGGREGATE_PREFIX', 24))
+
+# 集約するのに必要な、サブネット内のブロック済み・攻撃中のアドレス数
+AGGREGATE_MIN_HOSTS = int(os.environ.get('AGGREGATE_MIN_HOSTS', 10))
+
+# そのうち既にブロック済みである必要があるアドレス数
+AGGREGATE_MIN_BLOCKED = int(os.environ.get('AGGREGATE_MIN_BLOCKED', 5))
+
+# MaxMind形式のGeoIPデータベース（国: Country/City、ASN: ASN/ISP）
+GEOIP_DB = os.environ.get('GEOIP_DB', '/usr/share/GeoIP/GeoLite2-Country.mmdb')
+GEOIP_ASN_DB = os.environ.get('GEOIP_ASN_DB', '/usr/share/GeoIP/GeoLite2-ASN.mmdb')
+
+# GeoIP検索結果をキャッシュするIPの最大数
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', 10000))
+
+# top_attack_countries に含める国の数
+TOP_COUNTRIES_LIMIT = int(os.environ.get('TOP_COUNTRIES_LIMIT', 10))
+
+# /api/threats が1ページで返す件数の既定値と上限
+THREATS_DEFAULT_LIMIT = int(os.environ.get('THREATS_DEFAULT_LIMIT', 50))
+THREATS_MAX_LIMIT = int(os.environ.get('THREATS_MAX_LIMIT', 1000))
+
+# このサイズ（バイト）以上のJSONレスポンスを圧縮する
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# イベントストリーム用にauth.logを確認する間隔（秒）
+AUTH_LOG_POLL_INTERVAL = float(os.environ.get('AUTH_LOG_POLL_INTERVAL', 1))
+
+# 再接続時の再送用に保持するイベント数
+EVENT_HISTORY_SIZE = int(os.environ.get('EVENT_HISTORY_SIZE', 1000))
+
+# イベントストリームのキープアライブ間隔（秒）
+EVENT_KEEPALIVE_INTERVAL = int(os.environ.get('EVENT_KEEPALIVE_INTERVAL', 15))
 
 
 # ==================== ユーティリティ関数 ====================
 
-def run_command(command, shell=False):
+def run_command(command, shell=False, input_text=None):
     """
     シェルコマンドを実行して結果を返す
 
     Args:
         command: 実行するコマンド（リストまたは文字列）
         shell: シェル経由で実行するか
+        input_text: 標準入力に渡す文字列（オプション）
 
     Returns:
         tuple: (stdout, stderr, returncode)
@@ -79,6 +231,7 @@ def run_command(command, shell=False):
         result = subprocess.run(
             command,
             shell=shell,
+            input=input_text,
             capture_output=True,
             text=True,
             timeout=30
@@ -92,9 +245,11 @@ def run_command(command, shell=False):
         return "", str(e), -1
 
 
-def get_system_stats():
+def get_system_stats_subprocess():
     """
-    システムステータスを取得
+    外部コマンド（top, free, uptime, df）でシステムステータスを取得
+
+    /procが利用できない環境向けのフォールバック。
 
     Returns:
         dict: CPU、メモリ、運行時間などの情報
@@ -165,93 +320,1100 @@ def get_system_stats():
     return stats
 
 
-def parse_auth_log():
+# ==================== /proc サンプラー ====================
+
+def _format_size(num_bytes):
     """
-    /var/log/auth.log を解析して攻撃情報を抽出
+    バイト数を df -h と同じ形式に変換
+
+    Args:
+        num_bytes: バイト数
 
     Returns:
-        dict: 攻撃統計情報
+        str: 例 '976M', '9.8G', '20G'
+    """
+    value = float(num_bytes)
+    for unit in ('B', 'K', 'M', 'G', 'T', 'P'):
+        if value < 1024 or unit == 'P':
+            break
+        value /= 1024
+
+    if unit == 'B':
+        return f"{int(value)}"
+    if value < 10:
+        # df -h は切り上げで小数1桁
+        return f"{math.ceil(value * 10) / 10:.1f}{unit}"
+    return f"{math.ceil(value)}{unit}"
+
+
+def _format_uptime(seconds):
+    """
+    稼働秒数を uptime -p と同じ形式に変換
+
+    Args:
+        seconds: 稼働秒数
+
+    Returns:
+        str: 例 '2 weeks, 3 days, 4 hours, 5 minutes'
+    """
+    minutes = int(seconds // 60)
+    parts = []
+    for name, size in (('year', 525600), ('week', 10080), ('day', 1440),
+                       ('hour', 60), ('minute', 1)):
+        value, minutes = divmod(minutes, size)
+        if value:
+            parts.append(f"{value} {name}{'s' if value != 1 else ''}")
+
+    return ', '.join(parts) if parts else '0 minutes'
+
+
+class ProcSampler:
     """
-    if not os.path.exists(AUTH_LOG_PATH):
-        logger.warning(f"auth.logが見つかりません: {AUTH_LOG_PATH}")
+    /procとstatvfsから直接システム統計を取得するサンプラー
+
+    外部プロセスを起動しないため、ポーリング自体がCPU負荷を生まない。
+    CPU使用率は前回サンプルとの/proc/statの差分から計算する。
+    """
+
+    def __init__(self, proc_root='/proc', disk_path='/'):
+        """
+        Args:
+            proc_root: procファイルシステムのパス
+            disk_path: ディスク使用率を測定するマウントポイント
+        """
+        self.proc_root = proc_root
+        self.disk_path = disk_path
+        self._lock = threading.Lock()
+        self._prev_cpu = None
+
+    def available(self):
+        """/procが利用可能か判定"""
+        return os.path.exists(os.path.join(self.proc_root, 'stat'))
+
+    def _read_cpu_times(self):
+        """
+        /proc/stat の cpu 行から (busy, total) を取得
+
+        Returns:
+            tuple: (busy, total) のjiffies
+        """
+        with open(os.path.join(self.proc_root, 'stat'), 'r') as f:
+            fields = f.readline().split()
+
+        # cpu user nice system idle iowait irq softirq steal (guestはuserに含まれる)
+        values = [int(v) for v in fields[1:9]]
+        idle = values[3] + values[4]
+        total = sum(values)
+        return total - idle, total
+
+    def cpu_usage(self):
+        """
+        CPU使用率を取得
+
+        初回は起動時からの平均、以降は前回サンプルからの差分で計算する。
+
+        Returns:
+            float: CPU使用率（%）
+        """
+        busy, total = self._read_cpu_times()
+
+        with self._lock:
+            prev = self._prev_cpu
+            self._prev_cpu = (busy, total)
+
+        if prev is not None and total > prev[1]:
+            busy, total = busy - prev[0], total - prev[1]
+
+        if total <= 0:
+            return 0.0
+        return round(busy * 100.0 / total, 1)
+
+    def memory(self):
+        """
+        /proc/meminfo からメモリ使用量を取得
+
+        Returns:
+            dict: memory_usage, memory_total_mb, memory_used_mb
+        """
+        meminfo = {}
+        with open(os.path.join(self.proc_root, 'meminfo'), 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                meminfo[key] = int(rest.split()[0])  # kB
+
+        total = meminfo['MemTotal']
+        available = meminfo.get('MemAvailable')
+        if available is None:
+            available = (meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) +
+                         meminfo.get('Cached', 0))
+        used = total - available
+
         return {
-            'ssh_attacks_today': 0,
-            'vpn_attacks_today': 0,
-            'blocked_ips_today': 0,
-            'attack_ips': []
+            'memory_usage': round((used / total) * 100, 1),
+            'memory_total_mb': total // 1024,
+            'memory_used_mb': used // 1024,
         }
 
-    today = datetime.now().date()
-    ssh_failed_attempts = defaultdict(int)
-    vpn_failed_attempts = defaultdict(int)
-    attack_ips = []
+    def uptime(self):
+        """
+        /proc/uptime から稼働時間を取得
+
+        Returns:
+            str: uptime -p 形式の稼働時間
+        """
+        with open(os.path.join(self.proc_root, 'uptime'), 'r') as f:
+            seconds = float(f.read().split()[0])
+        return _format_uptime(seconds)
+
+    def disk(self):
+        """
+        statvfs からディスク使用率を取得
+
+        Returns:
+            dict: disk_usage, disk_total, disk_used（df -h と同じ表記）
+        """
+        st = os.statvfs(self.disk_path)
+        total = st.f_blocks * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        available = st.f_bavail * st.f_frsize
+
+        # df と同様に一般ユーザーが使える容量を基準に切り上げ
+        usable = used + available
+        usage = math.ceil(used * 100 / usable) if usable else 0
 
-    # 正規表現パターン
-    # SSH失败: Failed password for invalid user admin from 192.168.1.1 port 12345
-    ssh_pattern = re.compile(
-        r'Failed password for (?:invalid user )?(\w+) from ([\d\.]+) port (\d+)'
-    )
+        return {
+            'disk_usage': str(usage),
+            'disk_total': _format_size(total),
+            'disk_used': _format_size(used),
+        }
 
-    # VPN攻撃: 例 - WireGuard handshake failed from 192.168.1.1
-    vpn_pattern = re.compile(
-        r'(wireguard|openvpn).*(failed|invalid|rejected).*([\d\.]+)',
-        re.IGNORECASE
-    )
+    def sample(self):
+        """
+        システムステータスを取得
+
+        Returns:
+            dict: get_system_stats() と同じフィールド
+        """
+        stats = {}
+
+        try:
+            stats['cpu_usage'] = self.cpu_usage()
+        except Exception as e:
+            logger.error(f"CPU使用率取得エラー: {e}")
+            stats['cpu_usage'] = 0.0
+
+        try:
+            stats.update(self.memory())
+        except Exception as e:
+            logger.error(f"メモリ使用率取得エラー: {e}")
+            stats['memory_usage'] = 0.0
+
+        try:
+            stats['uptime'] = self.uptime()
+        except Exception as e:
+            logger.error(f"稼働時間取得エラー: {e}")
+            stats['uptime'] = 'unknown'
+
+        try:
+            stats.update(self.disk())
+        except Exception as e:
+            logger.error(f"ディスク使用率取得エラー: {e}")
+            stats['disk_usage'] = '0'
+
+        return stats
+
+
+_proc_sampler = ProcSampler()
+
+
+def get_system_stats():
+    """
+    システムステータスを取得
+
+    /procが利用できればプロセスを起動せずに取得し、
+    利用できない環境では外部コマンドにフォールバックする。
+
+    Returns:
+        dict: CPU、メモリ、運行時間などの情報
+    """
+    if _proc_sampler.available():
+        return _proc_sampler.sample()
+    return get_system_stats_subprocess()
+
+
+# ==================== 攻撃履歴ストア ====================
+
+class AttackHistoryStore:
+    """
+    IPごと・日ごとの攻撃回数と初回/最終検出時刻を保存するSQLiteストア
+
+    WALモードで開くため、取り込み側の書き込み中でも /api/ip_info の
+    読み込みはブロックされない。行は (IP, 日付, 種別) ごとに1行で、
+    回数はその日の累計を絶対値で書き込む（同じ内容を再度書いても増えない）。
+    データベースは最初に使われた時点で開く。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS attacks (
+            ip TEXT NOT NULL,
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            PRIMARY KEY (ip, day, kind)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS attacks_day ON attacks (day);
+    """
 
+    UPSERT = """
+        INSERT INTO attacks (ip, day, kind, count, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ip, day, kind) DO UPDATE SET
+            count = excluded.count,
+            first_seen = min(first_seen, excluded.first_seen),
+            last_seen = max(last_seen, excluded.last_seen)
+    """
+
+    def __init__(self, path=HISTORY_DB, retention_days=HISTORY_RETENTION_DAYS):
+        """
+        Args:
+            path: データベースファイルのパス
+            retention_days: 履歴を保持する日数
+        """
+        self.path = path
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._write_conn = None
+        self._local = threading.local()
+        self._pruned_day = None
+        self.disabled = False
+
+    def _connect(self):
+        """接続を開く（WALモード）"""
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _writer(self):
+        """書き込み用の接続（初回はスキーマを作成）"""
+        if self._write_conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = self._connect()
+            conn.executescript(self.SCHEMA)
+            self._write_conn = conn
+            logger.info(f"攻撃履歴データベースを開きました: {self.path}")
+        return self._write_conn
+
+    def _reader(self):
+        """読み込み用の接続（スレッドごと）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._lock:
+                self._writer()  # スキーマの作成を保証
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def write(self, rows):
+        """
+        攻撃履歴を1トランザクションでまとめて書き込む
+
+        Args:
+            rows: (ip, 日付, 種別, その日の回数, 初回時刻, 最終時刻) のリスト
+
+        Returns:
+            bool: 書き込めた場合True（無効化されている場合もTrue）
+        """
+        if self.disabled or not rows:
+            return True
+
+        try:
+            with self._lock:
+                conn = self._writer()
+                with conn:
+                    conn.executemany(self.UPSERT, rows)
+                self._prune_if_due(conn)
+            return True
+        except (sqlite3.Error, OSError) as e:
+            if self._write_conn is None:
+                # データベースを開けない環境では履歴なしで動作する
+                logger.error(f"攻撃履歴データベースを開けないため無効化します: {e}")
+                self.disabled = True
+                return True
+            logger.error(f"攻撃履歴の書き込みエラー: {e}")
+            return False
+
+    def _prune_if_due(self, conn):
+        """保持期間を過ぎた履歴を1日1回削除"""
+        today = datetime.now().date()
+        if self._pruned_day == today:
+            return
+
+        cutoff = (today - timedelta(days=self.retention_days)).isoformat()
+        with conn:
+            deleted = conn.execute('DELETE FROM attacks WHERE day < ?', (cutoff,)).rowcount
+        if deleted:
+            logger.info(f"古い攻撃履歴を削除しました: {deleted} 件")
+        self._pruned_day = today
+
+    def ip_history(self, ip):
+        """
+        IPの攻撃履歴を取得（インデックスによる検索）
+
+        Args:
+            ip: IPアドレス
+
+        Returns:
+            dict: first_seen, last_seen, daily（日ごとのssh/vpn回数）。
+                  履歴がない場合はNone
+        """
+        if self.disabled:
+            return None
+
+        rows = self._reader().execute(
+            'SELECT day, kind, count, first_seen, last_seen FROM attacks '
+            'WHERE ip = ? ORDER BY day', (ip,)
+        ).fetchall()
+        if not rows:
+            return None
+
+        daily = OrderedDict()
+        for day, kind, count, _, _ in rows:
+            daily.setdefault(day, {'date': day, 'ssh': 0, 'vpn': 0})[kind] = count
+
+        return {
+            'first_seen': min(row[3] for row in rows),
+            'last_seen': max(row[4] for row in rows),
+            'daily': list(daily.values()),
+        }
+
+
+_history = AttackHistoryStore()
+
+
+# ==================== auth.log 増分解析 ====================
+
+# SSH失败: Failed password for invalid user admin from 192.168.1.1 port 12345
+SSH_FAILED_PATTERN = re.compile(
+    r'Failed password for (?:invalid user )?(\w+) from ([\d\.]+) port (\d+)'
+)
+
+# VPN攻撃: 例 - WireGuard handshake failed from 192.168.1.1
+VPN_FAILED_PATTERN = re.compile(
+    r'(wireguard|openvpn).*(failed|invalid|rejected).*([\d\.]+)',
+    re.IGNORECASE
+)
+
+class AuthEvent(namedtuple('AuthEvent', ['time', 'kind', 'ip'])):
+    """解析済みの攻撃イベント（kind: 'ssh' または 'vpn'）"""
+
+    __slots__ = ()
+
+    @property
+    def date(self):
+        """イベントの日付"""
+        return self.time.date()
+
+
+# 旧syslog形式の月名
+SYSLOG_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+
+def parse_log_time(line, now=None):
+    """
+    ログ行の先頭から時刻を取得
+
+    固定幅の先頭部分を切り出して整数に変換するだけなので、
+    行ごとに strptime を呼ぶより大幅に速い。
+
+    Args:
+        line: auth.logの1行
+        now: 年の補完に使う現在時刻（旧形式のみ、省略時は現在）
+
+    Returns:
+        datetime: ログに記録されたローカル時刻（解析できない場合はNone）
+    """
     try:
-        with open(AUTH_LOG_PATH, 'r', encoding='utf-8', errors='ignore') as f:
-            for line in f:
-                # 今日の日付のログのみ処理
-                try:
-                    # Ubuntu 24.04のauth.logはISO 8601形式: 2025-11-13T05:56:27.584544+00:00
-                    # 旧形式もサポート: Nov 13 10:30:45
-                    if 'T' in line[:30]:  # ISO 8601形式
-                        date_str = line.split('T')[0]
-                        log_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    else:  # 旧形式
-                        date_str = ' '.join(line.split()[:3])
-                        log_date = datetime.strptime(
-                            f"{datetime.now().year} {date_str}",
-                            "%Y %b %d %H:%M:%S"
-                        ).date()
-
-                    if log_date != today:
-                        continue
-                except:
-                    continue
+        if line[10:11] == 'T':
+            # Ubuntu 24.04のISO 8601形式: 2025-11-13T05:56:27.584544+00:00
+            # （秒まで使用、オフセットはローカル時刻のため無視）
+            return datetime(
+                int(line[0:4]), int(line[5:7]), int(line[8:10]),
+                int(line[11:13]), int(line[14:16]), int(line[17:19])
+            )
+
+        # 旧syslog形式: "Nov 13 10:30:45"（日は空白埋め）
+        month = SYSLOG_MONTHS.get(line[0:3])
+        if month is None or line[15:16] != ' ':
+            return None
+
+        now = now or datetime.now()
+        parsed = datetime(
+            now.year, month, int(line[4:6]),
+            int(line[7:9]), int(line[10:12]), int(line[13:15])
+        )
+        # 年が記録されないため、年末のログを年明けに読んだ場合は前年とする
+        if parsed - now > timedelta(days=1):
+            parsed = parsed.replace(year=now.year - 1)
+        return parsed
+    except ValueError:
+        return None
 
-                # SSH攻撃を検出
-                ssh_match = ssh_pattern.search(line)
-                if ssh_match:
-                    ip = ssh_match.group(2)
-                    ssh_failed_attempts[ip] += 1
-
-                # VPN攻撃を検出
-                vpn_match = vpn_pattern.search(line)
-                if vpn_match:
-                    ip = vpn_match.group(3)
-                    vpn_failed_attempts[ip] += 1
-
-        # 攻撃IP情報を整理
-        all_ips = set(list(ssh_failed_attempts.keys()) + list(vpn_failed_attempts.keys()))
-        for ip in all_ips:
-            attack_ips.append({
-                'ip_address': ip,
-                'ssh_attempts': ssh_failed_attempts.get(ip, 0),
-                'vpn_attempts': vpn_failed_attempts.get(ip, 0),
-                'total_attempts': ssh_failed_attempts.get(ip, 0) + vpn_failed_attempts.get(ip, 0)
+
+def extract_auth_events(line):
+    """
+    ログ行から攻撃イベントを抽出
+
+    Args:
+        line: auth.logの1行
+
+    Returns:
+        list: AuthEventのリスト（攻撃行でなければ空）
+    """
+    ssh_match = SSH_FAILED_PATTERN.search(line)
+    vpn_match = VPN_FAILED_PATTERN.search(line)
+    if not ssh_match and not vpn_match:
+        return []
+
+    log_time = parse_log_time(line)
+    if log_time is None:
+        return []
+
+    events = []
+    if ssh_match:
+        events.append(AuthEvent(log_time, 'ssh', ssh_match.group(2)))
+    if vpn_match:
+        events.append(AuthEvent(log_time, 'vpn', vpn_match.group(3)))
+    return events
+
+
+# ログファイルの同一性確認に使う先頭バイト数
+FINGERPRINT_SIZE = 256
+
+
+def rotated_log_paths(log_path):
+    """
+    ローテーション済みログファイルを新しい順に列挙
+
+    auth.log.1, auth.log.2.gz, ... のように番号の小さい順（新しい順）に返す。
+
+    Args:
+        log_path: 現在のログファイルのパス
+
+    Returns:
+        list: ローテーション済みファイルのパス
+    """
+    directory = os.path.dirname(log_path) or '.'
+    base = os.path.basename(log_path)
+    pattern = re.compile(rf'^{re.escape(base)}\.(\d+)(\.gz)?$')
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+
+    rotated = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            rotated.append((int(match.group(1)), os.path.join(directory, name)))
+
+    rotated.sort()
+    return [path for _, path in rotated]
+
+
+def open_log_file(path):
+    """
+    ログファイルをバイナリモードで開く（.gzは逐次展開）
+
+    Args:
+        path: ログファイルのパス
+
+    Returns:
+        file: バイナリファイルオブジェクト
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_fingerprint(path, size=FINGERPRINT_SIZE):
+    """
+    ファイル先頭のバイト列からフィンガープリントを計算
+
+    圧縮済みファイルは展開後の内容で計算するため、
+    gzip化されたローテーションファイルとも照合できる。
+
+    Args:
+        path: ログファイルのパス
+        size: 読み込むバイト数
+
+    Returns:
+        str: 先頭バイト列のSHA-1（読めない場合はNone）
+    """
+    try:
+        with open_log_file(path) as f:
+            return hashlib.sha1(f.read(size)).hexdigest()
+    except (OSError, EOFError):
+        return None
+
+
+def iter_log_lines(paths):
+    """
+    複数のログファイルから行を逐次読み出すジェネレーター
+
+    ファイル全体をメモリに読み込まず、1行ずつ返す。
+
+    Args:
+        paths: 古い順に並べたログファイルのパス
+
+    Yields:
+        bytes: ログ1行
+    """
+    for path in paths:
+        try:
+            with open_log_file(path) as f:
+                yield from f
+        except (OSError, EOFError) as e:
+            logger.error(f"ログ読み込みエラー: {path}: {e}")
+
+
+def iter_auth_events(lines):
+    """
+    ログ行のストリームから攻撃イベントを抽出するジェネレーター
+
+    Args:
+        lines: バイト列のログ行のイテラブル
+
+    Yields:
+        AuthEvent: 攻撃イベント
+    """
+    for raw in lines:
+        yield from extract_auth_events(raw.decode('utf-8', errors='ignore'))
+
+
+# 攻撃トレンドのリングバッファのサイズ（分単位: 直近1時間、時間単位: 直近24時間）
+TREND_MINUTES = 60
+TREND_HOURS = 24
+
+
+class TrendRing:
+    """
+    一定幅の時間バケットごとのSSH/VPN攻撃回数を保持する固定長リングバッファ
+
+    バケット番号（UNIX時刻 // 幅）をスロットごとに記録し、古いバケットの
+    スロットは次に使われたときにリセットする。加算はO(1)、読み出しはO(バケット数)。
+    """
+
+    def __init__(self, width, size):
+        """
+        Args:
+            width: バケットの幅（秒）
+            size: バケット数
+        """
+        self.width = width
+        self.size = size
+        self.buckets = array('q', [-1] * size)
+        self.ssh = array('I', [0] * size)
+        self.vpn = array('I', [0] * size)
+
+    def add(self, timestamp, kind):
+        """
+        攻撃を1回加算
+
+        Args:
+            timestamp: 攻撃時刻（UNIX時刻）
+            kind: 'ssh' または 'vpn'
+        """
+        bucket = int(timestamp // self.width)
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            if self.buckets[slot] > bucket:
+                return  # バッファの範囲より古い
+            self.buckets[slot] = bucket
+            self.ssh[slot] = 0
+            self.vpn[slot] = 0
+
+        if kind == 'ssh':
+            self.ssh[slot] += 1
+        else:
+            self.vpn[slot] += 1
+
+    def series(self, now):
+        """
+        直近のバケットを古い順に返す
+
+        Args:
+            now: 現在時刻（UNIX時刻）
+
+        Returns:
+            list: [{'start', 'ssh', 'vpn'}, ...]（size件）
+        """
+        current = int(now // self.width)
+        series = []
+        for bucket in range(current - self.size + 1, current + 1):
+            slot = bucket % self.size
+            valid = self.buckets[slot] == bucket
+            series.append({
+                'start': datetime.fromtimestamp(bucket * self.width).isoformat(),
+                'ssh': self.ssh[slot] if valid else 0,
+                'vpn': self.vpn[slot] if valid else 0,
             })
+        return series
+
+    def clear(self):
+        """すべてのバケットを空にする"""
+        for slot in range(self.size):
+            self.buckets[slot] = -1
+            self.ssh[slot] = 0
+            self.vpn[slot] = 0
+
+    def to_state(self):
+        """状態ファイルに保存する形式に変換"""
+        return {'buckets': self.buckets.tolist(), 'ssh': self.ssh.tolist(), 'vpn': self.vpn.tolist()}
+
+    def load_state(self, state):
+        """保存済みの状態を復元（サイズが変わっていれば無視）"""
+        if len(state.get('buckets', ())) != self.size:
+            return
+        self.buckets = array('q', state['buckets'])
+        self.ssh = array('I', state['ssh'])
+        self.vpn = array('I', state['vpn'])
+
+
+class AuthLogTailer:
+    """
+    auth.logを増分で読み込むテイラー
+
+    inodeとバイトオフセットを記憶し、前回以降に追記された行だけを解析して
+    IPごとの攻撃カウンターに加算する。オフセットとカウンターは状態ファイルに
+    保存されるため、再起動しても全体の再スキャンは発生しない。
+    ローテーション済みファイル（auth.log.1, auth.log.N.gz）も追跡するため、
+    logrotate実行後も今日の集計が欠けることはない。
+    """
+
+    def __init__(self, log_path=AUTH_LOG_PATH, state_path=AUTH_LOG_STATE_FILE, history=None):
+        """
+        Args:
+            log_path: 監視するauth.logのパス
+            state_path: オフセットとカウンターの保存先
+            history: 攻撃履歴の書き込み先（AttackHistoryStore、オプション）
+        """
+        self.log_path = log_path
+        self.state_path = state_path
+        self.history = history
+        self._lock = threading.Lock()
+
+        self.inode = None
+        self.offset = 0
+        self.fingerprint = None
+        self.day = datetime.now().date()
+        self.ssh_counts = defaultdict(int)
+        self.vpn_counts = defaultdict(int)
+        self.first_seen = {}   # IP -> 今日の最初の攻撃時刻
+        self.last_seen = {}    # IP -> 今日の最後の攻撃時刻
+        self._changed = set()  # 前回 take_changes() 以降に攻撃回数が増えたIP
+        self._pending = {}     # 履歴に未書き込みの (IP, 種別) -> [初回時刻, 最終時刻]
+        self.trend = {
+            'minute': TrendRing(60, TREND_MINUTES),
+            'hour': TrendRing(3600, TREND_HOURS),
+        }
+        # 攻撃イベントを1件ずつ受け取る関数（自動ブロックなど、ロック保持中に呼ばれる）
+        self.listeners = []
+
+        self._load_state()
+
+    # ---------- 状態の永続化 ----------
+
+    def _load_state(self):
+        """保存済みの状態を読み込む"""
+        if not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+
+            self.inode = state.get('inode')
+            self.offset = int(state.get('offset', 0))
+            self.fingerprint = state.get('fingerprint')
+            day = datetime.strptime(state['day'], "%Y-%m-%d").date()
+            if day == self.day:
+                self.ssh_counts.update(state.get('ssh_counts', {}))
+                self.vpn_counts.update(state.get('vpn_counts', {}))
+                for target, key in ((self.first_seen, 'first_seen'), (self.last_seen, 'last_seen')):
+                    target.update(
+                        (ip, datetime.fromisoformat(seen))
+                        for ip, seen in state.get(key, {}).items()
+                    )
+            for name, ring in self.trend.items():
+                ring.load_state(state.get('trend', {}).get(name, {}))
+
+            logger.info(
+                f"auth.log状態を復元しました: inode={self.inode}, offset={self.offset}"
+            )
+        except Exception as e:
+            logger.error(f"auth.log状態の読み込みエラー: {e}")
+            self.inode = None
+            self.offset = 0
+            self.fingerprint = None
+
+    def _save_state(self):
+        """状態をアトミックに保存する"""
+        state = {
+            'inode': self.inode,
+            'offset': self.offset,
+            'fingerprint': self.fingerprint,
+            'day': self.day.isoformat(),
+            'ssh_counts': self.ssh_counts,
+            'vpn_counts': self.vpn_counts,
+            'first_seen': {ip: seen.isoformat() for ip, seen in self.first_seen.items()},
+            'last_seen': {ip: seen.isoformat() for ip, seen in self.last_seen.items()},
+            'trend': {name: ring.to_state() for name, ring in self.trend.items()},
+        }
+
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.error(f"auth.log状態の保存エラー: {e}")
+
+    # ---------- 集計 ----------
+
+    def _roll_day(self, day):
+        """日付が変わったらカウンターをリセット"""
+        if day > self.day:
+            # 前日分の履歴を書き切ってからリセットする
+            self._flush_history()
+            self._pending.clear()
+            self.day = day
+            self.ssh_counts.clear()
+            self.vpn_counts.clear()
+            self.first_seen.clear()
+            self.last_seen.clear()
+            self._changed.clear()
+
+    def _count(self, events, trend=True):
+        """
+        攻撃イベントをカウンターに加算（トレンドは範囲内すべて、IP別は今日の分のみ）
+
+        Args:
+            events: 攻撃イベント
+            trend: トレンドにも加算するか（状態から復元したトレンドを二重に数えない場合はFalse）
+        """
+        for event in events:
+            if trend:
+                timestamp = event.time.timestamp()
+                for ring in self.trend.values():
+                    ring.add(timestamp, event.kind)
+            for listener in self.listeners:
+                listener(event)
+
+            if event.date != self.day:
+                continue
+            self._changed.add(event.ip)
+
+            # ログは概ね時刻順だが、ローテーション済みファイルの読み込み順に依存しないよう比較する
+            first = self.first_seen.get(event.ip)
+            if first is None or event.time < first:
+                self.first_seen[event.ip] = event.time
+            last = self.last_seen.get(event.ip)
+            if last is None or event.time > last:
+                self.last_seen[event.ip] = event.time
+
+            seen = self._pending.get((event.ip, event.kind))
+            if seen is None:
+                self._pending[(event.ip, event.kind)] = [event.time, event.time]
+            else:
+                seen[0] = min(seen[0], event.time)
+                seen[1] = max(seen[1], event.time)
+
+            if event.kind == 'ssh':
+                self.ssh_counts[event.ip] += 1
+            else:
+                self.vpn_counts[event.ip] += 1
+
+    def _flush_history(self):
+        """
+        未書き込みの攻撃を履歴ストアへ1トランザクションで書き込む
+
+        回数はその日の累計（絶対値）なので、再起動後に同じ行を
+        読み直しても履歴の回数は重複しない。
+        """
+        if self.history is None or not self._pending:
+            return
+
+        day = self.day.isoformat()
+        rows = []
+        for (ip, kind), (first, last) in self._pending.items():
+            counts = self.ssh_counts if kind == 'ssh' else self.vpn_counts
+            rows.append((ip, day, kind, counts[ip], first.isoformat(), last.isoformat()))
+
+        if self.history.write(rows):
+            self._pending.clear()
+
+    def _complete_lines(self, f):
+        """
+        ファイルの現在位置から完全な行だけを返すジェネレーター
+
+        書き込み途中の行（改行なし）に達したら停止し、次回に読み直す。
+        読み込んだバイト数はself.offsetに加算される。
+        """
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break
+            self.offset += len(raw)
+            yield raw
+
+    # ---------- ローテーション処理 ----------
+
+    def _is_previous_file(self, path):
+        """ローテーション済みファイルが前回読んでいたファイルか判定"""
+        if not path.endswith('.gz'):
+            try:
+                if os.stat(path).st_ino == self.inode:
+                    return True
+            except OSError:
+                return False
+
+        # gzip化されるとinodeが変わるため先頭バイトで照合
+        return (self.fingerprint is not None and
+                read_fingerprint(path) == self.fingerprint)
+
+    def _rotated_today(self):
+        """
+        今日の行を含み得るローテーション済みファイルを古い順に返す
+
+        更新時刻が今日の0時より前のファイルには今日の行は含まれない。
+        """
+        day_start = datetime.combine(self.day, datetime.min.time()).timestamp()
+        paths = []
+        for path in rotated_log_paths(self.log_path):
+            try:
+                if os.stat(path).st_mtime < day_start:
+                    break
+            except OSError:
+                continue
+            paths.append(path)
+        paths.reverse()
+        return paths
+
+    def _rebuild_from_rotated(self, trend=True):
+        """
+        ローテーション済みファイルから今日の集計を再構築
+
+        状態ファイルがない場合や、前回のファイルを特定できない場合に使う。
+        現在のauth.logはこの後の通常読み込みで先頭から処理される。
+
+        Args:
+            trend: トレンドも作り直すか（Falseなら状態から復元したトレンドを残す）
+        """
+        self.ssh_counts.clear()
+        self.vpn_counts.clear()
+        self.first_seen.clear()
+        self.last_seen.clear()
+        if trend:
+            for ring in self.trend.values():
+                ring.clear()
+
+        paths = self._rotated_today()
+        if paths:
+            logger.info(f"ローテーション済みログから集計を再構築します: {paths}")
+        self._count(iter_auth_events(iter_log_lines(paths)), trend=trend)
+
+    def _catch_up_rotation(self):
+        """
+        ローテーションで移動した前回のファイルの未読部分と、
+        その後さらにローテーションされたファイルを読み込む
+        """
+        rotated = rotated_log_paths(self.log_path)
+        for index, path in enumerate(rotated):
+            if not self._is_previous_file(path):
+                continue
+
+            # 前回のファイルは既に書き込みが終わっているので末尾まで読む
+            with open_log_file(path) as f:
+                f.seek(self.offset)
+                self._count(iter_auth_events(f))
+
+            newer = list(reversed(rotated[:index]))
+            self._count(iter_auth_events(iter_log_lines(newer)))
+            return
+
+        # 今日のファイルだけでは前日以前のトレンドを作り直せないため、トレンドは残す
+        logger.warning("前回のauth.logを特定できません。今日の集計を再構築します")
+        self._rebuild_from_rotated(trend=False)
+
+    # ---------- 読み込み ----------
+
+    def poll(self):
+        """
+        前回の位置以降に追記された行を読み込む
+
+        Returns:
+            bool: auth.logが存在する場合True
+        """
+        with self._lock:
+            try:
+                st = os.stat(self.log_path)
+            except OSError:
+                return False
+
+            self._roll_day(datetime.now().date())
+
+            if self.inode is None:
+                # 初回起動: ローテーション済みファイルから今日の分を集計
+                self._rebuild_from_rotated()
+                self.offset = 0
+            elif st.st_ino != self.inode:
+                # logrotateでファイルが入れ替わった
+                logger.info("auth.logのローテーションを検出しました")
+                self._catch_up_rotation()
+                self.offset = 0
+            elif st.st_size < self.offset:
+                # copytruncate等でファイルが切り詰められた
+                logger.info("auth.logの切り詰めを検出しました")
+                self.offset = 0
+                self.fingerprint = None
+
+            if self.inode != st.st_ino:
+                self.inode = st.st_ino
+                self.fingerprint = None
+            previous_offset = self.offset
+
+            with open(self.log_path, 'rb') as f:
+                f.seek(self.offset)
+                self._count(iter_auth_events(self._complete_lines(f)))
+
+            # 先頭バイトが揃ったらフィンガープリントを記録
+            if self.fingerprint is None and self.offset >= FINGERPRINT_SIZE:
+                self.fingerprint = read_fingerprint(self.log_path)
+
+            # 履歴を書き込んでからオフセットを保存する（取りこぼしより重複を選ぶ）
+            self._flush_history()
+
+            if self.offset != previous_offset:
+                self._save_state()
+
+            return True
+
+    def _ip_record(self, ip):
+        """
+        IPの今日の攻撃回数と初回/最終攻撃時刻（ロック取得済みで呼ぶ）
+
+        Returns:
+            dict: ip_address, ssh_attempts, vpn_attempts, total_attempts, first_seen, last_seen
+        """
+        ssh = self.ssh_counts.get(ip, 0)
+        vpn = self.vpn_counts.get(ip, 0)
+        first = self.first_seen.get(ip)
+        last = self.last_seen.get(ip)
+        return {
+            'ip_address': ip,
+            'ssh_attempts': ssh,
+            'vpn_attempts': vpn,
+            'total_attempts': ssh + vpn,
+            'first_seen': first.isoformat() if first else None,
+            'last_seen': last.isoformat() if last else None,
+        }
+
+    def take_changes(self):
+        """
+        前回の呼び出し以降に攻撃回数が増えたIPとその現在の値を取得
+
+        Returns:
+            list: _ip_record() のリスト
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            return [self._ip_record(ip) for ip in changed]
+
+    def ip_stats(self, ip):
+        """
+        指定IPの今日の攻撃回数と初回/最終攻撃時刻
+
+        Returns:
+            dict: _ip_record() と同じ形式
+        """
+        with self._lock:
+            return self._ip_record(ip)
+
+    def trend_series(self, resolution='hour', now=None):
+        """
+        攻撃トレンドを取得（ログの再読み込みなし）
+
+        Args:
+            resolution: 'minute'（直近1時間）または 'hour'（直近24時間）
+            now: 現在時刻（UNIX時刻、省略時は現在）
+
+        Returns:
+            list: [{'start', 'ssh', 'vpn'}, ...]（古い順）
+        """
+        with self._lock:
+            return self.trend[resolution].series(time.time() if now is None else now)
+
+    def totals(self):
+        """今日の攻撃回数の合計 (ssh, vpn)"""
+        with self._lock:
+            return sum(self.ssh_counts.values()), sum(self.vpn_counts.values())
+
+    def stats(self, limit=None):
+        """
+        現在のカウンターから攻撃統計を構築
+
+        Args:
+            limit: 返す攻撃IPの最大件数（Noneの場合は全件）
+
+        Returns:
+            dict: 攻撃統計情報
+        """
+        with self._lock:
+            attack_ips = [
+                self._ip_record(ip) for ip in set(self.ssh_counts) | set(self.vpn_counts)
+            ]
 
         # 攻撃数でソート
         attack_ips.sort(key=lambda x: x['total_attempts'], reverse=True)
 
         return {
-            'ssh_attacks_today': sum(ssh_failed_attempts.values()),
-            'vpn_attacks_today': sum(vpn_failed_attempts.values()),
-            'attack_ips': attack_ips[:50],  # 上位50件
-            'unique_attackers': len(all_ips)
+            'ssh_attacks_today': sum(a['ssh_attempts'] for a in attack_ips),
+            'vpn_attacks_today': sum(a['vpn_attempts'] for a in attack_ips),
+            'attack_trend': [b['ssh'] + b['vpn'] for b in self.trend_series('hour')],
+            'attack_ips': attack_ips[:limit],
+            'unique_attackers': len(attack_ips)
         }
 
+
+_auth_tailer = AuthLogTailer(history=_history)
+
+
+def parse_auth_log():
+    """
+    /var/log/auth.log を増分解析して攻撃情報を抽出
+
+    Returns:
+        dict: 攻撃統計情報
+    """
+    try:
+        if not _auth_tailer.poll():
+            logger.warning(f"auth.logが見つかりません: {AUTH_LOG_PATH}")
+            return {
+                'ssh_attacks_today': 0,
+                'vpn_attacks_today': 0,
+                'blocked_ips_today': 0,
+                'attack_ips': []
+            }
+
+        return _auth_tailer.stats()
+
     except Exception as e:
         logger.error(f"auth.log解析エラー: {e}")
         return {
@@ -262,70 +1424,2965 @@ def parse_auth_log():
         }
 
 
-def get_ufw_status():
+# ==================== ホワイトリスト ====================
+
+class PrefixTrie:
+    """
+    IPネットワークを格納する2分岐のプレフィックストライ
+
+    包含判定はアドレスのビットを先頭から辿るだけなので、
+    エントリ数に関係なく最長でもアドレス長（IPv4は32、IPv6は128）の手数で済む。
+    """
+
+    __slots__ = ('_root', '_bits')
+
+    def __init__(self, bits):
+        """
+        Args:
+            bits: アドレス長（ビット）
+        """
+        # ノードは [0側の子, 1側の子, このノードで終わるネットワーク]
+        self._root = [None, None, None]
+        self._bits = bits
+
+    def add(self, network):
+        """ネットワークを追加"""
+        node = self._root
+        value = int(network.network_address)
+        for shift in range(self._bits - 1, self._bits - 1 - network.prefixlen, -1):
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = network
+
+    def match(self, address):
+        """
+        アドレスを含むネットワークを探す
+
+        Args:
+            address: ipaddress.IPv4Address または IPv6Address
+
+        Returns:
+            ネットワーク（含まれない場合はNone）
+        """
+        node = self._root
+        if node[2] is not None:
+            return node[2]
+
+        value = int(address)
+        for shift in range(self._bits - 1, -1, -1):
+            node = node[(value >> shift) & 1]
+            if node is None:
+                return None
+            if node[2] is not None:
+                return node[2]
+        return None
+
+
+class AddressSet:
+    """
+    単一アドレスとCIDRが混在する集合
+
+    in 演算子はCIDRに含まれるアドレスも真とする。ファイアウォールの
+    ルールにサブネットが含まれる場合のブロック済み判定に使う。
+    """
+
+    __slots__ = ('_addresses', '_tries', '_has_networks')
+
+    def __init__(self, entries=()):
+        """
+        Args:
+            entries: IPアドレスまたはCIDRの文字列
+        """
+        self._addresses = set()
+        self._tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self._has_networks = False
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """エントリを追加（不正なCIDRは無視する）"""
+        if '/' not in entry:
+            self._addresses.add(entry)
+            return
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            return
+        self._tries[network.version].add(network)
+        self._has_networks = True
+
+    def __contains__(self, ip_address):
+        if ip_address in self._addresses:
+            return True
+        if not self._has_networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return False
+        return self._tries[address.version].match(address) is not None
+
+
+class Whitelist:
+    """
+    ブロックしてはいけないアドレスの一覧（CIDR・IPv6対応）
+
+    WHITELIST_FILE は初回の利用時に一度だけ読み込み、以降の判定は
+    メモリ上のトライで行う。変更はAPI経由で行い、重複を除いた内容で
+    ファイルをアトミックに書き換える。
+    """
+
+    def __init__(self, path=WHITELIST_FILE):
+        """
+        Args:
+            path: ホワイトリストファイルのパス（1行1エントリ、#以降はコメント）
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+
+    @staticmethod
+    def normalize(entry):
+        """
+        エントリを正規化
+
+        単一アドレスはアドレスのまま、CIDRはネットワークアドレスに揃える。
+
+        Args:
+            entry: IPアドレスまたはCIDR
+
+        Returns:
+            tuple: (正規化した文字列, ネットワーク)
+
+        Raises:
+            ValueError: 形式が不正な場合
+        """
+        if not isinstance(entry, str):
+            raise ValueError(f"Invalid IP address or CIDR: {entry!r}")
+
+        network = ipaddress.ip_network(entry.strip(), strict=False)
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address), network
+        return str(network), network
+
+    def _ensure_loaded(self):
+        """未読み込みならファイルを読み込む（_lock を保持した状態で呼ぶ）"""
+        if self._entries is not None:
+            return
+
+        entries = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if not line:
+                        continue
+                    try:
+                        key, network = self.normalize(line)
+                    except ValueError:
+                        logger.warning(f"ホワイトリストの不正な行を無視します: {line}")
+                        continue
+                    entries.setdefault(key, network)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"ホワイトリスト読み込みエラー: {e}")
+
+        self._entries = entries
+        self._rebuild()
+        logger.info(f"ホワイトリストを読み込みました: {len(entries)} 件")
+
+    def _rebuild(self):
+        """エントリからトライを作り直す（参照の差し替えはアトミック）"""
+        tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for network in self._entries.values():
+            tries[network.version].add(network)
+        self._tries = tries
+
+    def _save(self):
+        """現在のエントリでファイルをアトミックに置き換える"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for key in self._entries:
+                f.write(f"{key}\n")
+        os.replace(tmp_path, self.path)
+
+    def entries(self):
+        """
+        Returns:
+            list: 登録順のエントリ
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._entries)
+
+    def match(self, ip_address):
+        """
+        アドレスを含むエントリを探す
+
+        Args:
+            ip_address: IPアドレス
+
+        Returns:
+            str: 該当するエントリ（含まれない・不正なアドレスの場合はNone）
+        """
+        if self._entries is None:
+            with self._lock:
+                self._ensure_loaded()
+
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+
+        network = self._tries[address.version].match(address)
+        if network is None:
+            return None
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+
+    def contains(self, ip_address):
+        """アドレスがホワイトリストに含まれるか"""
+        return self.match(ip_address) is not None
+
+    def overlaps(self, network):
+        """
+        ネットワークと重なるエントリがあるか（サブネット単位でブロックする前の確認）
+
+        Args:
+            network: ipaddress.IPv4Network または IPv6Network
+
+        Returns:
+            bool: 重なるエントリがある場合True
+        """
+        with self._lock:
+            self._ensure_loaded()
+            networks = list(self._entries.values())
+        return any(n.version == network.version and n.overlaps(network) for n in networks)
+
+    def add(self, entry):
+        """
+        エントリを追加
+
+        Returns:
+            tuple: (正規化したエントリ, 追加したか（既に登録済みならFalse）)
+
+        Raises:
+            ValueError: 形式が不正な場合
+        """
+        key, network = self.normalize(entry)
+        with self._lock:
+            self._ensure_loaded()
+            if key in self._entries:
+                return key, False
+            self._entries[key] = network
+            try:
+                self._save()
+            except OSError:
+                del self._entries[key]
+                raise
+            self._rebuild()
+        return key, True
+
+    def remove(self, entry):
+        """
+        エントリを削除
+
+        Returns:
+            tuple: (正規化したエントリ, 削除したか（未登録ならFalse）)
+
+        Raises:
+            ValueError: 形式が不正な場合
+        """
+        key, _ = self.normalize(entry)
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._entries:
+                return key, False
+            network = self._entries.pop(key)
+            try:
+                self._save()
+            except OSError:
+                self._entries[key] = network
+                raise
+            self._rebuild()
+        return key, True
+
+
+_whitelist = Whitelist()
+
+
+# ==================== ファイアウォール操作 ====================
+
+def is_valid_ipv4(ip_address):
+    """
+    IPv4アドレスの形式を検証
+
+    Args:
+        ip_address: 検証する文字列
+
+    Returns:
+        bool: 有効なIPv4アドレスの場合True
+    """
+    if not isinstance(ip_address, str):
+        return False
+    if not re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', ip_address):
+        return False
+    try:
+        ipaddress.IPv4Address(ip_address)
+    except ValueError:
+        return False
+    return True
+
+
+def edit_ufw_user_rules(content, add=(), remove=()):
+    """
+    UFWのuser.rulesにdenyルールを追加/削除した内容を返す
+
+    ufw deny from <IP> が生成するのと同じ形式のルールブロックを扱う:
+
+        ### tuple ### deny any any 0.0.0.0/0 any 1.2.3.4 in
+        -A ufw-user-input -s 1.2.3.4 -j DROP
+
+    Args:
+        content: 現在のuser.rulesの内容
+        add: 追加するIPアドレス
+        remove: 削除するIPアドレス
+
+    Returns:
+        str: 更新後のuser.rulesの内容
+    """
+    remove = set(remove)
+    lines = content.split('\n')
+    result = []
+    skipping = False
+
+    for line in lines:
+        if line.startswith('### tuple ###'):
+            fields = line.split()
+            # ### tuple ### deny any any 0.0.0.0/0 any <src> in
+            skipping = (len(fields) >= 9 and fields[3] == 'deny' and
+                        fields[8] in remove)
+            if skipping:
+                continue
+        elif skipping:
+            # ルールブロックは空行か次のルール/終端で終わる
+            if line.startswith('-A '):
+                continue
+            skipping = False
+            if line == '':
+                continue
+
+        result.append(line)
+
+    if add:
+        block = []
+        for ip in add:
+            block.append(f'### tuple ### deny any any 0.0.0.0/0 any {ip} in')
+            block.append(f'-A ufw-user-input -s {ip} -j DROP')
+            block.append('')
+
+        try:
+            end = result.index('### END RULES ###')
+        except ValueError:
+            raise ValueError('user.rulesに ### END RULES ### が見つかりません')
+        result[end:end] = block
+
+    return '\n'.join(result)
+
+
+# 緊急ロックダウンで使うiptablesのチェーン名とnftablesのテーブル名
+LOCKDOWN_CHAIN = 'HA_MONITOR_LOCKDOWN'
+LOCKDOWN_TABLE = 'inet ha_monitor_lockdown'
+# ロックダウン中も許可するICMPv6（ルーター要請/広告、近隣要請/広告）。
+# conntrackで追跡されないため、拒否するとIPv6の通信自体ができなくなる
+LOCKDOWN_NDP_TYPES = {
+    133: 'nd-router-solicit',
+    134: 'nd-router-advert',
+    135: 'nd-neighbor-solicit',
+    136: 'nd-neighbor-advert',
+}
+
+
+def split_networks(networks):
+    """
+    IPアドレス/CIDRをIPv4とIPv6に分ける
+
+    Returns:
+        tuple: (IPv4のリスト, IPv6のリスト)
+    """
+    v4, v6 = [], []
+    for entry in networks:
+        (v6 if ':' in entry else v4).append(entry)
+    return v4, v6
+
+
+def build_iptables_lockdown(networks, replace=False, ipv6=False):
+    """
+    ホワイトリスト以外の新規接続を拒否する iptables-restore --noflush 用スクリプト
+
+    既存のルールには触れず、専用チェーンをINPUTの先頭から参照する。
+    ループバックと確立済みの接続（操作中のSSHなど）は許可する。
+
+    Args:
+        networks: 許可するIPアドレス/CIDR（同じアドレスファミリーのもの）
+        replace: ロックダウン中の更新（INPUTからの参照は追加しない）
+        ipv6: ip6tables 用（近隣探索のICMPv6を許可する）
+
+    Returns:
+        str: スクリプト
+    """
+    lines = [
+        '*filter',
+        # --noflush でもユーザー定義チェーンは宣言時に空になる
+        f':{LOCKDOWN_CHAIN} - [0:0]',
+        f'-A {LOCKDOWN_CHAIN} -i lo -j ACCEPT',
+        f'-A {LOCKDOWN_CHAIN} -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT',
+    ]
+    if ipv6:
+        lines += [
+            f'-A {LOCKDOWN_CHAIN} -p ipv6-icmp --icmpv6-type {icmp_type} -j ACCEPT'
+            for icmp_type in LOCKDOWN_NDP_TYPES
+        ]
+    lines += [f'-A {LOCKDOWN_CHAIN} -s {network} -j ACCEPT' for network in networks]
+    lines.append(f'-A {LOCKDOWN_CHAIN} -j DROP')
+    if not replace:
+        lines.append(f'-I INPUT 1 -j {LOCKDOWN_CHAIN}')
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def build_iptables_release():
+    """ロックダウン用チェーンを取り除く iptables-restore --noflush 用スクリプト"""
+    return (
+        '*filter\n'
+        f'-D INPUT -j {LOCKDOWN_CHAIN}\n'
+        f'-F {LOCKDOWN_CHAIN}\n'
+        f'-X {LOCKDOWN_CHAIN}\n'
+        'COMMIT\n'
+    )
+
+
+def build_nft_lockdown(networks):
+    """
+    ホワイトリスト以外の新規接続を拒否する nft -f 用スクリプト
+
+    専用テーブルを作り直すだけなので、ブロック用のテーブルには触れない。
+    許可するアドレスはセットに入れるため、ルール数は一定。
+
+    Args:
+        networks: 許可するIPアドレス/CIDR
+
+    Returns:
+        str: スクリプト
+    """
+    v4, v6 = split_networks(networks)
+
+    def define_set(name, addr_type, elements):
+        body = f"type {addr_type}; flags interval;"
+        if elements:
+            body += f" elements = {{ {', '.join(elements)} }};"
+        return f"    set {name} {{ {body} }}"
+
+    return '\n'.join([
+        # 既存のテーブルがあっても無くても同じトランザクションで作り直す
+        f"add table {LOCKDOWN_TABLE}",
+        f"delete table {LOCKDOWN_TABLE}",
+        f"table {LOCKDOWN_TABLE} {{",
+        define_set('allow4', 'ipv4_addr', v4),
+        define_set('allow6', 'ipv6_addr', v6),
+        "    chain input {",
+        "        type filter hook input priority -20; policy drop;",
+        '        iif "lo" accept',
+        "        ct state established,related accept",
+        f"        icmpv6 type {{ {', '.join(LOCKDOWN_NDP_TYPES.values())} }} accept",
+        "        ip saddr @allow4 accept",
+        "        ip6 saddr @allow6 accept",
+        "    }",
+        "}",
+    ]) + '\n'
+
+
+class FirewallBackend:
+    """
+    ファイアウォールバックエンドの基底クラス
+
+    各メソッドは (成功したか, エラーメッセージ) を返す。
+    一括操作は1回のトランザクションとして適用されること。
+    """
+
+    name = None
+
+    def setup(self):
+        """起動時の初期化（セットやルールの作成）"""
+        return True, ''
+
+    def read_status(self):
+        """
+        実際のルールセットを読み込む
+
+        Returns:
+            dict: firewall_active, blocked_ips（取得失敗時はNone）
+        """
+        raise NotImplementedError
+
+    def block(self, ip_address):
+        """IPアドレスをブロック"""
+        return self.block_many([ip_address])
+
+    def unblock(self, ip_address):
+        """IPアドレスのブロックを解除"""
+        return self.unblock_many([ip_address])
+
+    def block_many(self, ip_addresses):
+        """複数のIPアドレスを1回のトランザクションでブロック"""
+        raise NotImplementedError
+
+    def unblock_many(self, ip_addresses):
+        """複数のIPアドレスのブロックを1回のトランザクションで解除"""
+        raise NotImplementedError
+
+    def replace(self, add, remove):
+        """
+        ルールを追加し、不要になったルールを削除する（サブネット集約用）
+
+        既定の実装は追加してから削除するため、途中で失敗しても
+        対象が一時的にブロックされなくなることはない。
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        if add:
+            ok, error = self.block_many(add)
+            if not ok:
+                return ok, error
+        if not remove:
+            return True, ''
+        return self.unblock_many(remove)
+
+    # iptablesを使うバックエンド（ufw, ipset）の緊急ロックダウン
+
+    RESTORE_COMMANDS = {
+        'iptables': (['sudo', 'iptables-save', '-t', 'filter'], ['sudo', 'iptables-restore']),
+        'ip6tables': (['sudo', 'ip6tables-save', '-t', 'filter'], ['sudo', 'ip6tables-restore']),
+    }
+
+    def snapshot(self):
+        """
+        ロックダウン前のルールセットを保存する（解除に失敗した場合の復元用）
+
+        Returns:
+            dict: コマンド名 -> iptables-save の出力
+        """
+        snapshot = {}
+        for name, (save, _) in self.RESTORE_COMMANDS.items():
+            stdout, _, returncode = run_command(save)
+            if returncode == 0:
+                snapshot[name] = stdout
+        return snapshot
+
+    def lockdown(self, networks, replace=False):
+        """
+        ホワイトリスト以外の新規接続を拒否するルールを1回で適用する
+
+        IPv4とIPv6それぞれで iptables-restore --noflush を1回ずつ実行する。
+        既存のルール数に関係なく、コマンドの回数と処理量は一定。
+
+        Args:
+            networks: 許可するIPアドレス/CIDR
+            replace: ロックダウン中の更新
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        v4, v6 = split_networks(networks)
+        applied = []
+        for name, family in (('iptables', v4), ('ip6tables', v6)):
+            restore = self.RESTORE_COMMANDS[name][1]
+            script = build_iptables_lockdown(family, replace, ipv6=name == 'ip6tables')
+            _, stderr, returncode = run_command(restore + ['--noflush'], input_text=script)
+            if returncode != 0:
+                if applied and not replace:
+                    # 片方だけロックダウンされた状態を残さない
+                    for done in applied:
+                        run_command(self.RESTORE_COMMANDS[done][1] + ['--noflush'],
+                                    input_text=build_iptables_release())
+                return False, stderr
+            applied.append(name)
+        return True, ''
+
+    def release(self, snapshot=None):
+        """
+        ロックダウンを解除する
+
+        専用チェーンを1回で取り除く。失敗した場合は保存しておいた
+        ルールセットを iptables-restore で丸ごと復元する。
+
+        Args:
+            snapshot: snapshot() の結果
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        errors = []
+        for name, (_, restore) in self.RESTORE_COMMANDS.items():
+            _, stderr, returncode = run_command(
+                restore + ['--noflush'], input_text=build_iptables_release()
+            )
+            if returncode == 0:
+                continue
+
+            saved = (snapshot or {}).get(name)
+            if saved is None:
+                errors.append(stderr)
+                continue
+            logger.warning(f"ロックダウン用チェーンを削除できないため、{name}のルールを復元します: {stderr}")
+            _, stderr, returncode = run_command(restore, input_text=saved)
+            if returncode != 0:
+                errors.append(stderr)
+
+        return not errors, '; '.join(errors)
+
+
+class UfwBackend(FirewallBackend):
+    """
+    UFWを使うファイアウォールバックエンド
+
+    単体の操作は ufw コマンドで行う。一括操作は ufw がIPごとに
+    ルールセット全体を再読み込みしてしまうため、user.rules を
+    まとめて書き換えてから ufw reload を一度だけ実行する。
+    """
+
+    name = 'ufw'
+
+    def __init__(self, user_rules_path=UFW_USER_RULES):
+        """
+        Args:
+            user_rules_path: UFWのユーザールールファイル
+        """
+        self.user_rules_path = user_rules_path
+        # ファイアウォールの変更は常に直列化する
+        self._lock = threading.Lock()
+
+    def read_status(self):
+        """
+        実際のルールセットを読み込む
+
+        Returns:
+            dict: firewall_active, blocked_ips（取得失敗時はNone）
+        """
+        return read_ufw_status()
+
+    def block(self, ip_address):
+        """
+        IPアドレスをブロック
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        with self._lock:
+            _, stderr, returncode = run_command(
+                ['sudo', 'ufw', 'deny', 'from', ip_address]
+            )
+        return returncode == 0, stderr
+
+    def unblock(self, ip_address):
+        """
+        IPアドレスのブロックを解除
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        with self._lock:
+            _, stderr, returncode = run_command(
+                ['sudo', 'ufw', 'delete', 'deny', 'from', ip_address]
+            )
+        return returncode == 0, stderr
+
+    def block_many(self, ip_addresses):
+        """
+        複数のIPアドレスを1回のトランザクションでブロック
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        return self._apply_user_rules(add=ip_addresses)
+
+    def unblock_many(self, ip_addresses):
+        """
+        複数のIPアドレスのブロックを1回のトランザクションで解除
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        return self._apply_user_rules(remove=ip_addresses)
+
+    def replace(self, add, remove):
+        """
+        ルールの追加と削除を1回の ufw reload で適用
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        return self._apply_user_rules(add=add, remove=remove)
+
+    def _apply_user_rules(self, add=(), remove=()):
+        """
+        user.rulesを書き換えて ufw reload を一度だけ実行する
+
+        reloadに失敗した場合は元の内容に戻して再度reloadする。
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        with self._lock:
+            try:
+                with open(self.user_rules_path, 'r') as f:
+                    original = f.read()
+                updated = edit_ufw_user_rules(original, add=add, remove=remove)
+                self._write_user_rules(updated)
+            except (OSError, ValueError) as e:
+                logger.error(f"user.rules更新エラー: {e}")
+                return False, str(e)
+
+            _, stderr, returncode = run_command(['sudo', 'ufw', 'reload'])
+            if returncode == 0:
+                return True, ''
+
+            logger.error(f"ufw reload失敗、ルールを元に戻します: {stderr}")
+            try:
+                self._write_user_rules(original)
+                run_command(['sudo', 'ufw', 'reload'])
+            except OSError as e:
+                logger.error(f"user.rulesの復元エラー: {e}")
+            return False, stderr
+
+    def _write_user_rules(self, content):
+        """user.rulesをアトミックに置き換える"""
+        tmp_path = f"{self.user_rules_path}.ha_monitor.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o640)
+        os.replace(tmp_path, self.user_rules_path)
+
+
+class IpsetBackend(FirewallBackend):
+    """
+    ipsetのハッシュセットを使うファイアウォールバックエンド
+
+    ブロック対象はハッシュセットに格納し、iptablesからは
+    1本のルール（-m set --match-set）で参照する。パケット照合も
+    追加/削除もセットの大きさに関係なく定数時間で済む。
+    """
+
+    name = 'ipset'
+
+    def __init__(self, set_name=BLOCK_SET_NAME):
+        """
+        Args:
+            set_name: ipsetのセット名
+        """
+        self.set_name = set_name
+        self._lock = threading.Lock()
+
+    def _match_rule(self, flag, position=()):
+        """セットを参照するiptablesルールのコマンド"""
+        return ['sudo', 'iptables', flag, 'INPUT', *position, '-m', 'set',
+                '--match-set', self.set_name, 'src', '-j', 'DROP']
+
+    def setup(self):
+        """セットと参照ルールを作成（既にあれば何もしない）"""
+        with self._lock:
+            _, stderr, returncode = run_command(
+                ['sudo', 'ipset', 'create', self.set_name, 'hash:net',
+                 'family', 'inet', 'maxelem', '1048576', '-exist']
+            )
+            if returncode != 0:
+                return False, stderr
+
+            _, _, returncode = run_command(self._match_rule('-C'))
+            if returncode != 0:
+                _, stderr, returncode = run_command(self._match_rule('-I', ['1']))
+                if returncode != 0:
+                    return False, stderr
+
+        return True, ''
+
+    def read_status(self):
+        """ipset save の出力からセットの要素を読み込む"""
+        stdout, _, returncode = run_command(['sudo', 'ipset', 'save', self.set_name])
+        if returncode != 0:
+            logger.error("ipset save失敗")
+            return None
+
+        blocked_ips = []
+        prefix = f"add {self.set_name} "
+        for line in stdout.split('\n'):
+            if line.startswith(prefix):
+                blocked_ips.append(line[len(prefix):].split()[0])
+
+        _, _, rule_check = run_command(self._match_rule('-C'))
+        return {
+            'firewall_active': rule_check == 0,
+            'blocked_ips': blocked_ips,
+        }
+
+    def _restore(self, verb, ip_addresses, script=''):
+        """ipset restore で複数の要素をまとめて追加/削除"""
+        script += ''.join(f"{verb} {self.set_name} {ip}\n" for ip in ip_addresses)
+        with self._lock:
+            _, stderr, returncode = run_command(
+                ['sudo', 'ipset', 'restore', '-exist'], input_text=script
+            )
+        return returncode == 0, stderr
+
+    def block_many(self, ip_addresses):
+        """複数のIPアドレスをセットに追加"""
+        return self._restore('add', ip_addresses)
+
+    def unblock_many(self, ip_addresses):
+        """複数のIPアドレスをセットから削除"""
+        return self._restore('del', ip_addresses)
+
+    def replace(self, add, remove):
+        """要素の追加と削除を1回の ipset restore で適用"""
+        script = ''.join(f"add {self.set_name} {ip}\n" for ip in add)
+        return self._restore('del', remove, script=script)
+
+
+class NftablesBackend(FirewallBackend):
+    """
+    nftablesのセットを使うファイアウォールバックエンド
+
+    専用テーブルのセットにブロック対象を格納し、1本のルールで参照する。
+    変更は nft -f による1回のトランザクションで適用される。
+    """
+
+    name = 'nftables'
+
+    TABLE = 'inet ha_monitor'
+
+    def __init__(self, set_name=BLOCK_SET_NAME):
+        """
+        Args:
+            set_name: nftablesのセット名
+        """
+        self.set_name = set_name
+        self._lock = threading.Lock()
+
+    def _run_script(self, script):
+        """nft -f でスクリプトをアトミックに適用"""
+        with self._lock:
+            _, stderr, returncode = run_command(
+                ['sudo', 'nft', '-f', '-'], input_text=script
+            )
+        return returncode == 0, stderr
+
+    def setup(self):
+        """テーブル、セット、参照ルールを作成（既存のセット要素は維持）"""
+        return self._run_script(
+            f"add table {self.TABLE}\n"
+            f"add set {self.TABLE} {self.set_name} "
+            f"{{ type ipv4_addr; flags interval; }}\n"
+            f"add chain {self.TABLE} input "
+            f"{{ type filter hook input priority -10; policy accept; }}\n"
+            f"flush chain {self.TABLE} input\n"
+            f"add rule {self.TABLE} input ip saddr @{self.set_name} drop\n"
+        )
+
+    def read_status(self):
+        """nft -j list set の出力からセットの要素を読み込む"""
+        stdout, _, returncode = run_command(
+            ['sudo', 'nft', '-j', 'list', 'set'] + self.TABLE.split() + [self.set_name]
+        )
+        if returncode != 0:
+            logger.error("nft list set失敗")
+            return None
+
+        try:
+            items = json.loads(stdout).get('nftables', [])
+        except ValueError as e:
+            logger.error(f"nft出力の解析エラー: {e}")
+            return None
+
+        blocked_ips = []
+        for item in items:
+            for elem in item.get('set', {}).get('elem', []):
+                if isinstance(elem, str):
+                    blocked_ips.append(elem)
+                elif isinstance(elem, dict) and 'prefix' in elem:
+                    prefix = elem['prefix']
+                    blocked_ips.append(f"{prefix['addr']}/{prefix['len']}")
+
+        return {
+            'firewall_active': True,
+            'blocked_ips': blocked_ips,
+        }
+
+    def _elements(self, verb, ip_addresses):
+        """セット要素を追加/削除するスクリプト"""
+        return (f"{verb} element {self.TABLE} {self.set_name} "
+                f"{{ {', '.join(ip_addresses)} }}\n")
+
+    def block_many(self, ip_addresses):
+        """複数のIPアドレスをセットに追加"""
+        return self._run_script(self._elements('add', ip_addresses))
+
+    def unblock_many(self, ip_addresses):
+        """複数のIPアドレスをセットから削除"""
+        return self._run_script(self._elements('delete', ip_addresses))
+
+    def replace(self, add, remove):
+        """
+        要素の削除と追加を1回のトランザクションで適用
+
+        intervalセットでは重なる要素を追加できないため、先に削除する。
+        """
+        script = self._elements('delete', remove) if remove else ''
+        if add:
+            script += self._elements('add', add)
+        return self._run_script(script)
+
+    def snapshot(self):
+        """ロックダウンは専用テーブルで行うため、既存のルールセットの保存は不要"""
+        return None
+
+    def lockdown(self, networks, replace=False):
+        """ホワイトリスト以外の新規接続を拒否する専用テーブルを1回のトランザクションで作成"""
+        return self._run_script(build_nft_lockdown(networks))
+
+    def release(self, snapshot=None):
+        """ロックダウン用のテーブルを1回のトランザクションで削除（テーブルがなくても成功する）"""
+        return self._run_script(f"add table {LOCKDOWN_TABLE}\ndelete table {LOCKDOWN_TABLE}\n")
+
+
+FIREWALL_BACKENDS = {
+    UfwBackend.name: UfwBackend,
+    IpsetBackend.name: IpsetBackend,
+    NftablesBackend.name: NftablesBackend,
+}
+
+
+def create_firewall_backend(name):
+    """
+    設定名からファイアウォールバックエンドを作成
+
+    Args:
+        name: 'ufw', 'ipset', 'nftables'
+
+    Returns:
+        FirewallBackend: バックエンドのインスタンス
+    """
+    try:
+        return FIREWALL_BACKENDS[name]()
+    except KeyError:
+        raise ValueError(
+            f"不明なファイアウォールバックエンド: {name} "
+            f"(選択肢: {', '.join(FIREWALL_BACKENDS)})"
+        )
+
+
+_firewall = create_firewall_backend(FIREWALL_BACKEND)
+
+
+def apply_batch(action, ip_addresses):
+    """
+    一括ブロック/解除を実行
+
+    入力を検証し、重複と既存ルール（ブロック時はホワイトリストも）を
+    除外した上で、残りを1回のファイアウォールトランザクションで適用する。
+
+    Args:
+        action: 'block' または 'unblock'
+        ip_addresses: IPアドレスのリスト
+
+    Returns:
+        tuple: (IPごとの結果リスト, トランザクションが成功したか)
+    """
+    results = []
+    pending = []
+    seen = set()
+
+    for ip in ip_addresses:
+        if not is_valid_ipv4(ip):
+            results.append({
+                'ip_address': ip,
+                'success': False,
+                'status': 'invalid',
+                'error': 'Invalid IP address format'
+            })
+            continue
+
+        if ip in seen:
+            results.append({'ip_address': ip, 'success': True, 'status': 'duplicate'})
+            continue
+        seen.add(ip)
+
+        whitelisted = _whitelist.match(ip) if action == 'block' else None
+        if whitelisted is not None:
+            results.append({
+                'ip_address': ip,
+                'success': False,
+                'status': 'whitelisted',
+                'error': f'Whitelisted by {whitelisted}'
+            })
+            continue
+
+        if action == 'block':
+            blocked = _firewall_state.is_covered(ip)
+        else:
+            blocked = _firewall_state.is_blocked(ip)
+        if action == 'block' and blocked:
+            results.append({'ip_address': ip, 'success': True, 'status': 'already_blocked'})
+        elif action == 'unblock' and not blocked:
+            results.append({'ip_address': ip, 'success': True, 'status': 'not_blocked'})
+        else:
+            entry = {'ip_address': ip}
+            pending.append(entry)
+            results.append(entry)
+
+    if not pending:
+        return results, True
+
+    targets = [entry['ip_address'] for entry in pending]
+    if action == 'block':
+        ok, error = _firewall.block_many(targets)
+    else:
+        ok, error = _firewall.unblock_many(targets)
+
+    for entry in pending:
+        if ok:
+            entry['success'] = True
+            entry['status'] = 'blocked' if action == 'block' else 'unblocked'
+            if action == 'block':
+                _firewall_state.add_blocked(entry['ip_address'])
+            else:
+                _firewall_state.remove_blocked(entry['ip_address'])
+        else:
+            entry['success'] = False
+            entry['status'] = 'failed'
+            entry['error'] = error
+
+    return results, ok
+
+
+# ==================== ファイアウォール状態キャッシュ ====================
+
+def read_ufw_status():
+    """
+    sudo ufw status numbered を実行して現在のルールセットを読み込む
+
+    Returns:
+        dict: firewall_active, blocked_ips（取得失敗時はNone）
+    """
+    stdout, _, returncode = run_command(['sudo', 'ufw', 'status', 'numbered'])
+
+    if returncode != 0:
+        logger.error("UFW status取得失敗")
+        return None
+
+    blocked_ips = []
+    for line in stdout.split('\n'):
+        # [ 1] Deny from 192.168.1.1（サブネットは 192.168.1.0/24）
+        match = re.search(r'Deny from ([\d\.]+(?:/\d+)?)', line)
+        if match:
+            blocked_ips.append(match.group(1))
+
+    return {
+        'firewall_active': 'Status: active' in stdout,
+        'blocked_ips': blocked_ips,
+    }
+
+
+class FirewallStateCache:
+    """
+    ファイアウォールのブロックリストのメモリ上のモデル
+
+    起動時に一度だけ読み込み、block_ip()/unblock_ip() の成功時に
+    ライトスルーで更新する。エージェント外での変更（手動のufw操作など）は
+    収集スレッドからの定期的な再照合で取り込むため、
+    読み取り側のエンドポイントがufwを起動することはない。
+    """
+
+    def __init__(self, loader, reconcile_interval=UFW_RECONCILE_INTERVAL):
+        """
+        Args:
+            loader: 実際のルールセットを読み込む関数
+            reconcile_interval: 再照合の間隔（秒）
+        """
+        self.loader = loader
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._active = False
+        self._blocked = {}  # 挿入順を保持するためdictを使う
+        self._loaded_at = None
+        self._version = 0  # ライトスルー更新ごとに増える
+        self._covered = None  # CIDRを含む包含判定用（変更時に作り直す）
+
+    def load(self):
+        """
+        実際のルールセットを読み込んでモデルを置き換える
+
+        Returns:
+            bool: 読み込みに成功した場合True
+        """
+        with self._lock:
+            version = self._version
+
+        state = self.loader()
+        if state is None:
+            # 読み込みに失敗した場合は前回のモデルを維持する
+            return False
+
+        blocked = dict.fromkeys(state['blocked_ips'])
+        with self._lock:
+            if self._version != version:
+                # 読み込み中にブロック操作があったため、古い結果で上書きしない
+                return False
+            if self._loaded_at is not None and blocked.keys() != self._blocked.keys():
+                logger.info(
+                    f"ファイアウォールルールの外部変更を検出しました: "
+                    f"{len(self._blocked)} → {len(blocked)} 件"
+                )
+            self._active = state['firewall_active']
+            self._blocked = blocked
+            self._covered = None
+            self._loaded_at = time.monotonic()
+        return True
+
+    def ensure_loaded(self):
+        """未読み込みの場合のみ読み込む"""
+        if self._loaded_at is None:
+            self.load()
+
+    def reconcile_if_due(self):
+        """前回の読み込みから再照合間隔が経過していれば読み直す"""
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= self.reconcile_interval:
+            self.load()
+
+    def is_blocked(self, ip_address):
+        """IPに対するルールがあるか判定（完全一致）"""
+        self.ensure_loaded()
+        return ip_address in self._blocked
+
+    def is_covered(self, ip_address):
+        """IPがブロックされているか判定（サブネットのルールに含まれる場合も含む）"""
+        self.ensure_loaded()
+        covered = self._covered
+        if covered is None:
+            with self._lock:
+                covered = self._covered = AddressSet(self._blocked)
+        return ip_address in covered
+
+    def add_blocked(self, ip_address):
+        """ブロック成功をモデルに反映"""
+        self.ensure_loaded()
+        with self._lock:
+            self._blocked[ip_address] = None
+            self._covered = None
+            self._version += 1
+
+    def remove_blocked(self, ip_address):
+        """ブロック解除成功をモデルに反映"""
+        self.ensure_loaded()
+        with self._lock:
+            self._blocked.pop(ip_address, None)
+            self._covered = None
+            self._version += 1
+
+    def status(self):
+        """
+        get_ufw_status() 形式で現在のモデルを返す
+
+        Returns:
+            dict: 防火墙規則情報
+        """
+        self.ensure_loaded()
+        with self._lock:
+            blocked_ips = list(self._blocked)
+            active = self._active
+
+        return {
+            'firewall_active': active,
+            'rules_count': len(blocked_ips),
+            'blocked_ips': blocked_ips,
+            'blocked_ips_today': len(blocked_ips)  # 簡略化：今日封禁された数として扱う
+        }
+
+
+_firewall_state = FirewallStateCache(_firewall.read_status)
+
+
+def get_ufw_status():
+    """
+    UFW防火墙状態を取得（メモリ上のモデルから）
+
+    Returns:
+        dict: 防火墙規則情報
+    """
+    try:
+        return _firewall_state.status()
+
+    except Exception as e:
+        logger.error(f"UFW状態取得エラー: {e}")
+        return {
+            'firewall_active': False,
+            'rules_count': 0,
+            'blocked_ips': [],
+            'blocked_ips_today': 0
+        }
+
+
+# ==================== サブネット集約 ====================
+
+def plan_aggregation(blocked, attacking, whitelist, prefixlen=AGGREGATE_PREFIX,
+                     min_hosts=AGGREGATE_MIN_HOSTS, min_blocked=AGGREGATE_MIN_BLOCKED):
+    """
+    ブロック済み・攻撃中のIPが密集しているサブネットを検出し、集約案を作る
+
+    同じサブネットに min_blocked 件以上のブロック済みIPがあり、攻撃中のIPと
+    合わせて min_hosts 件以上になるサブネットを1本のCIDRルールにまとめる。
+    ホワイトリストと重なるサブネットは集約しない。隣接するサブネットや
+    既存のCIDRルールとはさらにまとめ、それらに含まれるルールは削除対象にする。
+    対象はIPv4のみ。
+
+    Args:
+        blocked: 現在のルール（IPアドレスまたはCIDR）
+        attacking: 攻撃中のIPアドレス
+        whitelist: Whitelist
+        prefixlen: 集約の単位となるプレフィックス長
+        min_hosts: 集約に必要なブロック済み・攻撃中のアドレス数
+        min_blocked: そのうち既にブロック済みである必要があるアドレス数
+
+    Returns:
+        dict: clusters（検出したサブネット）, add（追加するCIDR）, remove（削除するルール）
+    """
+    existing = {}
+    for entry in blocked:
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            continue
+        if network.version == 4:
+            existing[entry] = network
+
+    members = defaultdict(lambda: (set(), set()))
+    for entry, network in existing.items():
+        if network.prefixlen == network.max_prefixlen:
+            members[network.supernet(new_prefix=prefixlen)][0].add(entry)
+    for ip in attacking:
+        if is_valid_ipv4(ip):
+            members[ipaddress.ip_network(f"{ip}/{prefixlen}", strict=False)][1].add(ip)
+
+    clusters = []
+    candidates = []
+    for network, (blocked_hosts, attacking_hosts) in members.items():
+        hosts = blocked_hosts | attacking_hosts
+        if len(blocked_hosts) < min_blocked or len(hosts) < min_hosts:
+            continue
+        whitelisted = whitelist.overlaps(network)
+        clusters.append({
+            'network': str(network),
+            'blocked': len(blocked_hosts),
+            'attacking': len(attacking_hosts - blocked_hosts),
+            'whitelisted': whitelisted,
+        })
+        if not whitelisted:
+            candidates.append(network)
+
+    if not candidates:
+        return {'clusters': clusters, 'add': [], 'remove': []}
+
+    # 既存のCIDRルールや隣接するサブネットとまとめる（覆う範囲は増えない）
+    merged = list(ipaddress.collapse_addresses(
+        candidates + [n for n in existing.values() if n.prefixlen < n.max_prefixlen]
+    ))
+    merged_trie = PrefixTrie(32)
+    for network in merged:
+        merged_trie.add(network)
+
+    def covered(network):
+        match = merged_trie.match(network.network_address)
+        return match is not None and match.prefixlen <= network.prefixlen
+
+    merged_keys = {str(network) for network in merged}
+    remove = [
+        entry for entry, network in existing.items()
+        if entry not in merged_keys and covered(network)
+    ]
+    add = [str(network) for network in merged if str(network) not in existing]
+
+    clusters.sort(key=lambda c: c['blocked'] + c['attacking'], reverse=True)
+    return {'clusters': clusters, 'add': add, 'remove': remove}
+
+
+class SubnetAggregator:
+    """
+    ブロック済みIPのサブネット集約を提案・適用する
+
+    propose モードでは /api/aggregate で集約案を返すだけで、
+    apply モードでは収集スレッドが収集ごとに集約案を自動で適用する。
+    """
+
+    def __init__(self, mode=AGGREGATE_MODE):
+        """
+        Args:
+            mode: 'off', 'propose', 'apply'
+        """
+        self.mode = mode
+        self._lock = threading.Lock()
+
+    def plan(self, attack_ips):
+        """
+        現在のルールと攻撃中のIPから集約案を作る
+
+        Args:
+            attack_ips: 攻撃中のIP（auth_stats['attack_ips'] 形式）
+
+        Returns:
+            dict: plan_aggregation() の結果
+        """
+        # 期限付きブロックをサブネットに含めると無期限になってしまうため除外する
+        expiries = _block_expiry.expiries()
+        return plan_aggregation(
+            [ip for ip in _firewall_state.status()['blocked_ips'] if ip not in expiries],
+            [attack['ip_address'] for attack in attack_ips],
+            _whitelist,
+        )
+
+    def apply(self, plan):
+        """
+        集約案を1回のファイアウォール操作で適用する
+
+        Args:
+            plan: plan_aggregation() の結果
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ)
+        """
+        # 既存のCIDRに含まれる個別ルールの削除だけの場合もある
+        if not plan['add'] and not plan['remove']:
+            return True, ''
+
+        with self._lock:
+            ok, error = _firewall.replace(plan['add'], plan['remove'])
+            if not ok:
+                logger.error(f"サブネット集約の適用に失敗しました: {error}")
+                return False, error
+
+            for network in plan['add']:
+                _firewall_state.add_blocked(network)
+            for entry in plan['remove']:
+                _firewall_state.remove_blocked(entry)
+
+        logger.info(
+            f"サブネットを集約しました: {', '.join(plan['add']) or '追加なし'}"
+            f"（{len(plan['remove'])} 件のルールを削除）"
+        )
+        return True, ''
+
+    def run(self, snapshot):
+        """収集スレッドから呼ばれる。apply モードなら集約案を適用する"""
+        if self.mode != 'apply':
+            return False
+        plan = self.plan(snapshot.auth_stats['attack_ips'])
+        if not plan['add'] and not plan['remove']:
+            return False
+        ok, _ = self.apply(plan)
+        return ok
+
+
+_aggregator = SubnetAggregator()
+
+
+def calculate_threat_level(attack_count):
+    """
+    攻撃回数から脅威レベルを計算
+
+    Args:
+        attack_count: 総攻撃回数
+
+    Returns:
+        str: 'low', 'medium', 'high', 'critical'
+    """
+    if attack_count < 10:
+        return 'low'
+    elif attack_count < 50:
+        return 'medium'
+    elif attack_count < 200:
+        return 'high'
+    else:
+        return 'critical'
+
+
+THREAT_LEVEL_ORDER = {'low': 0, 'medium': 1, 'high': 2, 'critical': 3}
+
+
+def _parse_bool(value):
+    """クエリパラメータの真偽値を解釈"""
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError(f"Invalid boolean: {value}")
+
+
+def _parse_int(value, name, minimum, maximum=None):
+    """クエリパラメータの整数を解釈して範囲を検証"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}: {value}")
+    if maximum is None:
+        if number < minimum:
+            raise ValueError(f"{name} must be >= {minimum}")
+    elif not minimum <= number <= maximum:
+        raise ValueError(f"{name} must be between {minimum} and {maximum}")
+    return number
+
+
+def block_ttl(expires_at, now=None):
+    """
+    期限付きブロックの残り秒数
+
+    Args:
+        expires_at: 解除予定（ISO 8601、無期限・未ブロックならNone）
+        now: 基準時刻（datetime、省略時は現在時刻）
+
+    Returns:
+        int: 残り秒数（期限がなければNone）
+    """
+    if not expires_at:
+        return None
+    remaining = datetime.fromisoformat(expires_at) - (now or datetime.now())
+    return max(0, int(remaining.total_seconds()))
+
+
+def query_threats(threats, args, now=None):
+    """
+    脅威リストにフィルター・ページング・フィールド選択を適用
+
+    Args:
+        threats: build_threats_payload() の結果（攻撃回数の降順）
+        args: クエリパラメータ
+            limit: 1ページの件数（既定 THREATS_DEFAULT_LIMIT、上限 THREATS_MAX_LIMIT）
+            offset: 先頭からの位置
+            min_level: この脅威レベル以上のみ（low, medium, high, critical）
+            blocked: true/false でブロック済みか否かを絞り込む
+            since: この時刻（ISO 8601）以降に攻撃があったIPのみ
+            fields: 返すフィールド（カンマ区切り）
+        now: block_ttl の基準時刻（datetime、省略時は現在時刻）
+
+    Returns:
+        dict: 脅威リストレスポンス（matched, offset, limit, next_offset を追加）
+
+    Raises:
+        ValueError: パラメータが不正な場合
+    """
+    limit = _parse_int(args.get('limit', THREATS_DEFAULT_LIMIT), 'limit', 1, THREATS_MAX_LIMIT)
+    offset = _parse_int(args.get('offset', 0), 'offset', 0)
+
+    conditions = []
+
+    if 'min_level' in args:
+        if args['min_level'] not in THREAT_LEVEL_ORDER:
+            raise ValueError(f"Invalid min_level: {args['min_level']}")
+        min_rank = THREAT_LEVEL_ORDER[args['min_level']]
+        conditions.append(lambda t: THREAT_LEVEL_ORDER[t['threat_level']] >= min_rank)
+
+    if 'blocked' in args:
+        blocked = _parse_bool(args['blocked'])
+        conditions.append(lambda t: t['blocked'] is blocked)
+
+    if 'since' in args:
+        try:
+            since = datetime.fromisoformat(args['since'])
+        except ValueError:
+            raise ValueError(f"Invalid since: {args['since']}")
+        if since.tzinfo is not None:
+            since = since.astimezone().replace(tzinfo=None)
+        # 最終攻撃時刻は同じ形式のローカル時刻なので文字列のまま比較できる
+        since = since.isoformat()
+        conditions.append(lambda t: (t['last_attack_time'] or '') >= since)
+
+    fields = None
+    if 'fields' in args:
+        fields = [f for f in args['fields'].split(',') if f]
+        known = (set(threats['threat_list'][0]) | {'block_ttl'}) if threats['threat_list'] else set(fields)
+        unknown = [f for f in fields if f not in known]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    matched = [t for t in threats['threat_list'] if all(c(t) for c in conditions)]
+    page = [
+        dict(t, block_ttl=block_ttl(t.get('block_expires_at'), now))
+        for t in matched[offset:offset + limit]
+    ]
+    if fields is not None:
+        page = [{f: t[f] for f in fields} for t in page]
+
+    response = dict(threats)
+    response.update({
+        'threat_list': page,
+        'total_threats': len(threats['threat_list']),
+        'matched': len(matched),
+        'offset': offset,
+        'limit': limit,
+        'next_offset': offset + limit if offset + limit < len(matched) else None,
+    })
+    return response
+
+
+# ==================== GeoIP ====================
+
+# GeoIP情報が得られない場合の値
+UNKNOWN_GEO = {'country': 'Unknown', 'country_code': None, 'asn': None, 'isp': None}
+
+
+class GeoIPResolver:
+    """
+    ローカルのMaxMind形式データベース（.mmdb）でIPの国・ASN・ISPを解決する
+
+    データベースはメモリマップで開き、ネットワークには一切アクセスしない。
+    検索結果はIPをキーとするサイズ上限付きのLRUキャッシュに保持する。
+    データベースやmaxminddbがない場合はすべて 'Unknown' を返す。
+    """
+
+    def __init__(self, country_db=GEOIP_DB, asn_db=GEOIP_ASN_DB, cache_size=GEOIP_CACHE_SIZE):
+        """
+        Args:
+            country_db: 国情報のデータベース（GeoLite2-Country/City等）
+            asn_db: ASN/ISP情報のデータベース（GeoLite2-ASN/GeoIP2-ISP等）
+            cache_size: キャッシュするIPの最大数
+        """
+        self.cache_size = cache_size
+        self.country_db = country_db
+        self._country_reader = self._open(country_db)
+        self._asn_reader = self._open(asn_db)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _open(path):
+        """データベースをメモリマップで開く（開けない場合はNone）"""
+        if maxminddb is None or not path or not os.path.exists(path):
+            return None
+        try:
+            reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+            logger.info(f"GeoIPデータベースを読み込みました: {path}")
+            return reader
+        except Exception as e:
+            logger.error(f"GeoIPデータベースの読み込みエラー: {path}: {e}")
+            return None
+
+    @property
+    def available(self):
+        """いずれかのデータベースが利用可能か"""
+        return self._country_reader is not None or self._asn_reader is not None
+
+    def unavailable_reason(self):
+        """
+        国を解決できない理由
+
+        Returns:
+            str: 理由（国情報のデータベースが利用可能ならNone）
+        """
+        if maxminddb is None:
+            return 'maxminddb is not installed (pip install maxminddb)'
+        if self._country_reader is None:
+            return f'country database not found: {self.country_db}'
+        return None
+
+    def _resolve(self, ip):
+        """データベースを検索（キャッシュなし）"""
+        geo = dict(UNKNOWN_GEO)
+
+        try:
+            if self._country_reader is not None:
+                record = self._country_reader.get(ip) or {}
+                country = record.get('country') or record.get('registered_country') or {}
+                geo['country_code'] = country.get('iso_code')
+                geo['country'] = (country.get('names', {}).get('en')
+                                  or geo['country_code'] or 'Unknown')
+
+            if self._asn_reader is not None:
+                record = self._asn_reader.get(ip) or {}
+                geo['asn'] = record.get('autonomous_system_number')
+                geo['isp'] = record.get('isp') or record.get('autonomous_system_organization')
+        except ValueError as e:
+            logger.warning(f"GeoIP検索エラー: {ip}: {e}")
+
+        return geo
+
+    def lookup_many(self, ips):
+        """
+        複数のIPをまとめて解決
+
+        キャッシュの確認と更新はそれぞれ1回のロックで行い、
+        データベースの検索はロックの外で行う。
+
+        Args:
+            ips: IPアドレスのイテラブル
+
+        Returns:
+            dict: IP -> {'country', 'country_code', 'asn', 'isp'}
+        """
+        if not self.available:
+            return {ip: UNKNOWN_GEO for ip in ips}
+
+        result = {}
+        misses = []
+        with self._lock:
+            for ip in ips:
+                geo = self._cache.get(ip)
+                if geo is None:
+                    misses.append(ip)
+                else:
+                    self._cache.move_to_end(ip)
+                    result[ip] = geo
+            self.hits += len(result)
+            self.misses += len(misses)
+
+        resolved = {ip: self._resolve(ip) for ip in misses}
+
+        with self._lock:
+            for ip, geo in resolved.items():
+                self._cache[ip] = geo
+                self._cache.move_to_end(ip)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        result.update(resolved)
+        return result
+
+    def lookup(self, ip):
+        """1件のIPを解決"""
+        return self.lookup_many([ip])[ip]
+
+
+_geoip = GeoIPResolver()
+
+
+class CountryAggregator:
+    """
+    国別の攻撃元IP数と攻撃回数を増分で集計する
+
+    新しく現れたIPの国と、既知IPの攻撃回数の増分だけを加算する。
+    日付が変わる等で既知のIPが消えた場合のみ全体を作り直す。
+    """
+
+    def __init__(self):
+        self._ips = {}                   # IP -> (国, 攻撃回数)
+        self._attackers = Counter()      # 国 -> 攻撃元IP数
+        self._attacks = Counter()        # 国 -> 攻撃回数
+
+    def update(self, attack_ips, geo):
+        """
+        最新の攻撃IPリストを反映
+
+        Args:
+            attack_ips: auth.log解析結果の attack_ips
+            geo: IP -> GeoIP情報（GeoIPResolver.lookup_many() の結果）
+        """
+        current = {attack['ip_address'] for attack in attack_ips}
+        if not self._ips.keys() <= current:
+            self._ips.clear()
+            self._attackers.clear()
+            self._attacks.clear()
+
+        for attack in attack_ips:
+            ip = attack['ip_address']
+            total = attack['total_attempts']
+            known = self._ips.get(ip)
+
+            if known is None:
+                country = geo.get(ip, UNKNOWN_GEO)['country']
+                self._attackers[country] += 1
+                self._attacks[country] += total
+                self._ips[ip] = (country, total)
+            elif known[1] != total:
+                self._attacks[known[0]] += total - known[1]
+                self._ips[ip] = (known[0], total)
+
+    def top(self, limit=TOP_COUNTRIES_LIMIT):
+        """
+        攻撃元IP数の多い国を返す
+
+        Returns:
+            list: [{'country', 'count', 'attacks'}, ...]
+        """
+        return [
+            {'country': country, 'count': count, 'attacks': self._attacks[country]}
+            for country, count in self._attackers.most_common(limit)
+        ]
+
+
+# ==================== スナップショット収集 ====================
+
+# 収集済みデータのスナップショット（更新されず、新しいものに置き換えられる）
+Snapshot = namedtuple('Snapshot', [
+    'generation',    # 収集ごとに増える世代番号
+    'timestamp',     # 収集時刻
+    'system_stats',  # get_system_stats() の結果
+    'ufw_status',    # get_ufw_status() の結果
+    'auth_stats',    # parse_auth_log() の結果
+    'status',        # /api/status のレスポンス
+    'threats',       # /api/threats のレスポンス
+    'etags',         # レスポンスごとのETag（内容のハッシュ）
+    'collected_at',  # 収集時の time.monotonic()（鮮度の判定用）
+])
+
+
+def content_etag(*payloads):
+    """
+    レスポンス内容からETagを計算
+
+    収集時刻（timestamp）は毎回変わるため除外し、
+    内容が同じであれば同じETagになるようにする。
+
+    Args:
+        payloads: レスポンスの辞書
+
+    Returns:
+        str: ETag（引用符なし）
+    """
+    digest = hashlib.sha1()
+    for payload in payloads:
+        content = {k: v for k, v in payload.items() if k != 'timestamp'}
+        digest.update(json.dumps(content, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:20]
+
+
+# 収集ごとに変わるステータスの項目（ETagには SYSTEM_STATS_ETAG_INTERVAL ごとにだけ反映する）
+VOLATILE_STATUS_FIELDS = ('timestamp', 'cpu_usage', 'memory_usage', 'disk_usage', 'uptime')
+
+
+def status_etag_content(status, now):
+    """
+    ステータスのうちETagの計算に使う部分
+
+    変動する値の代わりに SYSTEM_STATS_ETAG_INTERVAL 単位の時刻を含めるため、
+    攻撃数などが変わらなくてもシステム統計はその間隔で更新される。
+
+    Args:
+        status: build_status_payload() の結果
+        now: 収集時刻
+
+    Returns:
+        dict: ETag計算用の辞書
+    """
+    content = {k: v for k, v in status.items() if k not in VOLATILE_STATUS_FIELDS}
+    content['system_stats_epoch'] = int(now.timestamp() // max(1, SYSTEM_STATS_ETAG_INTERVAL))
+    return content
+
+
+def build_status_payload(now, system_stats, ufw_status, auth_stats):
+    """
+    /api/status のレスポンスを構築
+
+    Args:
+        now: 収集時刻
+        system_stats: システム統計
+        ufw_status: UFW状態
+        auth_stats: auth.log解析結果
+
+    Returns:
+        dict: ステータスレスポンス
+    """
+    return {
+        'timestamp': now.isoformat(),
+        'system_status': 'online',
+        'cpu_usage': system_stats.get('cpu_usage', 0.0),
+        'memory_usage': system_stats.get('memory_usage', 0.0),
+        'disk_usage': system_stats.get('disk_usage', '0'),
+        'uptime': system_stats.get('uptime', 'unknown'),
+        'firewall_rules_count': ufw_status['rules_count'],
+        'blocked_ips_today': ufw_status['blocked_ips_today'],
+        'ssh_attacks_today': auth_stats['ssh_attacks_today'],
+        'vpn_attacks_today': auth_stats['vpn_attacks_today'],
+    }
+
+
+def build_threat_record(attack, blocked_set, geo=None, expires_at=None):
+    """
+    脅威リストの1件分のレコードを構築
+
+    Args:
+        attack: IPごとの攻撃回数と初回/最終攻撃時刻（auth.log解析結果の attack_ips の要素）
+        blocked_set: ブロック済みIPのセット（set または AddressSet）
+        geo: GeoIP情報（オプション）
+        expires_at: 期限付きブロックの解除予定（UNIX秒、無期限・未ブロックならNone）
+
+    Returns:
+        dict: 脅威レコード
+    """
+    ip = attack['ip_address']
+    total = attack['total_attempts']
+
+    # 個別の脅威レベルを計算
+    if total >= 100:
+        level = 'critical'
+    elif total >= 50:
+        level = 'high'
+    elif total >= 10:
+        level = 'medium'
+    else:
+        level = 'low'
+
+    geo = geo or UNKNOWN_GEO
+
+    return {
+        'ip_address': ip,
+        'country': geo['country'],
+        'country_code': geo['country_code'],
+        'asn': geo['asn'],
+        'isp': geo['isp'],
+        'attack_count': total,
+        'threat_level': level,
+        'first_attack_time': attack.get('first_seen'),
+        'last_attack_time': attack.get('last_seen'),
+        'blocked': ip in blocked_set,
+        # 残り時間（block_ttl）は収集ごとに変わりETagや差分を無駄に更新するため、
+        # 読み出し時に query_threats() で計算する
+        'block_expires_at': datetime.fromtimestamp(expires_at).isoformat() if expires_at else None
+    }
+
+
+def build_threats_payload(now, ufw_status, auth_stats, geo=None, top_countries=None, expiries=None):
+    """
+    /api/threats のレスポンスを構築
+
+    Args:
+        now: 収集時刻
+        ufw_status: UFW状態（どのIPがブロック済みか確認）
+        auth_stats: auth.log解析結果
+        geo: IP -> GeoIP情報（オプション）
+        top_countries: 国別統計（省略時は脅威リストから集計）
+        expiries: IP -> 期限付きブロックの解除予定（UNIX秒、オプション）
+
+    Returns:
+        dict: 脅威リストレスポンス
+    """
+    blocked_set = AddressSet(ufw_status['blocked_ips'])
+
+    # 脅威リストを構築
+    geo = geo or {}
+    expiries = expiries or {}
+    threat_list = [
+        build_threat_record(
+            attack, blocked_set, geo.get(attack['ip_address']),
+            expires_at=expiries.get(attack['ip_address']),
+        )
+        for attack in auth_stats['attack_ips']
+    ]
+
+    # 全体の脅威レベル
+    total_attacks = auth_stats['ssh_attacks_today'] + auth_stats['vpn_attacks_today']
+    overall_threat_level = calculate_threat_level(total_attacks)
+
+    # 国別統計
+    if top_countries is None:
+        aggregator = CountryAggregator()
+        aggregator.update(auth_stats['attack_ips'], geo)
+        top_countries = aggregator.top()
+
+    return {
+        'timestamp': now.isoformat(),
+        'threat_level': overall_threat_level,
+        'total_threats': len(threat_list),
+        'total_attacks': total_attacks,
+        'threat_list': threat_list,
+        'top_attack_countries': top_countries,
+        'attack_trend': auth_stats.get('attack_trend', [])  # 直近24時間（1時間ごと、古い順）
+    }
+
+
+class ThreatChangeLog:
+    """
+    脅威リストの変更履歴（差分同期用）
+
+    IPごとに最後に変更された世代番号を記録し、削除されたIPは
+    トゥームストーンとして保持する。クライアントは前回受け取った
+    カーソル以降に追加・変更・削除されたレコードだけを取得できる。
+    """
+
+    def __init__(self, tombstone_limit=THREAT_TOMBSTONE_LIMIT):
+        """
+        Args:
+            tombstone_limit: 保持する削除済みIPの最大数
+        """
+        self.tombstone_limit = tombstone_limit
+        self._lock = threading.Lock()
+        self.generation = 0
+        self._records = {}             # IP -> (世代, レコード)
+        self._removed = OrderedDict()  # IP -> 削除された世代
+        self._horizon = 0              # これ以前のカーソルは差分を返せない
+        self._summary = {}
+
+    def update(self, generation, threats):
+        """
+        新しい脅威リストを取り込み、変更があったレコードに世代を付ける
+
+        何も変わっていなければ世代は進めない（カーソルが変わらない）。
+
+        Args:
+            generation: スナップショットの世代番号
+            threats: build_threats_payload() の結果
+        """
+        current = {t['ip_address']: t for t in threats['threat_list']}
+        summary = {k: v for k, v in threats.items() if k != 'threat_list'}
+
+        with self._lock:
+            changed = False
+            for ip, record in current.items():
+                previous = self._records.get(ip)
+                if previous is None or previous[1] != record:
+                    self._records[ip] = (generation, record)
+                    self._removed.pop(ip, None)
+                    changed = True
+
+            for ip in [ip for ip in self._records if ip not in current]:
+                del self._records[ip]
+                self._removed[ip] = generation
+                changed = True
+
+            while len(self._removed) > self.tombstone_limit:
+                _, removed_generation = self._removed.popitem(last=False)
+                self._horizon = max(self._horizon, removed_generation)
+
+            comparable = {k: v for k, v in summary.items() if k != 'timestamp'}
+            previous_summary = {k: v for k, v in self._summary.items() if k != 'timestamp'}
+            if changed or comparable != previous_summary:
+                self.generation = generation
+            self._summary = summary
+
+    def cursor(self):
+        """現在のカーソル（起動ID:世代）"""
+        return f"{BOOT_ID}:{self.generation}"
+
+    def _parse_cursor(self, since):
+        """カーソルから世代番号を取り出す（差分を返せない場合はNone）"""
+        if not since:
+            return None
+        boot_id, _, generation = since.partition(':')
+        if boot_id != BOOT_ID or not generation.isdigit():
+            return None
+
+        generation = int(generation)
+        if generation < self._horizon or generation > self.generation:
+            return None
+        return generation
+
+    def delta(self, since=None):
+        """
+        カーソル以降の差分を取得
+
+        カーソルが無効（未指定、再起動前のもの、古すぎる）の場合は
+        全件を返し、full=True とする。
+
+        Args:
+            since: 前回受け取ったカーソル
+
+        Returns:
+            dict: サマリー項目, cursor, full, upserts, removed
+        """
+        with self._lock:
+            since_generation = self._parse_cursor(since)
+            full = since_generation is None
+
+            if full:
+                upserts = [record for _, record in self._records.values()]
+                removed = []
+            else:
+                upserts = [record for generation, record in self._records.values()
+                           if generation > since_generation]
+                removed = [ip for ip, generation in self._removed.items()
+                           if generation > since_generation]
+
+            response = dict(self._summary)
+            response.update({
+                'cursor': self.cursor(),
+                'full': full,
+                'upserts': sorted(upserts, key=lambda t: t['attack_count'], reverse=True),
+                'removed': removed,
+            })
+            return response
+
+
+class SnapshotCollector:
+    """
+    バックグラウンドでスナップショットを定期的に更新するコレクター
+
+    システム統計、UFW状態、auth.log解析はすべてこのスレッドで実行され、
+    APIエンドポイントは最新のスナップショットを読むだけになる。
+    そのためリクエストの応答時間はポーリングする側の数に依存しない。
+    """
+
+    def __init__(self, interval=COLLECT_INTERVAL, ttl=SNAPSHOT_TTL, stale_ttl=SNAPSHOT_STALE_TTL):
+        """
+        Args:
+            interval: 更新間隔（秒）
+            ttl: スナップショットを新鮮とみなす時間（秒）
+            stale_ttl: TTL切れ後に古い値を返しながら裏で再収集する猶予（秒）
+        """
+        self.interval = interval
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._snapshot = None
+        self._generation = 0
+        self.changes = ThreatChangeLog()
+        self.countries = CountryAggregator()
+        self._refresh_lock = threading.Lock()
+        self._revalidating = threading.Event()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """
+        新しいスナップショットを収集して差し替える
+
+        Returns:
+            Snapshot: 新しいスナップショット
+        """
+        with self._refresh_lock:
+            return self._collect()
+
+    def _collect(self):
+        """スナップショットを収集する（_refresh_lock を保持した状態で呼ぶ）"""
+        # エージェント外でのufw変更を取り込む（リクエスト処理ではufwを起動しない）
+        _firewall_state.reconcile_if_due()
+
+        now = datetime.now()
+        system_stats = get_system_stats()
+        ufw_status = get_ufw_status()
+        auth_stats = parse_auth_log()
+
+        status = build_status_payload(now, system_stats, ufw_status, auth_stats)
+        # GeoIPはリクエストごとではなく収集ごとにまとめて解決する
+        geo = _geoip.lookup_many(a['ip_address'] for a in auth_stats['attack_ips'])
+        self.countries.update(auth_stats['attack_ips'], geo)
+
+        threats = build_threats_payload(
+            now, ufw_status, auth_stats, geo=geo, top_countries=self.countries.top(),
+            expiries=_block_expiry.expiries(),
+        )
+
+        stable_status = status_etag_content(status, now)
+
+        self._generation += 1
+        snapshot = Snapshot(
+            generation=self._generation,
+            timestamp=now,
+            system_stats=system_stats,
+            ufw_status=ufw_status,
+            auth_stats=auth_stats,
+            status=status,
+            threats=threats,
+            etags={
+                'status': content_etag(stable_status),
+                'threats': content_etag(threats),
+                'snapshot': content_etag(stable_status, threats),
+            },
+            collected_at=time.monotonic(),
+        )
+
+        self.changes.update(snapshot.generation, threats)
+
+        # 参照の代入はアトミックなので読み取り側にロックは不要
+        self._snapshot = snapshot
+        return snapshot
+
+    def get(self):
+        """
+        最新のスナップショットを取得
+
+        TTL内ならそのまま返す。TTL切れでも猶予内なら古い値を返し、
+        再収集は裏で1回だけ行う。一度も収集していないか猶予も過ぎている
+        場合はその場で収集するが、同時に来た呼び出しは先行する収集の
+        結果を待って共有する（single-flight）。
+
+        Returns:
+            Snapshot: 最新のスナップショット
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self._refresh_once(None)
+
+        age = time.monotonic() - snapshot.collected_at
+        if age < self.ttl:
+            return snapshot
+        if age < self.ttl + self.stale_ttl:
+            self._revalidate()
+            return snapshot
+        return self._refresh_once(snapshot)
+
+    def _refresh_once(self, seen):
+        """
+        別の呼び出しがすでに収集し直していなければ収集する
+
+        Args:
+            seen: 呼び出し側が見ていたスナップショット（未収集ならNone）
+
+        Returns:
+            Snapshot: 最新のスナップショット
+        """
+        with self._refresh_lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot is not seen:
+                # ロック待ちの間に先行する呼び出しが収集済み
+                return snapshot
+            return self._collect()
+
+    def _revalidate(self):
+        """古いスナップショットを返した後、裏で1回だけ再収集する"""
+        if self._thread is not None and self._thread.is_alive():
+            self.trigger()
+            return
+
+        if self._revalidating.is_set():
+            return
+        self._revalidating.set()
+        seen = self._snapshot
+
+        def run():
+            try:
+                self._refresh_once(seen)
+            except Exception as e:
+                logger.error(f"スナップショット再収集エラー: {e}", exc_info=True)
+            finally:
+                self._revalidating.clear()
+
+        threading.Thread(target=run, name='snapshot-revalidate', daemon=True).start()
+
+    def trigger(self):
+        """次の更新を待たずに収集スレッドを起こす（ブロック操作後など）"""
+        self._wake.set()
+
+    def _run(self):
+        """収集スレッドのメインループ"""
+        while not self._stop.is_set():
+            try:
+                snapshot = self.refresh()
+                if _aggregator.run(snapshot):
+                    # ルールが変わったのですぐに収集し直す
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"スナップショット収集エラー: {e}", exc_info=True)
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        """収集スレッドを開始"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='snapshot-collector', daemon=True
+        )
+        self._thread.start()
+        logger.info(f"スナップショット収集を開始しました（{self.interval}秒間隔）")
+
+    def stop(self):
+        """収集スレッドを停止"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+_collector = SnapshotCollector()
+
+
+# ==================== イベントストリーム ====================
+
+Event = namedtuple('Event', ['id', 'type', 'data'])
+
+
+class EventSubscription:
+    """イベントストリームの購読者1件分のキュー"""
+
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+
+class EventBus:
+    """
+    攻撃・ブロック・解除イベントを購読者に配信する
+
+    直近のイベントを履歴として保持し、再接続したクライアントには
+    Last-Event-ID 以降のイベントを再送する。受信が追いつかない購読者は
+    切断され、クライアント側の再接続（と再取得）に任せる。
+    """
+
+    def __init__(self, history_size=EVENT_HISTORY_SIZE, max_queue=1000):
+        """
+        Args:
+            history_size: 再送用に保持するイベント数
+            max_queue: 購読者ごとの未送信イベントの上限
+        """
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+
+    def publish(self, event_type, data):
+        """
+        イベントを配信
+
+        Args:
+            event_type: イベント種別（attack, block, unblock）
+            data: イベントデータ
+        """
+        with self._lock:
+            event = Event(f"{BOOT_ID}-{self._next_id}", event_type, data)
+            self._next_id += 1
+            self._history.append(event)
+
+            for subscription in list(self._subscribers):
+                try:
+                    subscription.queue.put_nowait(event)
+                except queue.Full:
+                    logger.warning("イベントの受信が追いつかない購読者を切断します")
+                    subscription.closed = True
+                    self._subscribers.discard(subscription)
+
+    def subscribe(self, last_event_id=None):
+        """
+        購読を開始
+
+        Args:
+            last_event_id: クライアントが最後に受け取ったイベントID
+
+        Returns:
+            EventSubscription: 購読（再送分のイベントはキューに積まれている）
+        """
+        with self._lock:
+            missed = []
+            boot_id, _, number = (last_event_id or '').partition('-')
+            if boot_id == BOOT_ID and number.isdigit():
+                missed = [
+                    event for event in self._history
+                    if int(event.id.partition('-')[2]) > int(number)
+                ]
+
+            # 再送分は履歴の件数まで積めるよう、キューの上限に加える
+            subscription = EventSubscription(self.max_queue + len(missed))
+            for event in missed:
+                subscription.queue.put_nowait(event)
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """購読を終了"""
+        with self._lock:
+            self._subscribers.discard(subscription)
+        subscription.closed = True
+
+
+_events = EventBus()
+
+
+def publish_firewall_events(action, ip_addresses, reasons=None):
+    """
+    ブロック/解除イベントを配信
+
+    Args:
+        action: 'block' または 'unblock'
+        ip_addresses: 対象IPのリスト
+        reasons: IP -> ブロック理由（自動ブロックの場合）
+    """
+    reasons = reasons or {}
+    for ip in ip_addresses:
+        data = {'ip_address': ip}
+        if ip in reasons:
+            data['reason'] = reasons[ip]
+        _events.publish(action, data)
+
+
+# ==================== 自動ブロック ====================
+
+class AutoBlocker:
+    """
+    auth.logの攻撃イベントから、しきい値を超えたIPを自動でブロックする（fail2ban方式）
+
+    IPごとに直近 max_retry 件の攻撃時刻だけを保持し、その最古と最新の差が
+    window 秒以内になった時点でブロック対象にする。IPあたりのメモリは
+    max_retry 件分で済む。検出はauth.logの読み込み中に行い、ブロックは
+    監視スレッドが読み込みのたびにまとめて適用するため、Home Assistantの
+    ポーリングを待たずに反応できる。ブロックしたIPには理由を記録する。
+    """
+
+    def __init__(self, max_retry=AUTO_BLOCK_MAX_RETRY, window=AUTO_BLOCK_WINDOW,
+                 state_path=AUTO_BLOCK_STATE_FILE, duration=AUTO_BLOCK_DURATION):
+        """
+        Args:
+            max_retry: ブロックする攻撃回数（0で無効）
+            window: 判定に使う時間窓（秒）
+            state_path: ブロック理由の保存先
+            duration: ブロック期間（秒、0で無期限）
+        """
+        self.max_retry = max_retry
+        self.window = window
+        self.duration = duration
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._recent = {}    # IP -> deque((時刻, 種別), maxlen=max_retry)
+        self._pending = {}   # IP -> 理由（ブロック待ち）
+        self._pruned_at = 0
+        self.reasons = {}    # IP -> 理由（ブロック済み）
+        self._load_state()
+
+    @property
+    def enabled(self):
+        """自動ブロックが有効か"""
+        return self.max_retry > 0
+
+    def _load_state(self):
+        """保存済みのブロック理由を読み込む"""
+        if not self.enabled or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                self.reasons = json.load(f).get('reasons', {})
+        except Exception as e:
+            logger.error(f"自動ブロック状態の読み込みエラー: {e}")
+
+    def _save_state(self):
+        """ブロック理由をアトミックに保存する"""
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'reasons': self.reasons}, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.error(f"自動ブロック状態の保存エラー: {e}")
+
+    def observe(self, event, now=None):
+        """
+        攻撃イベントを1件記録する（AuthLogTailer のリスナー）
+
+        Args:
+            event: AuthEvent
+            now: 現在時刻（UNIX秒、テスト用）
+        """
+        if not self.enabled:
+            return
+
+        timestamp = event.time.timestamp()
+        now = time.time() if now is None else now
+        if now - timestamp > self.window:
+            # 時間窓より古いイベント（起動時の再集計など）では反応しない
+            return
+
+        with self._lock:
+            if event.ip in self._pending:
+                return
+            recent = self._recent.get(event.ip)
+            if recent is None:
+                recent = self._recent[event.ip] = deque(maxlen=self.max_retry)
+            recent.append((timestamp, event.kind))
+            if len(recent) < self.max_retry:
+                return
+
+            # ローテーション済みファイルの読み込み順に依存しないよう最小/最大で判定する
+            first = min(t for t, _ in recent)
+            last = max(t for t, _ in recent)
+            if last - first > self.window:
+                return
+
+            kinds = Counter(kind for _, kind in recent)
+            self._pending[event.ip] = {
+                'rule': f"{self.max_retry} failures within {self.window}s",
+                'attempts': len(recent),
+                'ssh_attempts': kinds['ssh'],
+                'vpn_attempts': kinds['vpn'],
+                'first_attempt': datetime.fromtimestamp(first).isoformat(),
+                'last_attempt': datetime.fromtimestamp(last).isoformat(),
+            }
+            del self._recent[event.ip]
+
+    def _prune(self, now):
+        """時間窓を過ぎたIPのカウンターを捨てる（_lock を保持した状態で呼ぶ）"""
+        if now - self._pruned_at < self.window:
+            return
+        self._pruned_at = now
+        expired = [ip for ip, recent in self._recent.items() if now - recent[-1][0] > self.window]
+        for ip in expired:
+            del self._recent[ip]
+
+    def flush(self):
+        """
+        検出したIPをまとめて1回のトランザクションでブロックする
+
+        ホワイトリストのIPとブロック済みのIPは apply_batch() で除外される。
+
+        Returns:
+            list: ブロックしたIP
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._prune(time.time())
+        if not pending:
+            return []
+
+        results, _ = apply_batch('block', list(pending))
+        blocked = {}
+        for result in results:
+            ip = result['ip_address']
+            if result['status'] == 'blocked':
+                blocked[ip] = dict(pending[ip], blocked_at=datetime.now().isoformat())
+                logger.warning(
+                    f"自動ブロック: {ip}（{self.window}秒以内に{pending[ip]['attempts']}回の攻撃）"
+                )
+            elif result['status'] == 'whitelisted':
+                logger.info(f"ホワイトリストのため自動ブロックしません: {ip}")
+            elif not result['success']:
+                logger.error(f"自動ブロック失敗: {ip}: {result.get('error')}")
+
+        if blocked:
+            if self.duration:
+                expires_at = _block_expiry.schedule(list(blocked), self.duration)
+                for reason in blocked.values():
+                    reason['expires_at'] = datetime.fromtimestamp(expires_at).isoformat()
+            with self._lock:
+                self.reasons.update(blocked)
+                self._save_state()
+            publish_firewall_events('block', list(blocked), reasons=blocked)
+            _collector.trigger()
+        return list(blocked)
+
+    def reason(self, ip_address):
+        """
+        Returns:
+            dict: IPを自動ブロックした理由（自動ブロックでない場合はNone）
+        """
+        return self.reasons.get(ip_address)
+
+    def forget(self, ip_addresses):
+        """ブロック解除されたIPの理由を削除"""
+        with self._lock:
+            removed = [ip for ip in ip_addresses if self.reasons.pop(ip, None) is not None]
+            if removed:
+                self._save_state()
+
+
+_auto_blocker = AutoBlocker()
+_auth_tailer.listeners.append(_auto_blocker.observe)
+
+
+# ==================== 期限付きブロック ====================
+
+class BlockExpiryScheduler:
+    """
+    期限付きブロックを期限が来たら解除するスケジューラー
+
+    解除予定は最小ヒープで管理し、1本のスレッドが直近の期限まで待機する。
+    期限が batch_window 秒以内に重なるブロックは1回のトランザクションで
+    まとめて解除する。予定は状態ファイルに保存するため再起動後も引き継がれ、
+    停止中に期限を過ぎたブロックは起動直後に解除される。
+    """
+
+    # 解除に失敗した場合の再試行間隔（秒）。失敗が続くたびに倍にし、上限で頭打ちにする
+    RETRY_INTERVAL = 60
+    RETRY_MAX_INTERVAL = 3600
+
+    def __init__(self, state_path=BLOCK_EXPIRY_STATE_FILE, batch_window=BLOCK_EXPIRY_BATCH_WINDOW):
+        """
+        Args:
+            state_path: 解除予定の保存先
+            batch_window: まとめて解除する期限の幅（秒）
+        """
+        self.state_path = state_path
+        self.batch_window = batch_window
+        self._cond = threading.Condition()
+        self._expires = {}  # IP -> 解除予定（UNIX秒）
+        self._heap = []     # (解除予定, IP)。_expires と一致しない要素は取り出し時に捨てる
+        self._failures = {}  # IP -> 連続して解除に失敗した回数
+        self._stop = False
+        self._thread = None
+        self._load_state()
+
+    def _load_state(self):
+        """保存済みの解除予定を読み込む"""
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                self._expires = {ip: float(t) for ip, t in json.load(f).get('expires', {}).items()}
+            self._heap = [(t, ip) for ip, t in self._expires.items()]
+            heapq.heapify(self._heap)
+            logger.info(f"期限付きブロックを復元しました: {len(self._expires)} 件")
+        except Exception as e:
+            logger.error(f"期限付きブロックの読み込みエラー: {e}")
+
+    def _save_state(self):
+        """解除予定をアトミックに保存する（_cond を保持した状態で呼ぶ）"""
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'expires': self._expires}, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.error(f"期限付きブロックの保存エラー: {e}")
+
+    def schedule(self, ip_addresses, duration, now=None):
+        """
+        ブロックの解除を予約する（既に予約があれば置き換える）
+
+        Args:
+            ip_addresses: 対象IPのリスト
+            duration: ブロック期間（秒）
+            now: 現在時刻（UNIX秒、テスト用）
+
+        Returns:
+            float: 解除予定（UNIX秒）
+        """
+        expires_at = (time.time() if now is None else now) + duration
+        with self._cond:
+            for ip in ip_addresses:
+                self._expires[ip] = expires_at
+                self._failures.pop(ip, None)
+                heapq.heappush(self._heap, (expires_at, ip))
+            if len(self._heap) > 2 * len(self._expires) + 64:
+                # 置き換え・取り消し済みの要素が溜まったら作り直す
+                self._heap = [(t, ip) for ip, t in self._expires.items()]
+                heapq.heapify(self._heap)
+            self._save_state()
+            self._cond.notify()
+        return expires_at
+
+    def cancel(self, ip_addresses):
+        """解除予定を取り消す（無期限のブロックに変更した・手動で解除した場合）"""
+        with self._cond:
+            removed = [ip for ip in ip_addresses if self._expires.pop(ip, None) is not None]
+            for ip in removed:
+                self._failures.pop(ip, None)
+            if removed:
+                self._save_state()
+
+    def expires_at(self, ip_address):
+        """
+        Returns:
+            float: 解除予定（UNIX秒、期限付きでない場合はNone）
+        """
+        return self._expires.get(ip_address)
+
+    def expiries(self):
+        """
+        Returns:
+            dict: IP -> 解除予定（UNIX秒）
+        """
+        with self._cond:
+            return dict(self._expires)
+
+    def remaining(self, ip_address, now=None):
+        """
+        Returns:
+            int: 解除までの残り秒数（期限付きでない場合はNone）
+        """
+        expires_at = self._expires.get(ip_address)
+        if expires_at is None:
+            return None
+        return max(0, int(expires_at - (time.time() if now is None else now)))
+
+    def _retry_later(self, ip, now, error):
+        """
+        解除に失敗したIPを再試行の予定に戻す（_cond を保持した状態で呼ぶ）
+
+        Args:
+            ip: 対象IP
+            now: 現在時刻（UNIX秒）
+            error: 失敗の理由
+        """
+        failures = self._failures.get(ip, 0) + 1
+        self._failures[ip] = failures
+        delay = min(self.RETRY_INTERVAL * 2 ** (failures - 1), self.RETRY_MAX_INTERVAL)
+        self._expires[ip] = now + delay
+        heapq.heappush(self._heap, (now + delay, ip))
+        logger.error(f"期限付きブロックの解除失敗、{delay}秒後に再試行します: {ip}: {error}")
+
+    def expire(self, now=None):
+        """
+        期限の来たブロックを1回のトランザクションで解除する
+
+        Args:
+            now: 現在時刻（UNIX秒、テスト用）
+
+        Returns:
+            list: 解除したIP
+        """
+        now = time.time() if now is None else now
+        due = {}
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now + self.batch_window:
+                expires_at, ip = heapq.heappop(self._heap)
+                if self._expires.get(ip) == expires_at:
+                    due[ip] = expires_at
+        if not due:
+            return []
+
+        try:
+            results, _ = apply_batch('unblock', list(due))
+        except Exception as e:
+            # 取り出した予定を戻さないと、ブロックが解除されないまま残る
+            with self._cond:
+                for ip, expires_at in due.items():
+                    if self._expires.get(ip) == expires_at:
+                        self._retry_later(ip, now, e)
+                self._save_state()
+            return []
+
+        unblocked = []
+        with self._cond:
+            for result in results:
+                ip = result['ip_address']
+                if self._expires.get(ip) != due[ip]:
+                    # 解除中に予定が変更された
+                    continue
+                if result['success']:
+                    del self._expires[ip]
+                    self._failures.pop(ip, None)
+                    if result['status'] == 'unblocked':
+                        unblocked.append(ip)
+                else:
+                    self._retry_later(ip, now, result.get('error'))
+            self._save_state()
+
+        if unblocked:
+            logger.info(f"期限切れのブロックを解除しました: {', '.join(unblocked)}")
+            _auto_blocker.forget(unblocked)
+            publish_firewall_events('unblock', unblocked)
+            _collector.trigger()
+        return unblocked
+
+    def _run(self):
+        """スケジューラースレッドのメインループ"""
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                timeout = self._heap[0][0] - time.time() if self._heap else None
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"期限付きブロックの解除エラー: {e}", exc_info=True)
+                time.sleep(1)
+
+    def start(self):
+        """スケジューラースレッドを開始"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._cond:
+            self._stop = False
+        self._thread = threading.Thread(target=self._run, name='block-expiry', daemon=True)
+        self._thread.start()
+        logger.info(f"期限付きブロックの管理を開始しました（{len(self._expires)} 件）")
+
+    def stop(self):
+        """スケジューラースレッドを停止"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+_block_expiry = BlockExpiryScheduler()
+
+
+class AuthLogWatcher:
+    """
+    auth.logを短い間隔で確認し、新しい攻撃をイベントとして配信する
+
+    スナップショットの収集間隔を待たずに攻撃を通知するためのもの。
+    攻撃を検出した場合はスナップショットの収集も前倒しする。
+    """
+
+    def __init__(self, tailer, bus, interval=AUTH_LOG_POLL_INTERVAL, blocker=None):
+        """
+        Args:
+            tailer: AuthLogTailer
+            bus: EventBus
+            interval: 確認間隔（秒）
+            blocker: 読み込みのたびに検出分をブロックする AutoBlocker（オプション）
+        """
+        self.tailer = tailer
+        self.bus = bus
+        self.interval = interval
+        self.blocker = blocker
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """
+        auth.logの追記分を読み込み、攻撃回数が増えたIPごとにイベントを配信
+
+        Returns:
+            int: 配信したイベント数
+        """
+        if not self.tailer.poll():
+            return 0
+
+        # 攻撃イベントより先にブロックし、配信する脅威情報に反映させる
+        if self.blocker is not None:
+            self.blocker.flush()
+
+        changes = self.tailer.take_changes()
+        if not changes:
+            return 0
+
+        ssh_total, vpn_total = self.tailer.totals()
+        ips = [c['ip_address'] for c in changes]
+        blocked_set = {ip for ip in ips if _firewall_state.is_covered(ip)}
+        geo = _geoip.lookup_many(ips)
+
+        for attack in changes:
+            self.bus.publish('attack', {
+                'ip_address': attack['ip_address'],
+                'ssh_attempts': attack['ssh_attempts'],
+                'vpn_attempts': attack['vpn_attempts'],
+                'threat': build_threat_record(
+                    attack, blocked_set, geo[attack['ip_address']],
+                    expires_at=_block_expiry.expires_at(attack['ip_address']),
+                ),
+                'ssh_attacks_today': ssh_total,
+                'vpn_attacks_today': vpn_total,
+            })
+
+        _collector.trigger()
+        return len(changes)
+
+    def _run(self):
+        """監視スレッドのメインループ"""
+        # 起動時の集計（ローテーション済みファイル分）は新しい攻撃ではない
+        try:
+            self.tailer.poll()
+            self.tailer.take_changes()
+            if self.blocker is not None:
+                self.blocker.flush()
+        except Exception as e:
+            logger.error(f"auth.log監視の初期化エラー: {e}", exc_info=True)
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"auth.log監視エラー: {e}", exc_info=True)
+
+    def start(self):
+        """監視スレッドを開始"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='auth-log-watcher', daemon=True
+        )
+        self._thread.start()
+        logger.info(f"auth.log監視を開始しました（{self.interval}秒間隔）")
+
+    def stop(self):
+        """監視スレッドを停止"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+_auth_watcher = AuthLogWatcher(_auth_tailer, _events, blocker=_auto_blocker)
+
+
+# ==================== 緊急ロックダウン ====================
+
+class EmergencyLockdown:
     """
-    UFW防火墙状態を取得
+    緊急ロックダウン（ホワイトリスト以外からの新規接続をすべて拒否）
 
-    Returns:
-        dict: 防火墙規則情報
+    ルールセットはホワイトリストからメモリ上で組み立て、バックエンドの
+    1回のトランザクションで適用する。解除も1回で済み、どちらも既存の
+    ブロックルールの数に関係なく一定の時間で終わる。状態は
+    EMERGENCY_MODE_FILE に保存し、エージェントを再起動しても解除できる。
+
+    状態はルールを切り替える前に保存する。保存できなければルールには
+    触れないため、ロックダウンされたまま解除の手段を失うことはない。
     """
-    try:
-        stdout, _, returncode = run_command(['sudo', 'ufw', 'status', 'numbered'])
 
-        if returncode != 0:
-            logger.error("UFW status取得失敗")
-            return {
-                'firewall_active': False,
-                'rules_count': 0,
-                'blocked_ips': []
+    def __init__(self, state_path=EMERGENCY_MODE_FILE):
+        """
+        Args:
+            state_path: ロックダウン状態の保存先
+        """
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._state = None
+        self._load_state()
+
+    @property
+    def active(self):
+        """ロックダウン中か"""
+        return self._state is not None
+
+    def _load_state(self):
+        """保存済みのロックダウン状態を読み込む"""
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                self._state = json.load(f)
+            if self._state.get('activating'):
+                # 切り替えの途中で停止した。適用済みかわからないため、解除できるようロックダウン中として扱う
+                logger.warning("緊急ロックダウンの適用中に停止したため、ロックダウン中として扱います")
+            logger.warning(f"緊急ロックダウン中です（{self._state.get('activated_at')} から）")
+        except Exception as e:
+            logger.error(f"ロックダウン状態の読み込みエラー: {e}")
+
+    def _save_state(self, state):
+        """
+        ロックダウン状態をアトミックに保存する（所有者のみ読み書き可）
+
+        Args:
+            state: 保存する状態（Noneならファイルを削除する）
+        """
+        if state is None:
+            try:
+                os.remove(self.state_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        os.makedirs(os.path.dirname(self.state_path), mode=0o700, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        # 既存の一時ファイルが残っていた場合も権限を絞る
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def status(self):
+        """
+        Returns:
+            dict: active, activated_at, reason, allowed
+        """
+        state = self._state or {}
+        return {
+            'active': self.active,
+            'activated_at': state.get('activated_at'),
+            'reason': state.get('reason'),
+            'allowed': state.get('allowed', []),
+        }
+
+    def activate(self, reason, keep=()):
+        """
+        ロックダウンを開始する（ロックダウン中なら許可リストを更新する）
+
+        Args:
+            reason: 理由
+            keep: ホワイトリストに加えて許可するアドレス（リクエスト元など）
+
+        Returns:
+            tuple: (成功したか, エラーメッセージ, 所要時間（ミリ秒）)
+
+        Raises:
+            ValueError: 許可するアドレスが1つもない場合
+            OSError: 状態を保存できない場合（ルールは変更されない）
+        """
+        with self._lock:
+            keep = [ip for ip in keep if ip and not _whitelist.contains(ip)]
+            allowed = list(dict.fromkeys(_whitelist.entries() + keep))
+            if not allowed:
+                raise ValueError('Whitelist is empty; lockdown would lock out every client')
+
+            previous = self._state
+            start = time.monotonic()
+            snapshot = previous['snapshot'] if previous else _firewall.snapshot()
+            state = {
+                'activated_at': previous['activated_at'] if previous else datetime.now().isoformat(),
+                'reason': reason,
+                'allowed': allowed,
+                'keep': keep,
+                'snapshot': snapshot,
             }
 
-        rules = []
-        blocked_ips = []
+            # 解除に必要な情報を先に保存してからルールを切り替える
+            self._save_state({**state, 'activating': True})
+            ok, error = _firewall.lockdown(allowed, replace=previous is not None)
+            elapsed_ms = (time.monotonic() - start) * 1000
+            if not ok:
+                logger.error(f"緊急ロックダウンの適用に失敗しました: {error}")
+                try:
+                    self._save_state(previous)
+                except OSError as e:
+                    logger.error(f"ロックダウン状態の保存エラー: {e}")
+                return False, error, elapsed_ms
+
+            self._state = state
+            try:
+                self._save_state(state)
+            except OSError as e:
+                # 適用中として保存済みの状態でも解除できる
+                logger.error(f"ロックダウン状態の保存エラー: {e}")
+
+        logger.warning(
+            f"🚨 緊急ロックダウン: {len(allowed)} 件のアドレスのみ許可（{elapsed_ms:.0f}ms）理由: {reason}"
+        )
+        return True, '', elapsed_ms
 
-        for line in stdout.split('\n'):
-            # [ 1] Deny from 192.168.1.1
-            match = re.search(r'Deny from ([\d\.]+)', line)
-            if match:
-                ip = match.group(1)
-                blocked_ips.append(ip)
-                rules.append(line.strip())
+    def refresh(self):
+        """ホワイトリストの変更をロックダウン中のルールに反映する"""
+        state = self._state
+        if state is None:
+            return True, '', 0
+        return self.activate(state['reason'], keep=state.get('keep', []))
 
-        return {
-            'firewall_active': 'Status: active' in stdout,
-            'rules_count': len(rules),
-            'blocked_ips': blocked_ips,
-            'blocked_ips_today': len(blocked_ips)  # 簡略化：今日封禁された数として扱う
-        }
+    def release(self):
+        """
+        ロックダウンを解除する
 
-    except Exception as e:
-        logger.error(f"UFW状態取得エラー: {e}")
-        return {
-            'firewall_active': False,
-            'rules_count': 0,
-            'blocked_ips': [],
-            'blocked_ips_today': 0
-        }
+        Returns:
+            tuple: (成功したか, エラーメッセージ, 所要時間（ミリ秒）)
+        """
+        with self._lock:
+            if self._state is None:
+                return True, '', 0
 
+            start = time.monotonic()
+            ok, error = _firewall.release(self._state.get('snapshot'))
+            elapsed_ms = (time.monotonic() - start) * 1000
+            if not ok:
+                logger.error(f"緊急ロックダウンの解除に失敗しました: {error}")
+                return False, error, elapsed_ms
 
-def calculate_threat_level(attack_count):
-    """
-    攻撃回数から脅威レベルを計算
+            self._state = None
+            self._save_state(None)
 
-    Args:
-        attack_count: 総攻撃回数
+        logger.warning(f"緊急ロックダウンを解除しました（{elapsed_ms:.0f}ms）")
+        return True, '', elapsed_ms
 
-    Returns:
-        str: 'low', 'medium', 'high', 'critical'
-    """
-    if attack_count < 10:
-        return 'low'
-    elif attack_count < 50:
-        return 'medium'
-    elif attack_count < 200:
-        return 'high'
-    else:
-        return 'critical'
+
+_lockdown = EmergencyLockdown()
 
 
 # ==================== API認証 ====================
@@ -353,15 +4410,164 @@ def require_token(f):
     return decorated_function
 
 
+# ==================== レスポンス形式と圧縮 ====================
+
+def _build_compressors():
+    """
+    利用可能な圧縮方式を優先順に返す
+
+    Returns:
+        OrderedDict: Content-Encoding名 -> 圧縮関数
+    """
+    compressors = OrderedDict()
+    if zstandard is not None:
+        # ZstdCompressor はスレッドセーフではないため呼び出しごとに作成する
+        compressors['zstd'] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+    if brotli is not None:
+        compressors['br'] = lambda data: brotli.compress(data, quality=5)
+    compressors['gzip'] = lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    compressors['deflate'] = lambda data: zlib.compress(data, 6)
+    return compressors
+
+
+COMPRESSORS = _build_compressors()
+
+
+def choose_encoding(accept_encodings):
+    """
+    Accept-Encoding から使用する圧縮方式を選ぶ
+
+    品質値が同じ場合はサーバー側の優先順（zstd, br, gzip, deflate）に従う。
+
+    Args:
+        accept_encodings: request.accept_encodings
+
+    Returns:
+        str: Content-Encoding名（圧縮しない場合はNone）
+    """
+    return accept_encodings.best_match(list(COMPRESSORS))
+
+
+def _build_serializers():
+    """
+    利用可能なレスポンス形式を優先順に返す（先頭のJSONが既定）
+
+    Returns:
+        OrderedDict: MIMEタイプ -> シリアライズ関数
+    """
+    serializers = OrderedDict()
+    serializers['application/json'] = None  # jsonify を使う
+    if msgpack is not None:
+        serializers['application/msgpack'] = lambda payload: msgpack.packb(payload, use_bin_type=True)
+    if cbor2 is not None:
+        serializers['application/cbor'] = cbor2.dumps
+    return serializers
+
+
+SERIALIZERS = _build_serializers()
+
+
+def negotiate_mimetype():
+    """
+    Accept ヘッダーからレスポンス形式を選ぶ
+
+    Accept がない場合や */* の場合はJSON（curl等でのデバッグ用）。
+
+    Returns:
+        str: MIMEタイプ
+    """
+    return request.accept_mimetypes.best_match(list(SERIALIZERS), default='application/json')
+
+
+def negotiated_response(payload, mimetype=None):
+    """
+    Accept ヘッダーに応じた形式でレスポンスを作成
+
+    Args:
+        payload: レスポンスの辞書
+        mimetype: 形式（省略時は negotiate_mimetype() で選択）
+
+    Returns:
+        Response: JSON、msgpack または CBOR のレスポンス
+    """
+    mimetype = mimetype or negotiate_mimetype()
+    serializer = SERIALIZERS[mimetype]
+    if serializer is None:
+        return jsonify(payload)
+
+    response = app.response_class(serializer(payload), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    JSON等のレスポンスを Accept-Encoding に応じて圧縮する
+
+    イベントストリーム等のストリーミングレスポンスと、
+    COMPRESS_MIN_SIZE 未満の小さなレスポンスは圧縮しない。
+    """
+    if (response.mimetype not in SERIALIZERS or response.is_streamed
+            or response.status_code != 200 or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(COMPRESSORS[encoding](response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+
+    # 圧縮後の表現はバイト列が異なるため、強いETagは弱いETagにする
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
 # ==================== APIエンドポイント ====================
 
+def conditional_json(payload, etag):
+    """
+    ETag付きでレスポンスを返す（形式は Accept に応じて選択）
+
+    クライアントの If-None-Match が一致する場合は、
+    シリアライズせずに 304 Not Modified を返す。
+    圧縮レスポンスには弱いETagが付くため、比較は弱い比較で行う。
+
+    Args:
+        payload: レスポンスの辞書
+        etag: このレスポンスのETag（引用符なし）
+
+    Returns:
+        Response: 200 または 304
+    """
+    mimetype = negotiate_mimetype()
+    if mimetype != 'application/json':
+        # 形式ごとに異なるバイト列になるため、ETagも区別する
+        etag = f"{etag}-{mimetype.rsplit('/', 1)[1]}"
+
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.vary.add('Accept')
+    else:
+        response = negotiated_response(payload, mimetype)
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """ヘルスチェック（認証不要）"""
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'version': '0.2.0'
+        'version': '0.2.0',
+        'capabilities': API_CAPABILITIES
     })
 
 
@@ -372,38 +4578,12 @@ def get_status():
     try:
         logger.info("システムステータス要求")
 
-        # システム統計を取得
-        system_stats = get_system_stats()
-
-        # UFW状態を取得
-        ufw_status = get_ufw_status()
-
-        # auth.log解析（キャッシュ使用）
-        global _cache
-        now = datetime.now()
-        if (_cache['last_update'] is None or
-            (now - _cache['last_update']).total_seconds() > CACHE_DURATION):
-            _cache['stats'] = parse_auth_log()
-            _cache['last_update'] = now
-
-        auth_stats = _cache['stats']
-
-        # レスポンスを構築
-        status = {
-            'timestamp': now.isoformat(),
-            'system_status': 'online',
-            'cpu_usage': system_stats.get('cpu_usage', 0.0),
-            'memory_usage': system_stats.get('memory_usage', 0.0),
-            'disk_usage': system_stats.get('disk_usage', '0'),
-            'uptime': system_stats.get('uptime', 'unknown'),
-            'firewall_rules_count': ufw_status['rules_count'],
-            'blocked_ips_today': ufw_status['blocked_ips_today'],
-            'ssh_attacks_today': auth_stats['ssh_attacks_today'],
-            'vpn_attacks_today': auth_stats['vpn_attacks_today'],
-        }
+        # 収集済みのスナップショットを返す
+        snapshot = _collector.get()
+        status = snapshot.status
 
         logger.info(f"ステータス返信: {status['ssh_attacks_today']} SSH攻撃, {status['vpn_attacks_today']} VPN攻撃")
-        return jsonify(status)
+        return conditional_json(status, snapshot.etags['status'])
 
     except Exception as e:
         logger.error(f"ステータス取得エラー: {e}", exc_info=True)
@@ -413,76 +4593,147 @@ def get_status():
 @app.route('/api/threats', methods=['GET'])
 @require_token
 def get_threats():
-    """脅威IPリストを取得"""
+    """
+    脅威IPリストを取得
+
+    limit/offset でページング、min_level/blocked/since で絞り込み、
+    fields で返すフィールドを選択できる（query_threats() を参照）。
+    """
     try:
         logger.info("脅威リスト要求")
 
-        # auth.log解析（キャッシュ使用）
-        global _cache
-        now = datetime.now()
-        if (_cache['last_update'] is None or
-            (now - _cache['last_update']).total_seconds() > CACHE_DURATION):
-            _cache['stats'] = parse_auth_log()
-            _cache['last_update'] = now
+        # 収集済みのスナップショットから必要な部分だけを返す
+        snapshot = _collector.get()
+        try:
+            threats = query_threats(snapshot.threats, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        auth_stats = _cache['stats']
+        logger.info(
+            f"脅威リスト返信: {len(threats['threat_list'])}/{threats['matched']} IP, "
+            f"レベル={threats['threat_level']}"
+        )
+        query = hashlib.sha1(request.query_string).hexdigest()[:8]
+        return conditional_json(threats, f"{snapshot.etags['threats']}-{query}")
 
-        # UFW状態を取得（どのIPがブロック済みか確認）
-        ufw_status = get_ufw_status()
-        blocked_set = set(ufw_status['blocked_ips'])
+    except Exception as e:
+        logger.error(f"脅威リスト取得エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        # 脅威リストを構築
-        threat_list = []
-        for attack in auth_stats['attack_ips']:
-            ip = attack['ip_address']
-            total = attack['total_attempts']
 
-            # 個別の脅威レベルを計算
-            if total >= 100:
-                level = 'critical'
-            elif total >= 50:
-                level = 'high'
-            elif total >= 10:
-                level = 'medium'
-            else:
-                level = 'low'
+@app.route('/api/threats/delta', methods=['GET'])
+@require_token
+def get_threats_delta():
+    """前回のカーソル以降に変更された脅威レコードだけを取得"""
+    try:
+        since = request.args.get('since')
+        logger.info(f"脅威差分要求: since={since}")
 
-            threat_list.append({
-                'ip_address': ip,
-                'country': 'Unknown',  # TODO: GeoIP lookup
-                'attack_count': total,
-                'threat_level': level,
-                'last_attack_time': datetime.now().isoformat(),
-                'blocked': ip in blocked_set
-            })
+        # 初回はスナップショットの収集を待ってから差分を返す
+        _collector.get()
+        delta = _collector.changes.delta(since)
 
-        # 全体の脅威レベル
-        total_attacks = auth_stats['ssh_attacks_today'] + auth_stats['vpn_attacks_today']
-        overall_threat_level = calculate_threat_level(total_attacks)
+        return conditional_json(delta, f"{delta['cursor']}-{since}")
 
-        # 国別統計（簡略化）
-        top_countries = [
-            {'country': 'Unknown', 'count': len(threat_list)}
-        ]
+    except Exception as e:
+        logger.error(f"脅威差分取得エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        response = {
-            'timestamp': now.isoformat(),
-            'threat_level': overall_threat_level,
-            'total_threats': len(threat_list),
-            'total_attacks': total_attacks,
-            'threat_list': threat_list,
-            'top_attack_countries': top_countries,
-            'attack_trend': []  # TODO: 24時間トレンドデータ
-        }
 
-        logger.info(f"脅威リスト返信: {len(threat_list)} IP, レベル={overall_threat_level}")
-        return jsonify(response)
+@app.route('/api/trend', methods=['GET'])
+@require_token
+def get_trend():
+    """
+    SSH/VPN別の攻撃トレンドを取得
+
+    resolution=hour（既定、直近24時間）または minute（直近1時間）。
+    """
+    try:
+        resolution = request.args.get('resolution', 'hour')
+        if resolution not in ('minute', 'hour'):
+            return jsonify({'error': 'resolution must be minute or hour'}), 400
+
+        return jsonify({
+            'timestamp': datetime.now().isoformat(),
+            'resolution': resolution,
+            'buckets': _auth_tailer.trend_series(resolution)
+        })
 
     except Exception as e:
-        logger.error(f"脅威リスト取得エラー: {e}", exc_info=True)
+        logger.error(f"トレンド取得エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/snapshot', methods=['GET'])
+@require_token
+def get_snapshot():
+    """
+    ステータスと脅威リストを同一のスナップショットから一度に取得
+
+    since パラメータを指定した場合は、脅威リストの代わりに
+    そのカーソル以降の差分（threats_delta）を返す。
+    """
+    try:
+        logger.info("スナップショット要求")
+
+        snapshot = _collector.get()
+
+        if 'since' in request.args:
+            since = request.args.get('since')
+            delta = _collector.changes.delta(since)
+            return conditional_json({
+                'generation': snapshot.generation,
+                'timestamp': snapshot.timestamp.isoformat(),
+                'status': snapshot.status,
+                'threats_delta': delta
+            }, f"{snapshot.etags['status']}-{delta['cursor']}-{since}")
+
+        return conditional_json({
+            'generation': snapshot.generation,
+            'timestamp': snapshot.timestamp.isoformat(),
+            'status': snapshot.status,
+            'threats': snapshot.threats
+        }, snapshot.etags['snapshot'])
+
+    except Exception as e:
+        logger.error(f"スナップショット取得エラー: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/events', methods=['GET'])
+@require_token
+def stream_events():
+    """
+    攻撃・ブロック・解除イベントをServer-Sent Eventsで配信
+
+    Last-Event-ID ヘッダーを指定すると、それ以降のイベントを再送してから
+    新しいイベントを配信する。
+    """
+    subscription = _events.subscribe(request.headers.get('Last-Event-ID'))
+    logger.info(f"イベントストリーム接続: {request.remote_addr}")
+
+    def generate():
+        try:
+            # ヘッダーをすぐに送るため、最初にコメント行を返す
+            yield ": connected\n\n"
+            while not subscription.closed:
+                try:
+                    event = subscription.queue.get(timeout=EVENT_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield (f"id: {event.id}\nevent: {event.type}\n"
+                       f"data: {json.dumps(event.data)}\n\n")
+        finally:
+            _events.unsubscribe(subscription)
+            logger.info(f"イベントストリーム切断: {request.remote_addr}")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/api/block', methods=['POST'])
 @require_token
 def block_ip():
@@ -490,36 +4741,59 @@ def block_ip():
     try:
         data = request.get_json()
         ip_address = data.get('ip_address')
-        duration = data.get('duration')  # 未使用（将来の拡張用）
+        duration = data.get('duration')  # 秒、省略時は無期限
 
         if not ip_address:
             return jsonify({'error': 'IP address required'}), 400
 
+        if duration is not None:
+            try:
+                duration = _parse_int(duration, 'duration', 1, MAX_BLOCK_DURATION)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
         # IP形式検証
-        if not re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', ip_address):
+        if not is_valid_ipv4(ip_address):
             return jsonify({'error': 'Invalid IP address format'}), 400
 
+        whitelisted = _whitelist.match(ip_address)
+        if whitelisted is not None:
+            logger.warning(f"ホワイトリストのIPはブロックしません: {ip_address}（{whitelisted}）")
+            return jsonify({
+                'success': False,
+                'error': f'IP {ip_address} is whitelisted by {whitelisted}',
+                'whitelisted_by': whitelisted
+            }), 403
+
         logger.info(f"IPブロック要求: {ip_address}")
 
         # UFWでIPをブロック
-        stdout, stderr, returncode = run_command(
-            ['sudo', 'ufw', 'deny', 'from', ip_address]
-        )
+        ok, stderr = _firewall.block(ip_address)
 
-        if returncode != 0:
+        if not ok:
             logger.error(f"UFWブロック失敗: {stderr}")
             return jsonify({
                 'success': False,
                 'error': f'Failed to block IP: {stderr}'
             }), 500
 
-        logger.info(f"IP {ip_address} をブロックしました")
+        _firewall_state.add_blocked(ip_address)
+        if duration is None:
+            _block_expiry.cancel([ip_address])
+            expires_at = None
+            logger.info(f"IP {ip_address} をブロックしました")
+        else:
+            expires_at = datetime.fromtimestamp(_block_expiry.schedule([ip_address], duration)).isoformat()
+            logger.info(f"IP {ip_address} をブロックしました（{duration}秒後に解除）")
+        publish_firewall_events('block', [ip_address])
+        _collector.trigger()
 
         return jsonify({
             'success': True,
             'message': f'IP {ip_address} blocked successfully',
             'ip_address': ip_address,
-            'blocked_at': datetime.now().isoformat()
+            'blocked_at': datetime.now().isoformat(),
+            'expires_at': expires_at
         })
 
     except Exception as e:
@@ -541,11 +4815,9 @@ def unblock_ip():
         logger.info(f"IPブロック解除要求: {ip_address}")
 
         # UFWでブロックを削除
-        stdout, stderr, returncode = run_command(
-            ['sudo', 'ufw', 'delete', 'deny', 'from', ip_address]
-        )
+        ok, stderr = _firewall.unblock(ip_address)
 
-        if returncode != 0:
+        if not ok:
             logger.error(f"UFWブロック解除失敗: {stderr}")
             return jsonify({
                 'success': False,
@@ -553,6 +4825,11 @@ def unblock_ip():
             }), 500
 
         logger.info(f"IP {ip_address} のブロックを解除しました")
+        _firewall_state.remove_blocked(ip_address)
+        _block_expiry.cancel([ip_address])
+        _auto_blocker.forget([ip_address])
+        publish_firewall_events('unblock', [ip_address])
+        _collector.trigger()
 
         return jsonify({
             'success': True,
@@ -566,56 +4843,166 @@ def unblock_ip():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/whitelist', methods=['GET', 'POST', 'DELETE'])
+@app.route('/api/block/batch', methods=['POST'])
 @require_token
-def manage_whitelist():
-    """ホワイトリスト管理"""
+def block_ip_batch():
+    """複数のIPアドレスを一括ブロック"""
+    return _handle_batch('block')
+
+
+@app.route('/api/unblock/batch', methods=['POST'])
+@require_token
+def unblock_ip_batch():
+    """複数のIPアドレスのブロックを一括解除"""
+    return _handle_batch('unblock')
+
+
+def _handle_batch(action):
+    """
+    一括ブロック/解除リクエストを処理
+
+    Args:
+        action: 'block' または 'unblock'
+
+    Returns:
+        Response: IPごとの結果を含むレスポンス
+    """
     try:
-        if request.method == 'GET':
-            # ホワイトリスト取得
-            if os.path.exists(WHITELIST_FILE):
-                with open(WHITELIST_FILE, 'r') as f:
-                    whitelist = [line.strip() for line in f if line.strip()]
+        data = request.get_json(silent=True) or {}
+        ip_addresses = data.get('ip_addresses')
+
+        if not isinstance(ip_addresses, list) or not ip_addresses:
+            return jsonify({'error': 'ip_addresses (non-empty list) required'}), 400
+
+        if len(ip_addresses) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Too many IP addresses (max {MAX_BATCH_SIZE})'}), 400
+
+        duration = data.get('duration') if action == 'block' else None
+        if duration is not None:
+            try:
+                duration = _parse_int(duration, 'duration', 1, MAX_BLOCK_DURATION)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        logger.info(f"一括{action}要求: {len(ip_addresses)} 件")
+
+        results, ok = apply_batch(action, ip_addresses)
+        if ok:
+            applied_ips = [r['ip_address'] for r in results if r['status'] in ('blocked', 'unblocked')]
+            if action == 'unblock':
+                _block_expiry.cancel(applied_ips)
+                _auto_blocker.forget(applied_ips)
+            elif duration is not None:
+                _block_expiry.schedule(applied_ips, duration)
             else:
-                whitelist = []
+                _block_expiry.cancel(applied_ips)
+            publish_firewall_events(action, applied_ips)
+            _collector.trigger()
+
+        failed = sum(1 for r in results if not r['success'])
+        applied = sum(1 for r in results if r['status'] in ('blocked', 'unblocked'))
+        logger.info(f"一括{action}完了: 適用 {applied} 件, 失敗 {failed} 件")
 
-            return jsonify({'whitelist': whitelist})
+        return jsonify({
+            'success': failed == 0,
+            'applied': applied,
+            'skipped': len(results) - applied - failed,
+            'failed': failed,
+            'results': results,
+            'timestamp': datetime.now().isoformat()
+        }), (200 if ok else 500)
+
+    except Exception as e:
+        logger.error(f"一括{action}エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/aggregate', methods=['GET', 'POST'])
+@require_token
+def aggregate_subnets():
+    """ブロック済みIPのサブネット集約案の取得（GET）と適用（POST）"""
+    try:
+        if _aggregator.mode == 'off':
+            return jsonify({'error': 'Subnet aggregation is disabled'}), 400
+
+        plan = _aggregator.plan(_collector.get().auth_stats['attack_ips'])
+        response = {
+            'mode': _aggregator.mode,
+            'prefix': AGGREGATE_PREFIX,
+            **plan,
+            'timestamp': datetime.now().isoformat()
+        }
+        if request.method == 'GET':
+            return jsonify(response)
+
+        ok, error = _aggregator.apply(plan)
+        if not ok:
+            return jsonify({'success': False, 'error': error, **response}), 500
+        if plan['add'] or plan['remove']:
+            _collector.trigger()
+        return jsonify({'success': True, **response})
+
+    except Exception as e:
+        logger.error(f"サブネット集約エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        elif request.method == 'POST':
-            # ホワイトリストに追加
-            data = request.get_json()
-            ip_address = data.get('ip_address')
 
-            if not ip_address:
-                return jsonify({'error': 'IP address required'}), 400
+@app.route('/api/auto_block', methods=['GET'])
+@require_token
+def get_auto_block():
+    """自動ブロックの設定と、自動ブロックしたIPとその理由"""
+    try:
+        return jsonify({
+            'enabled': _auto_blocker.enabled,
+            'max_retry': _auto_blocker.max_retry,
+            'window': _auto_blocker.window,
+            'blocked': [
+                {'ip_address': ip, **reason}
+                for ip, reason in list(_auto_blocker.reasons.items())
+            ],
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error(f"自動ブロック情報取得エラー: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 
-            # ファイルに追加
-            os.makedirs(os.path.dirname(WHITELIST_FILE), exist_ok=True)
-            with open(WHITELIST_FILE, 'a') as f:
-                f.write(f"{ip_address}\n")
+@app.route('/api/whitelist', methods=['GET', 'POST', 'DELETE'])
+@require_token
+def manage_whitelist():
+    """ホワイトリスト管理（IPアドレスまたはCIDR）"""
+    try:
+        if request.method == 'GET':
+            return jsonify({'whitelist': _whitelist.entries()})
 
-            logger.info(f"ホワイトリストに追加: {ip_address}")
-            return jsonify({'success': True, 'message': 'Added to whitelist'})
+        data = request.get_json(silent=True) or {}
+        ip_address = data.get('ip_address')
 
-        elif request.method == 'DELETE':
-            # ホワイトリストから削除
-            data = request.get_json()
-            ip_address = data.get('ip_address')
+        if not ip_address:
+            return jsonify({'error': 'IP address required'}), 400
 
-            if not ip_address:
-                return jsonify({'error': 'IP address required'}), 400
+        try:
+            if request.method == 'POST':
+                entry, changed = _whitelist.add(ip_address)
+            else:
+                entry, changed = _whitelist.remove(ip_address)
+        except ValueError:
+            return jsonify({'error': 'Invalid IP address or CIDR format'}), 400
 
-            if os.path.exists(WHITELIST_FILE):
-                with open(WHITELIST_FILE, 'r') as f:
-                    lines = f.readlines()
+        if request.method == 'POST':
+            if changed:
+                logger.info(f"ホワイトリストに追加: {entry}")
+            message = 'Added to whitelist' if changed else 'Already whitelisted'
+        else:
+            if changed:
+                logger.info(f"ホワイトリストから削除: {entry}")
+            message = 'Removed from whitelist' if changed else 'Not in whitelist'
 
-                with open(WHITELIST_FILE, 'w') as f:
-                    for line in lines:
-                        if line.strip() != ip_address:
-                            f.write(line)
+        if changed and _lockdown.active:
+            _lockdown.refresh()
 
-            logger.info(f"ホワイトリストから削除: {ip_address}")
-            return jsonify({'success': True, 'message': 'Removed from whitelist'})
+        return jsonify({'success': True, 'message': message, 'entry': entry, 'changed': changed})
 
     except Exception as e:
         logger.error(f"ホワイトリスト管理エラー: {e}", exc_info=True)
@@ -633,40 +5020,43 @@ def get_ip_info():
         if not ip_address:
             return jsonify({'error': 'IP address required'}), 400
 
-        # auth.log解析
-        auth_stats = parse_auth_log()
-
-        # 指定IPの情報を検索
-        ip_info = None
-        for attack in auth_stats['attack_ips']:
-            if attack['ip_address'] == ip_address:
-                ip_info = attack
-                break
+        # 今日の回数はメモリ上のカウンター、過去の履歴は履歴ストアから取得
+        today = _auth_tailer.ip_stats(ip_address)
+        history = _history.ip_history(ip_address)
 
-        if ip_info is None:
+        if history is None and today['total_attempts'] == 0:
             return jsonify({
                 'ip_address': ip_address,
                 'found': False,
                 'message': 'No attack records found for this IP'
             })
 
-        # UFW状態を確認
-        ufw_status = get_ufw_status()
-        is_blocked = ip_address in ufw_status['blocked_ips']
+        # UFW状態を確認（メモリ上のモデルから）
+        is_blocked = _firewall_state.is_covered(ip_address)
+        geo = _geoip.lookup(ip_address)
+        expires_at = _block_expiry.expires_at(ip_address)
+        block_expires_at = datetime.fromtimestamp(expires_at).isoformat() if expires_at is not None else None
 
         response = {
             'ip_address': ip_address,
             'found': True,
-            'country': 'Unknown',  # TODO: GeoIP lookup
+            'country': geo['country'],
+            'country_code': geo['country_code'],
             'city': 'Unknown',
-            'isp': 'Unknown',
-            'threat_score': min(ip_info['total_attempts'] / 10, 10),  # 0-10スケール
-            'total_attacks': ip_info['total_attempts'],
-            'ssh_attempts': ip_info['ssh_attempts'],
-            'vpn_attempts': ip_info['vpn_attempts'],
-            'first_seen': datetime.now().isoformat(),  # TODO: 実際の初回検出時刻
-            'last_seen': datetime.now().isoformat(),
-            'blocked': is_blocked
+            'isp': geo['isp'] or 'Unknown',
+            'asn': geo['asn'],
+            'threat_score': min(today['total_attempts'] / 10, 10),  # 0-10スケール
+            'total_attacks': today['total_attempts'],
+            'ssh_attempts': today['ssh_attempts'],
+            'vpn_attempts': today['vpn_attempts'],
+            # 履歴ストアが使えない場合は今日の記録で代用
+            'first_seen': history['first_seen'] if history else today['first_seen'],
+            'last_seen': history['last_seen'] if history else today['last_seen'],
+            'daily_counts': history['daily'] if history else [],
+            'blocked': is_blocked,
+            'block_expires_at': block_expires_at,
+            'block_ttl': block_ttl(block_expires_at),
+            'auto_block_reason': _auto_blocker.reason(ip_address)
         }
 
         return jsonify(response)
@@ -676,34 +5066,38 @@ def get_ip_info():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/emergency', methods=['POST'])
+@app.route('/api/emergency', methods=['GET', 'POST', 'DELETE'])
 @require_token
 def emergency_lockdown():
-    """緊急ロックダウン"""
+    """緊急ロックダウンの状態取得（GET）、開始（POST）、解除（DELETE）"""
     try:
-        logger.warning("🚨 緊急ロックダウン実行")
-
-        # ロックモードファイルを作成
-        with open(EMERGENCY_MODE_FILE, 'w') as f:
-            f.write(f"Emergency lockdown activated at {datetime.now().isoformat()}\n")
-
-        # TODO: 実際のロックダウン処理
-        # - すべての新規接続を拒否
-        # - ホワイトリストIPのみ許可
-        # - 管理者に通知
-
-        actions = [
-            "すべての新規接続をブロック",
-            "ホワイトリストIPのみ許可",
-            "管理者に通知送信",
-            "ログ記録強化"
-        ]
-
+        if request.method == 'GET':
+            return jsonify(_lockdown.status())
+
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            reason = data.get('reason') or 'manual'
+            logger.warning(f"🚨 緊急ロックダウン要求: {reason}")
+            try:
+                # 要求元（Home Assistant）が締め出されないよう許可に含める
+                ok, error, elapsed_ms = _lockdown.activate(reason, keep=[request.remote_addr])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            message = 'Emergency lockdown activated'
+        else:
+            ok, error, elapsed_ms = _lockdown.release()
+            message = 'Emergency lockdown released'
+
+        if not ok:
+            return jsonify({'success': False, 'error': error}), 500
+
+        _events.publish('lockdown', _lockdown.status())
         return jsonify({
             'success': True,
-            'message': 'Emergency lockdown activated',
+            'message': message,
             'timestamp': datetime.now().isoformat(),
-            'actions': actions
+            'duration_ms': round(elapsed_ms, 1),
+            **_lockdown.status()
         })
 
     except Exception as e:
@@ -713,6 +5107,76 @@ def emergency_lockdown():
 
 # ==================== メイン ====================
 
+# ==================== サーバー起動 ====================
+
+_agent_started = False
+_agent_start_lock = threading.Lock()
+
+
+def start_agent():
+    """
+    ファイアウォールの初期化とバックグラウンド処理を開始する
+
+    状態（スナップショット、auth.logの読み取り位置、イベント購読者）は
+    プロセス内に持つため、1プロセスで1回だけ実行される。
+    """
+    global _agent_started
+
+    with _agent_start_lock:
+        if _agent_started:
+            return
+        _agent_started = True
+
+        # ディレクトリ作成
+        os.makedirs(os.path.dirname(WHITELIST_FILE), exist_ok=True)
+
+        # ファイアウォールバックエンドを初期化
+        logger.info(f"🧱 ファイアウォール: {_firewall.name}")
+        ok, error = _firewall.setup()
+        if not ok:
+            logger.error(f"ファイアウォールの初期化に失敗しました: {error}")
+
+        # GeoIPが使えないと国別統計がすべて Unknown になるため、起動時に1回だけ知らせる
+        reason = _geoip.unavailable_reason()
+        if reason:
+            logger.warning(f"GeoIPを利用できないため、攻撃元の国はすべて Unknown になります: {reason}")
+
+        # バックグラウンド収集とauth.log監視を開始
+        _collector.start()
+        _auth_watcher.start()
+        _block_expiry.start()
+
+
+def create_app():
+    """
+    外部のWSGIサーバーから読み込むためのアプリケーションファクトリ
+
+    例: gunicorn -w 1 -k gthread --threads 16 'vps_monitor_api:create_app()'
+    状態をプロセス内に持つため、ワーカーは必ず1つにしてスレッドで並列化する。
+
+    Returns:
+        Flask: 初期化済みのアプリケーション
+    """
+    start_agent()
+    return app
+
+
+def serve():
+    """設定されたWSGIサーバーでAPIを起動"""
+    if SERVER == 'waitress' and waitress is not None:
+        logger.info(f"🌐 サーバー: waitress（{SERVER_THREADS}スレッド）")
+        # 遅いファイアウォール操作は処理スレッドを1本占有するだけで、
+        # スナップショットを読むだけの参照系は他のスレッドで即座に返る
+        waitress.serve(app, host='0.0.0.0', port=API_PORT, threads=SERVER_THREADS, ident=None)
+        return
+
+    if SERVER == 'waitress':
+        logger.warning("waitressがインストールされていないため、開発用サーバーで起動します")
+    logger.info("🌐 サーバー: Flask開発用サーバー")
+    # イベントストリームが接続を保持するため、リクエストごとにスレッドで処理する
+    app.run(host='0.0.0.0', port=API_PORT, debug=False, threaded=True)
+
+
 if __name__ == '__main__':
     logger.info("=" * 60)
     logger.info("🚀 VPS監視APIサーバーを起動しています")
@@ -726,8 +5190,5 @@ if __name__ == '__main__':
     if os.geteuid() == 0:
         logger.warning("⚠️  rootユーザーで実行されています")
 
-    # ディレクトリ作成
-    os.makedirs(os.path.dirname(WHITELIST_FILE), exist_ok=True)
-
-    # サーバー起動
-    app.run(host='0.0.0.0', port=API_PORT, debug=False)
+    start_agent()
+    serve()
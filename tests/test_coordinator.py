@@ -77,6 +77,8 @@ async def test_async_update_data_success(
     coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
 
     with patch.object(
+        coordinator, "_fetch_capabilities", return_value=set()
+    ), patch.object(
         coordinator, "_fetch_vps_status", return_value=mock_api_response_status
     ), patch.object(
         coordinator, "_fetch_threats", return_value=mock_api_response_threats
@@ -90,6 +92,174 @@ async def test_async_update_data_success(
         assert data["threats"]["threat_level"] == "high"
 
 
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_async_update_data_uses_snapshot(
+    mock_hass, mock_config_entry, mock_api_response_status, mock_api_response_threats
+):
+    """スナップショット対応エージェントでは1回のリクエストで更新することをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+
+    responses = {
+        "http://192.168.1.100:5001/health": {"status": "healthy", "capabilities": ["snapshot"]},
+        "http://192.168.1.100:5001/api/snapshot": {
+            "generation": 3,
+            "status": mock_api_response_status,
+            "threats": mock_api_response_threats,
+        },
+    }
+    requested = []
+
+    async def fake_request(url, method="GET", json_data=None):
+        requested.append(url)
+        return responses[url]
+
+    with patch.object(coordinator, "_make_api_request", side_effect=fake_request):
+        await coordinator._async_update_data()
+        data = await coordinator._async_update_data()
+
+    # 対応機能の検出は初回のみ、以降はスナップショット1回
+    assert requested == [
+        "http://192.168.1.100:5001/health",
+        "http://192.168.1.100:5001/api/snapshot",
+        "http://192.168.1.100:5001/api/snapshot",
+    ]
+    assert data["status"]["blocked_ips_today"] == 15
+    assert data["threats"]["threat_level"] == "high"
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_async_update_data_applies_threats_delta(
+    mock_hass, mock_config_entry, mock_api_response_status
+):
+    """差分対応エージェントではカーソル以降の差分を反映することをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+    base = "http://192.168.1.100:5001"
+
+    def record(ip, count):
+        return {"ip_address": ip, "attack_count": count}
+
+    responses = {
+        f"{base}/health": {"capabilities": ["snapshot", "threats_delta"]},
+        f"{base}/api/snapshot?since=": {
+            "status": mock_api_response_status,
+            "threats_delta": {
+                "threat_level": "medium", "cursor": "boot:1", "full": True,
+                "upserts": [record("1.1.1.1", 10), record("2.2.2.2", 5)], "removed": [],
+            },
+        },
+        f"{base}/api/snapshot?since=boot%3A1": {
+            "status": mock_api_response_status,
+            "threats_delta": {
+                "threat_level": "high", "cursor": "boot:4", "full": False,
+                "upserts": [record("2.2.2.2", 20), record("3.3.3.3", 1)],
+                "removed": ["1.1.1.1"],
+            },
+        },
+    }
+
+    async def fake_request(url, method="GET", json_data=None):
+        coordinator._modified = True
+        return responses[url]
+
+    with patch.object(coordinator, "_make_api_request", side_effect=fake_request):
+        first = await coordinator._async_update_data()
+        coordinator.data = first
+        second = await coordinator._async_update_data()
+
+    assert [t["ip_address"] for t in first["threats"]["threat_list"]] == ["1.1.1.1", "2.2.2.2"]
+    assert [t["ip_address"] for t in second["threats"]["threat_list"]] == ["2.2.2.2", "3.3.3.3"]
+    assert second["threats"]["threat_level"] == "high"
+    assert coordinator._threat_cursor == "boot:4"
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_handle_event_pushes_attack_and_block(
+    mock_hass, mock_config_entry, mock_api_response_status
+):
+    """攻撃・ブロックイベントが即座にデータへ反映されることをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+    coordinator.data = {
+        "status": coordinator._parse_status(mock_api_response_status),
+        "threats": coordinator._parse_threats({
+            "threat_list": [{"ip_address": "1.1.1.1", "attack_count": 5, "blocked": False}],
+        }),
+    }
+    attack = (
+        '{"ip_address": "2.2.2.2", "ssh_attacks_today": 200, "vpn_attacks_today": 3,'
+        ' "threat": {"ip_address": "2.2.2.2", "attack_count": 9, "blocked": False}}'
+    )
+
+    with patch.object(coordinator, "async_update_listeners") as update_listeners:
+        coordinator._handle_event("attack", "boot-1", attack)
+        coordinator._handle_event("block", "boot-2", '{"ip_address": "2.2.2.2"}')
+
+    assert update_listeners.call_count == 2
+    threat_list = coordinator.data["threats"]["threat_list"]
+    assert [t["ip_address"] for t in threat_list] == ["2.2.2.2", "1.1.1.1"]
+    assert threat_list[0]["blocked"] is True
+    assert coordinator.data["status"]["ssh_attacks_today"] == 200
+    assert coordinator.data["threats"]["threat_level"] == "critical"
+    assert coordinator._last_event_id == "boot-2"
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_frequent_events_keep_scheduled_refresh(
+    mock_hass, mock_config_entry, mock_api_response_status
+):
+    """イベントが頻繁に届いても、予定済みの補正ポーリングが延期されないことをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+    coordinator.data = {
+        "status": coordinator._parse_status(mock_api_response_status),
+        "threats": coordinator._parse_threats({"threat_list": []}),
+    }
+    scheduled_refresh = MagicMock()
+    coordinator._unsub_refresh = scheduled_refresh
+
+    with patch.object(coordinator, "_schedule_refresh") as reschedule, \
+            patch.object(coordinator, "async_update_listeners"):
+        for count in range(1, 21):
+            coordinator._handle_event(
+                "attack", f"boot-{count}",
+                '{"ip_address": "2.2.2.2", "ssh_attacks_today": %d, "vpn_attacks_today": 0,'
+                ' "threat": {"ip_address": "2.2.2.2", "attack_count": %d}}' % (count, count),
+            )
+
+    scheduled_refresh.assert_not_called()
+    reschedule.assert_not_called()
+    assert coordinator._unsub_refresh is scheduled_refresh
+    assert coordinator.data["status"]["ssh_attacks_today"] == 20
+    assert coordinator.data["threats"]["threat_level"] == "medium"
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_async_update_data_legacy_agent(
+    mock_hass, mock_config_entry, mock_api_response_status, mock_api_response_threats
+):
+    """スナップショット非対応エージェントでは個別に取得することをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+
+    responses = {
+        "http://192.168.1.100:5001/health": {"status": "healthy"},
+        "http://192.168.1.100:5001/api/status": mock_api_response_status,
+        "http://192.168.1.100:5001/api/threats": mock_api_response_threats,
+    }
+
+    async def fake_request(url, method="GET", json_data=None):
+        return responses[url]
+
+    with patch.object(coordinator, "_make_api_request", side_effect=fake_request):
+        data = await coordinator._async_update_data()
+
+    assert coordinator.capabilities == set()
+    assert data["status"]["ssh_attacks_today"] == 234
+    assert data["threats"]["total_threats"] == 42
+
+
 @pytest.mark.unit
 @pytest.mark.asyncio
 async def test_make_api_request_auth_error(mock_hass, mock_config_entry):
@@ -176,6 +346,26 @@ async def test_block_ip_failure(mock_hass, mock_config_entry):
         assert result is False
 
 
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_block_ip_with_duration(mock_hass, mock_config_entry):
+    """期限付きブロックで期間（秒）が送信されることをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+
+    mock_response = {"success": True, "expires_at": "2026-10-18T11:00:00"}
+
+    with patch.object(
+        coordinator, "_make_api_request", return_value=mock_response
+    ) as mock_request, patch.object(coordinator, "async_request_refresh", new_callable=AsyncMock):
+        result = await coordinator.async_block_ip("192.168.1.1", duration=3600)
+
+        assert result is True
+        assert mock_request.call_args.kwargs["json_data"] == {
+            "ip_address": "192.168.1.1",
+            "duration": 3600,
+        }
+
+
 @pytest.mark.unit
 @pytest.mark.asyncio
 async def test_unblock_ip_success(mock_hass, mock_config_entry):
@@ -192,6 +382,24 @@ async def test_unblock_ip_success(mock_hass, mock_config_entry):
         assert result is True
 
 
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_emergency_lockdown(mock_hass, mock_config_entry):
+    """緊急ロックダウンで理由が送信されることをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+
+    mock_response = {"success": True, "active": True, "allowed": ["192.168.1.0/24"]}
+
+    with patch.object(
+        coordinator, "_make_api_request", return_value=mock_response
+    ) as mock_request, patch.object(coordinator, "async_request_refresh", new_callable=AsyncMock):
+        result = await coordinator.async_emergency_lockdown("brute force")
+
+        assert result is True
+        assert mock_request.call_args.args[0].endswith("/api/emergency")
+        assert mock_request.call_args.kwargs["json_data"] == {"reason": "brute force"}
+
+
 @pytest.mark.unit
 @pytest.mark.asyncio
 async def test_handle_response_success(mock_hass, mock_config_entry):
@@ -219,3 +427,57 @@ async def test_handle_response_403_forbidden(mock_hass, mock_config_entry):
 
     with pytest.raises(ConfigEntryAuthFailed):
         await coordinator._handle_response(mock_response)
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_handle_response_not_modified(mock_hass, mock_config_entry):
+    """304レスポンスで前回のデータを再利用することをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+    url = "http://192.168.1.100:5001/api/snapshot"
+
+    first = AsyncMock()
+    first.status = 200
+    first.headers = {"ETag": '"abc123"'}
+    first.json = AsyncMock(return_value={"data": "test"})
+    data = await coordinator._handle_response(first, url)
+
+    second = AsyncMock()
+    second.status = 304
+    second.json = AsyncMock(side_effect=AssertionError("304ではJSONをデコードしない"))
+
+    assert await coordinator._handle_response(second, url) is data
+    assert coordinator._etags[url] == '"abc123"'
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_handle_response_msgpack(mock_hass, mock_config_entry):
+    """msgpack形式のレスポンスをデコードできることをテスト"""
+    import msgpack
+
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+
+    response = AsyncMock()
+    response.status = 200
+    response.headers = {}
+    response.content_type = "application/msgpack"
+    response.read = AsyncMock(return_value=msgpack.packb({"threat_level": "high"}))
+    response.json = AsyncMock(side_effect=AssertionError("msgpackではJSONをデコードしない"))
+
+    assert await coordinator._handle_response(response) == {"threat_level": "high"}
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_async_update_data_unchanged_keeps_data(mock_hass, mock_config_entry):
+    """すべて未変更の場合は前回のデータをそのまま返すことをテスト"""
+    coordinator = HAIPMonitorDataUpdateCoordinator(mock_hass, mock_config_entry)
+    coordinator.capabilities = {"snapshot"}
+    coordinator.data = {"status": {}, "threats": {}, "last_update": "2025-11-13T10:30:00Z"}
+
+    # 304の場合、_handle_responseは_modifiedを立てない
+    with patch.object(coordinator, "_make_api_request", return_value={}):
+        data = await coordinator._async_update_data()
+
+    assert data is coordinator.data
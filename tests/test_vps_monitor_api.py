@@ -0,0 +1,1817 @@
+"""
+ファイル名: test_vps_monitor_api.py
+説明: VPS監視APIサーバー（remote_scripts）のユニットテスト
+作成日: 2026-10-18
+"""
+import gzip
+import json
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import pytest
+
+pytest.importorskip("flask")
+
+# VPS側スクリプトはパッケージではないため、パスを追加してインポートする
+os.environ.setdefault("LOG_FILE", os.devnull)
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "remote_scripts")
+)
+
+import vps_monitor_api  # noqa: E402
+
+
+def _today_line(message):
+    """今日の日付のISO 8601形式ログ行を生成"""
+    today = vps_monitor_api.datetime.now().strftime("%Y-%m-%d")
+    return f"{today}T10:00:00.000000+00:00 vps sshd[1234]: {message}\n"
+
+
+def _ssh_failure(ip):
+    """SSHログイン失敗のログ行を生成"""
+    return _today_line(f"Failed password for invalid user admin from {ip} port 22 ssh2")
+
+
+@pytest.fixture
+def auth_log(tmp_path):
+    """一時的なauth.logと状態ファイルのパス"""
+    return tmp_path / "auth.log", tmp_path / "state" / "auth_log_state.json"
+
+
+@pytest.mark.unit
+def test_tailer_reads_only_appended_lines(auth_log):
+    """追記された行だけが集計されることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 3)
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    assert tailer.poll() is True
+    assert tailer.stats()["ssh_attacks_today"] == 3
+
+    with open(log_path, "a") as f:
+        f.write(_ssh_failure("5.6.7.8"))
+
+    tailer.poll()
+    stats = tailer.stats()
+    assert stats["ssh_attacks_today"] == 4
+    assert stats["unique_attackers"] == 2
+    assert stats["attack_ips"][0]["ip_address"] == "1.2.3.4"
+
+
+@pytest.mark.unit
+def test_tailer_skips_partial_line(auth_log):
+    """書き込み途中の行は次回まで読まないことをテスト"""
+    log_path, state_path = auth_log
+    line = _ssh_failure("1.2.3.4")
+    log_path.write_text(line + line[:20])
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+    assert tailer.offset == len(line.encode())
+
+    with open(log_path, "a") as f:
+        f.write(line[20:])
+
+    tailer.poll()
+    assert tailer.stats()["ssh_attacks_today"] == 2
+
+
+@pytest.mark.unit
+def test_tailer_restores_offset_after_restart(auth_log):
+    """再起動後に保存済みオフセットから再開することをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 2)
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    restarted = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    assert restarted.offset == tailer.offset
+    restarted.poll()
+    assert restarted.stats()["ssh_attacks_today"] == 2
+
+
+@pytest.mark.unit
+def test_tailer_handles_truncation(auth_log):
+    """ファイルの切り詰め後に先頭から読み直すことをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 3)
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    log_path.write_text(_ssh_failure("5.6.7.8"))
+    tailer.poll()
+
+    stats = tailer.stats()
+    assert stats["ssh_attacks_today"] == 4
+    assert tailer.offset == len(_ssh_failure("5.6.7.8").encode())
+
+
+@pytest.mark.unit
+def test_tailer_drains_rotated_file(auth_log):
+    """ローテーション時に旧ファイルの未読部分を読み切ることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4"))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    # ローテーション直前に追記され、その後リネームされる
+    with open(log_path, "a") as f:
+        f.write(_ssh_failure("1.2.3.4"))
+    os.rename(log_path, f"{log_path}.1")
+    log_path.write_text(_ssh_failure("5.6.7.8"))
+
+    tailer.poll()
+    stats = tailer.stats()
+    assert stats["ssh_attacks_today"] == 3
+    assert {a["ip_address"] for a in stats["attack_ips"]} == {"1.2.3.4", "5.6.7.8"}
+
+
+@pytest.mark.unit
+def test_tailer_drains_compressed_rotated_file(auth_log):
+    """gzip化された旧ファイルもフィンガープリントで照合することをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 4)
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+    assert tailer.fingerprint is not None
+
+    with open(log_path, "a") as f:
+        f.write(_ssh_failure("1.2.3.4"))
+    with open(log_path, "rb") as src, gzip.open(f"{log_path}.1.gz", "wb") as dst:
+        dst.write(src.read())
+    new_log = log_path.parent / "auth.log.new"
+    new_log.write_text(_ssh_failure("5.6.7.8"))
+    os.replace(new_log, log_path)
+
+    tailer.poll()
+    assert tailer.stats()["ssh_attacks_today"] == 6
+
+
+@pytest.mark.unit
+def test_tailer_first_start_reads_rotated_chain(auth_log):
+    """初回起動時にローテーション済みファイルから今日の分を集計することをテスト"""
+    log_path, state_path = auth_log
+    with gzip.open(f"{log_path}.2.gz", "wt") as f:
+        f.write(_ssh_failure("9.9.9.9") * 2)
+    (log_path.parent / "auth.log.1").write_text(_ssh_failure("1.2.3.4") * 3)
+    log_path.write_text(_ssh_failure("5.6.7.8"))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    stats = tailer.stats()
+    assert stats["ssh_attacks_today"] == 6
+    assert stats["unique_attackers"] == 3
+
+
+@pytest.mark.unit
+def test_rotated_log_paths_order(tmp_path):
+    """ローテーション済みファイルが新しい順に並ぶことをテスト"""
+    for name in ("auth.log", "auth.log.1", "auth.log.2.gz", "auth.log.10.gz", "other.log.1"):
+        (tmp_path / name).write_text("")
+
+    paths = vps_monitor_api.rotated_log_paths(str(tmp_path / "auth.log"))
+    assert [os.path.basename(p) for p in paths] == [
+        "auth.log.1", "auth.log.2.gz", "auth.log.10.gz"
+    ]
+
+
+@pytest.fixture
+def fake_proc(tmp_path):
+    """最小限の/procを模したディレクトリ"""
+    proc = tmp_path / "proc"
+    proc.mkdir()
+    (proc / "stat").write_text("cpu  100 0 100 800 0 0 0 0 0 0\n")
+    (proc / "meminfo").write_text(
+        "MemTotal:        2048000 kB\n"
+        "MemFree:          512000 kB\n"
+        "MemAvailable:    1024000 kB\n"
+    )
+    (proc / "uptime").write_text("1299900.50 2000000.00\n")
+    return proc
+
+
+@pytest.mark.unit
+def test_proc_sampler_cpu_uses_deltas(fake_proc):
+    """CPU使用率が前回サンプルとの差分で計算されることをテスト"""
+    sampler = vps_monitor_api.ProcSampler(str(fake_proc), str(fake_proc))
+
+    # 起動時からの平均: busy=200 / total=1000
+    assert sampler.cpu_usage() == 20.0
+
+    # 差分: busy +50 / total +100
+    (fake_proc / "stat").write_text("cpu  150 0 100 850 0 0 0 0 0 0\n")
+    assert sampler.cpu_usage() == 50.0
+
+
+@pytest.mark.unit
+def test_proc_sampler_sample_fields(fake_proc):
+    """サンプル結果が既存のレスポンス項目を含むことをテスト"""
+    sampler = vps_monitor_api.ProcSampler(str(fake_proc), str(fake_proc))
+    stats = sampler.sample()
+
+    assert stats["memory_usage"] == 50.0
+    assert stats["memory_total_mb"] == 2000
+    assert stats["memory_used_mb"] == 1000
+    assert stats["uptime"] == "2 weeks, 1 day, 1 hour, 5 minutes"
+    assert stats["disk_usage"].isdigit()
+    assert "disk_total" in stats
+
+
+@pytest.mark.unit
+def test_format_size_matches_df():
+    """df -h と同じサイズ表記になることをテスト"""
+    assert vps_monitor_api._format_size(512) == "512"
+    assert vps_monitor_api._format_size(1000 * 1024 ** 2) == "1000M"
+    assert vps_monitor_api._format_size(int(9.81 * 1024 ** 3)) == "9.9G"
+    assert vps_monitor_api._format_size(20 * 1024 ** 3) == "20G"
+
+
+AUTH_HEADERS = {"Authorization": f"Bearer {vps_monitor_api.API_TOKEN}"}
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    """固定データを収集するスナップショットコレクター"""
+    calls = {"ufw": 0, "auth": 0}
+
+    def fake_ufw_status():
+        calls["ufw"] += 1
+        return {
+            "firewall_active": True,
+            "rules_count": 1,
+            "blocked_ips": ["1.2.3.4"],
+            "blocked_ips_today": 1,
+        }
+
+    def fake_parse_auth_log():
+        calls["auth"] += 1
+        return {
+            "ssh_attacks_today": 120,
+            "vpn_attacks_today": 0,
+            "attack_ips": [
+                {"ip_address": "1.2.3.4", "ssh_attempts": 100, "vpn_attempts": 0, "total_attempts": 100,
+                 "first_seen": "2026-10-18T01:00:00", "last_seen": "2026-10-18T09:00:00"},
+                {"ip_address": "5.6.7.8", "ssh_attempts": 20, "vpn_attempts": 0, "total_attempts": 20,
+                 "first_seen": "2026-10-18T02:00:00", "last_seen": "2026-10-18T08:00:00"},
+            ],
+            "unique_attackers": 2,
+        }
+
+    monkeypatch.setattr(vps_monitor_api, "get_system_stats", lambda: {"cpu_usage": 1.5})
+    monkeypatch.setattr(vps_monitor_api, "get_ufw_status", fake_ufw_status)
+    monkeypatch.setattr(vps_monitor_api, "parse_auth_log", fake_parse_auth_log)
+    monkeypatch.setattr(vps_monitor_api, "_firewall_state", vps_monitor_api.FirewallStateCache(
+        lambda: {"firewall_active": True, "blocked_ips": ["1.2.3.4"]}, reconcile_interval=3600
+    ))
+
+    snapshot_collector = vps_monitor_api.SnapshotCollector(interval=3600)
+    snapshot_collector.calls = calls
+    monkeypatch.setattr(vps_monitor_api, "_collector", snapshot_collector)
+    return snapshot_collector
+
+
+@pytest.fixture
+def client():
+    """Flaskテストクライアント"""
+    return vps_monitor_api.app.test_client()
+
+
+@pytest.mark.unit
+def test_endpoints_serve_collected_snapshot(collector, client):
+    """エンドポイントが収集済みスナップショットを返すことをテスト"""
+    collector.refresh()
+
+    for _ in range(3):
+        status = client.get("/api/status", headers=AUTH_HEADERS).get_json()
+        threats = client.get("/api/threats", headers=AUTH_HEADERS).get_json()
+
+    # リクエストごとの再計算は発生しない
+    assert collector.calls == {"ufw": 1, "auth": 1}
+    assert status["ssh_attacks_today"] == 120
+    assert status["cpu_usage"] == 1.5
+    assert threats["threat_level"] == "high"
+    assert threats["threat_list"][0]["threat_level"] == "critical"
+    assert threats["threat_list"][0]["blocked"] is True
+    assert threats["threat_list"][1]["blocked"] is False
+
+
+@pytest.mark.unit
+def test_collector_thread_refreshes_on_trigger(collector):
+    """trigger()で収集スレッドが即座に更新することをテスト"""
+    collector.start()
+    try:
+        first = collector.get()
+        collector.trigger()
+        for _ in range(100):
+            if collector.get().generation > first.generation:
+                break
+            time.sleep(0.01)
+        assert collector.get().generation > first.generation
+    finally:
+        collector.stop()
+
+
+@pytest.mark.unit
+def test_collector_single_flight_on_cold_start(monkeypatch, collector):
+    """未収集時に同時に来たリクエストでもauth.log解析が1回だけであることをテスト"""
+    slow_parse = vps_monitor_api.parse_auth_log
+
+    def parse_auth_log():
+        time.sleep(0.2)
+        return slow_parse()
+
+    monkeypatch.setattr(vps_monitor_api, "parse_auth_log", parse_auth_log)
+
+    barrier = threading.Barrier(8)
+    results = []
+
+    def request():
+        barrier.wait()
+        results.append(collector.get())
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert collector.calls["auth"] == 1
+    assert len({snapshot.generation for snapshot in results}) == 1
+
+
+@pytest.mark.unit
+def test_collector_stale_while_revalidate(monkeypatch, collector):
+    """TTL切れでも猶予内なら古い値を返し、再収集は裏で1回だけ行うことをテスト"""
+    first = collector.get()
+    collector.ttl = 0
+
+    slow_parse = vps_monitor_api.parse_auth_log
+
+    def parse_auth_log():
+        time.sleep(0.1)
+        return slow_parse()
+
+    monkeypatch.setattr(vps_monitor_api, "parse_auth_log", parse_auth_log)
+
+    # 再収集中も古いスナップショットが即座に返る
+    for _ in range(5):
+        assert collector.get() is first
+    for _ in range(100):
+        if collector._snapshot is not first:
+            break
+        time.sleep(0.01)
+    assert collector._snapshot.generation == first.generation + 1
+    assert collector.calls["auth"] == 2
+
+    # 猶予も過ぎていればその場で再収集する
+    collector.stale_ttl = 0
+    assert collector.get().generation > first.generation + 1
+
+
+@pytest.mark.unit
+def test_firewall_state_cache_write_through():
+    """ブロック操作がライトスルーで反映され、読み取りでufwを起動しないことをテスト"""
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {"firewall_active": True, "blocked_ips": ["1.2.3.4"]}
+
+    cache = vps_monitor_api.FirewallStateCache(loader, reconcile_interval=3600)
+    assert cache.is_blocked("1.2.3.4")
+
+    cache.add_blocked("5.6.7.8")
+    cache.remove_blocked("1.2.3.4")
+    for _ in range(5):
+        status = cache.status()
+
+    assert loads == [1]
+    assert status["blocked_ips"] == ["5.6.7.8"]
+    assert status["rules_count"] == 1
+
+
+@pytest.mark.unit
+def test_firewall_state_cache_reconcile():
+    """再照合で外部変更を取り込み、読み込み失敗時は前回のモデルを維持することをテスト"""
+    states = [
+        {"firewall_active": True, "blocked_ips": ["1.2.3.4"]},
+        {"firewall_active": True, "blocked_ips": ["1.2.3.4", "9.9.9.9"]},
+        None,
+    ]
+    cache = vps_monitor_api.FirewallStateCache(lambda: states.pop(0), reconcile_interval=0)
+
+    cache.reconcile_if_due()
+    cache.reconcile_if_due()
+    assert cache.status()["blocked_ips"] == ["1.2.3.4", "9.9.9.9"]
+
+    cache.reconcile_if_due()
+    assert cache.status()["blocked_ips"] == ["1.2.3.4", "9.9.9.9"]
+
+
+@pytest.mark.unit
+def test_block_endpoint_updates_firewall_state(monkeypatch, client):
+    """ブロックAPIの成功時にモデルが更新されることをテスト"""
+    commands = []
+
+    def fake_run_command(command, shell=False):
+        commands.append(command)
+        return "", "", 0
+
+    cache = vps_monitor_api.FirewallStateCache(
+        lambda: {"firewall_active": True, "blocked_ips": []}, reconcile_interval=3600
+    )
+    monkeypatch.setattr(vps_monitor_api, "run_command", fake_run_command)
+    monkeypatch.setattr(vps_monitor_api, "_firewall_state", cache)
+
+    response = client.post("/api/block", json={"ip_address": "5.6.7.8"}, headers=AUTH_HEADERS)
+
+    assert response.get_json()["success"] is True
+    assert commands == [["sudo", "ufw", "deny", "from", "5.6.7.8"]]
+    assert cache.is_blocked("5.6.7.8")
+
+
+UFW_USER_RULES = """*filter
+:ufw-user-input - [0:0]
+
+### RULES ###
+
+### tuple ### allow tcp 22 0.0.0.0/0 any 0.0.0.0/0 in
+-A ufw-user-input -p tcp --dport 22 -j ACCEPT
+
+### tuple ### deny any any 0.0.0.0/0 any 1.2.3.4 in
+-A ufw-user-input -s 1.2.3.4 -j DROP
+
+### END RULES ###
+
+COMMIT
+"""
+
+
+@pytest.mark.unit
+def test_edit_ufw_user_rules_add_and_remove():
+    """user.rulesのルールブロックを追加/削除できることをテスト"""
+    updated = vps_monitor_api.edit_ufw_user_rules(
+        UFW_USER_RULES, add=["5.6.7.8", "9.9.9.9"], remove=["1.2.3.4"]
+    )
+
+    assert "1.2.3.4" not in updated
+    assert "-A ufw-user-input -p tcp --dport 22 -j ACCEPT" in updated
+    assert "### tuple ### deny any any 0.0.0.0/0 any 5.6.7.8 in\n-A ufw-user-input -s 5.6.7.8 -j DROP\n" in updated
+    assert updated.index("9.9.9.9") < updated.index("### END RULES ###")
+
+    # 元に戻すと同じ内容になる
+    restored = vps_monitor_api.edit_ufw_user_rules(
+        updated, add=["1.2.3.4"], remove=["5.6.7.8", "9.9.9.9"]
+    )
+    assert restored == UFW_USER_RULES
+
+
+@pytest.mark.unit
+def test_batch_block_single_transaction(monkeypatch, tmp_path, collector, client):
+    """一括ブロックが重複を除外して1回のreloadで適用されることをテスト"""
+    rules_path = tmp_path / "user.rules"
+    rules_path.write_text(UFW_USER_RULES)
+    commands = []
+
+    def fake_run_command(command, shell=False):
+        commands.append(command)
+        return "", "", 0
+
+    monkeypatch.setattr(vps_monitor_api, "run_command", fake_run_command)
+    monkeypatch.setattr(vps_monitor_api, "_firewall", vps_monitor_api.UfwBackend(str(rules_path)))
+    monkeypatch.setattr(vps_monitor_api, "_firewall_state", vps_monitor_api.FirewallStateCache(
+        lambda: {"firewall_active": True, "blocked_ips": ["1.2.3.4"]}, reconcile_interval=3600
+    ))
+
+    response = client.post(
+        "/api/block/batch",
+        json={"ip_addresses": ["5.6.7.8", "1.2.3.4", "5.6.7.8", "999.1.1.1", "9.9.9.9"]},
+        headers=AUTH_HEADERS,
+    )
+    body = response.get_json()
+
+    assert commands == [["sudo", "ufw", "reload"]]
+    assert [r["status"] for r in body["results"]] == [
+        "blocked", "already_blocked", "duplicate", "invalid", "blocked"
+    ]
+    assert body["applied"] == 2
+    assert body["failed"] == 1
+    assert "-A ufw-user-input -s 9.9.9.9 -j DROP" in rules_path.read_text()
+    assert vps_monitor_api._firewall_state.is_blocked("9.9.9.9")
+
+
+@pytest.mark.unit
+def test_batch_block_rolls_back_on_reload_failure(monkeypatch, tmp_path):
+    """reload失敗時にuser.rulesが元に戻ることをテスト"""
+    rules_path = tmp_path / "user.rules"
+    rules_path.write_text(UFW_USER_RULES)
+    monkeypatch.setattr(
+        vps_monitor_api, "run_command", lambda command, shell=False: ("", "reload failed", 1)
+    )
+
+    ok, error = vps_monitor_api.UfwBackend(str(rules_path)).block_many(["5.6.7.8"])
+
+    assert ok is False
+    assert error == "reload failed"
+    assert rules_path.read_text() == UFW_USER_RULES
+
+
+class FakeFirewallBackend(vps_monitor_api.FirewallBackend):
+    """root権限なしで動作するメモリ上のファイアウォール"""
+
+    name = "fake"
+
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.transactions = []
+
+    def read_status(self):
+        return {"firewall_active": True, "blocked_ips": sorted(self.blocked)}
+
+    def block_many(self, ip_addresses):
+        self.transactions.append(("block", list(ip_addresses)))
+        self.blocked.update(ip_addresses)
+        return True, ""
+
+    def unblock_many(self, ip_addresses):
+        self.transactions.append(("unblock", list(ip_addresses)))
+        self.blocked.difference_update(ip_addresses)
+        return True, ""
+
+    def snapshot(self):
+        return {"iptables": "*filter\nCOMMIT\n"}
+
+    def lockdown(self, networks, replace=False):
+        self.transactions.append(("lockdown", list(networks), replace))
+        return True, ""
+
+    def release(self, snapshot=None):
+        self.transactions.append(("release", snapshot))
+        return True, ""
+
+
+@pytest.fixture
+def fake_firewall(monkeypatch):
+    """フェイクバックエンドとその状態キャッシュを差し替える"""
+    backend = FakeFirewallBackend(blocked=["1.2.3.4"])
+    monkeypatch.setattr(vps_monitor_api, "_firewall", backend)
+    monkeypatch.setattr(
+        vps_monitor_api,
+        "_firewall_state",
+        vps_monitor_api.FirewallStateCache(backend.read_status, reconcile_interval=3600),
+    )
+    return backend
+
+
+@pytest.mark.unit
+def test_batch_unblock_with_fake_backend(collector, fake_firewall, client):
+    """フェイクバックエンドで一括解除が1トランザクションになることをテスト"""
+    fake_firewall.blocked.add("5.6.7.8")
+    vps_monitor_api._firewall_state.load()
+
+    response = client.post(
+        "/api/unblock/batch",
+        json={"ip_addresses": ["1.2.3.4", "5.6.7.8", "9.9.9.9"]},
+        headers=AUTH_HEADERS,
+    )
+
+    assert response.status_code == 200
+    assert fake_firewall.transactions == [("unblock", ["1.2.3.4", "5.6.7.8"])]
+    assert fake_firewall.blocked == set()
+    assert vps_monitor_api._firewall_state.status()["rules_count"] == 0
+
+
+@pytest.mark.unit
+def test_single_block_uses_backend(collector, fake_firewall, client):
+    """単体ブロックが選択されたバックエンドを使うことをテスト"""
+    response = client.post("/api/block", json={"ip_address": "5.6.7.8"}, headers=AUTH_HEADERS)
+
+    assert response.get_json()["success"] is True
+    assert fake_firewall.transactions == [("block", ["5.6.7.8"])]
+
+
+@pytest.mark.unit
+def test_set_backends_apply_one_transaction(monkeypatch):
+    """ipset/nftablesバックエンドが1回のコマンドで一括適用することをテスト"""
+    calls = []
+
+    def fake_run_command(command, shell=False, input_text=None):
+        calls.append((command, input_text))
+        return "", "", 0
+
+    monkeypatch.setattr(vps_monitor_api, "run_command", fake_run_command)
+
+    vps_monitor_api.IpsetBackend("blk").block_many(["1.2.3.4", "5.6.7.8"])
+    vps_monitor_api.NftablesBackend("blk").unblock_many(["1.2.3.4", "5.6.7.8"])
+
+    assert calls == [
+        (["sudo", "ipset", "restore", "-exist"], "add blk 1.2.3.4\nadd blk 5.6.7.8\n"),
+        (["sudo", "nft", "-f", "-"], "delete element inet ha_monitor blk { 1.2.3.4, 5.6.7.8 }\n"),
+    ]
+
+
+@pytest.mark.unit
+def test_set_backends_read_status(monkeypatch):
+    """ipset/nftablesのセット要素を読み込めることをテスト"""
+    outputs = {
+        "ipset": "create blk hash:net family inet\nadd blk 1.2.3.4\nadd blk 10.0.0.0/24\n",
+        "nft": '{"nftables": [{"metainfo": {}}, {"set": {"name": "blk", "elem": '
+               '["1.2.3.4", {"prefix": {"addr": "10.0.0.0", "len": 24}}]}}]}',
+    }
+
+    def fake_run_command(command, shell=False, input_text=None):
+        return outputs.get(command[1], ""), "", 0
+
+    monkeypatch.setattr(vps_monitor_api, "run_command", fake_run_command)
+
+    for backend in (vps_monitor_api.IpsetBackend("blk"), vps_monitor_api.NftablesBackend("blk")):
+        assert backend.read_status()["blocked_ips"] == ["1.2.3.4", "10.0.0.0/24"]
+
+
+@pytest.mark.unit
+def test_create_firewall_backend():
+    """設定名からバックエンドを選択できることをテスト"""
+    assert isinstance(vps_monitor_api.create_firewall_backend("nftables"), vps_monitor_api.NftablesBackend)
+    with pytest.raises(ValueError):
+        vps_monitor_api.create_firewall_backend("pf")
+
+
+@pytest.mark.unit
+def test_snapshot_endpoint_combines_status_and_threats(collector, client):
+    """スナップショットが同一世代のステータスと脅威を返すことをテスト"""
+    health = client.get("/health").get_json()
+    assert "snapshot" in health["capabilities"]
+
+    body = client.get("/api/snapshot", headers=AUTH_HEADERS).get_json()
+
+    assert collector.calls == {"ufw": 1, "auth": 1}
+    assert body["generation"] == collector.get().generation
+    assert body["status"]["ssh_attacks_today"] == 120
+    assert body["threats"]["total_threats"] == 2
+    assert body["status"]["timestamp"] == body["threats"]["timestamp"]
+
+
+@pytest.mark.unit
+def test_threats_etag_not_modified(monkeypatch, collector, client):
+    """内容が同じ場合は304を返し、変わった場合は新しいETagを返すことをテスト"""
+    first = client.get("/api/threats", headers=AUTH_HEADERS)
+    etag = first.headers["ETag"]
+
+    collector.refresh()  # 内容は同じ（時刻のみ変化）
+    second = client.get("/api/threats", headers={**AUTH_HEADERS, "If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.data == b""
+
+    monkeypatch.setattr(vps_monitor_api, "parse_auth_log", lambda: {
+        "ssh_attacks_today": 1,
+        "vpn_attacks_today": 0,
+        "attack_ips": [{"ip_address": "1.1.1.1", "ssh_attempts": 1, "vpn_attempts": 0, "total_attempts": 1}],
+        "unique_attackers": 1,
+    })
+    collector.refresh()
+    third = client.get("/api/threats", headers={**AUTH_HEADERS, "If-None-Match": etag})
+    assert third.status_code == 200
+    assert third.headers["ETag"] != etag
+
+
+@pytest.mark.unit
+def test_status_etag_ignores_system_stats_noise(monkeypatch, collector, client):
+    """CPU使用率だけが変わった収集ではステータスとスナップショットが304になることをテスト"""
+    monkeypatch.setattr(vps_monitor_api, "SYSTEM_STATS_ETAG_INTERVAL", 10 ** 9)
+    collector.refresh()
+    status_etag = client.get("/api/status", headers=AUTH_HEADERS).headers["ETag"]
+    snapshot_etag = client.get("/api/snapshot", headers=AUTH_HEADERS).headers["ETag"]
+
+    monkeypatch.setattr(vps_monitor_api, "get_system_stats", lambda: {"cpu_usage": 87.0})
+    collector.refresh()
+    response = client.get("/api/status", headers={**AUTH_HEADERS, "If-None-Match": status_etag})
+    assert response.status_code == 304
+    response = client.get("/api/snapshot", headers={**AUTH_HEADERS, "If-None-Match": snapshot_etag})
+    assert response.status_code == 304
+
+    # 間隔が過ぎればシステム統計の変化も反映される
+    monkeypatch.setattr(vps_monitor_api, "SYSTEM_STATS_ETAG_INTERVAL", 1)
+    collector.refresh()
+    response = client.get("/api/status", headers={**AUTH_HEADERS, "If-None-Match": status_etag})
+    assert response.status_code == 200
+    assert response.get_json()["cpu_usage"] == 87.0
+
+
+def _threats(*records):
+    """ThreatChangeLog.update() 用の脅威データ"""
+    return {
+        "threat_level": "low",
+        "timestamp": "now",
+        "threat_list": [{"ip_address": ip, "attack_count": count} for ip, count in records],
+    }
+
+
+@pytest.mark.unit
+def test_threat_change_log_delta():
+    """カーソル以降の追加・変更・削除だけを返すことをテスト"""
+    changes = vps_monitor_api.ThreatChangeLog()
+    changes.update(1, _threats(("1.1.1.1", 5), ("2.2.2.2", 3)))
+    cursor = changes.cursor()
+
+    # 変化がなければカーソルは進まない
+    changes.update(2, _threats(("1.1.1.1", 5), ("2.2.2.2", 3)))
+    assert changes.cursor() == cursor
+    assert changes.delta(cursor)["upserts"] == []
+
+    changes.update(3, _threats(("1.1.1.1", 9), ("3.3.3.3", 1)))
+    delta = changes.delta(cursor)
+    assert delta["full"] is False
+    assert [t["ip_address"] for t in delta["upserts"]] == ["1.1.1.1", "3.3.3.3"]
+    assert delta["removed"] == ["2.2.2.2"]
+    assert delta["cursor"] != cursor
+
+    # 無効なカーソル（再起動前のもの等）は全件を返す
+    full = changes.delta("otherboot:1")
+    assert full["full"] is True
+    assert len(full["upserts"]) == 2
+
+
+@pytest.mark.unit
+def test_threat_change_log_expired_tombstones_force_full_resync():
+    """トゥームストーンが破棄されたカーソルでは全件を返すことをテスト"""
+    changes = vps_monitor_api.ThreatChangeLog(tombstone_limit=1)
+    changes.update(1, _threats(("1.1.1.1", 1), ("2.2.2.2", 1)))
+    cursor = changes.cursor()
+    changes.update(2, _threats(("2.2.2.2", 1)))
+    changes.update(3, _threats())
+
+    assert changes.delta(cursor)["full"] is True
+
+
+@pytest.mark.unit
+def test_snapshot_since_returns_threats_delta(collector, client):
+    """since を指定したスナップショットが脅威の差分を返すことをテスト"""
+    assert "threats_delta" in client.get("/health").get_json()["capabilities"]
+
+    first = client.get("/api/snapshot?since=", headers=AUTH_HEADERS).get_json()
+    delta = first["threats_delta"]
+    assert delta["full"] is True
+    assert len(delta["upserts"]) == 2
+    assert "threats" not in first
+
+    collector.refresh()
+    response = client.get(f"/api/threats/delta?since={delta['cursor']}", headers=AUTH_HEADERS)
+    second = response.get_json()
+    assert second["full"] is False
+    assert second["upserts"] == [] and second["removed"] == []
+    assert second["cursor"] == delta["cursor"]
+
+    not_modified = client.get(
+        f"/api/threats/delta?since={delta['cursor']}",
+        headers={**AUTH_HEADERS, "If-None-Match": response.headers["ETag"]},
+    )
+    assert not_modified.status_code == 304
+
+
+@pytest.mark.unit
+def test_event_bus_replays_after_last_event_id():
+    """再接続時に Last-Event-ID 以降のイベントが再送されることをテスト"""
+    bus = vps_monitor_api.EventBus(history_size=10)
+    first = bus.subscribe().queue
+    bus.publish("block", {"ip_address": "1.1.1.1"})
+    bus.publish("block", {"ip_address": "2.2.2.2"})
+    last_id = first.get_nowait().id
+
+    replayed = bus.subscribe(last_id).queue
+    bus.publish("unblock", {"ip_address": "3.3.3.3"})
+
+    assert [replayed.get_nowait().data["ip_address"] for _ in range(2)] == ["2.2.2.2", "3.3.3.3"]
+    # 別の起動のIDは再送しない
+    assert bus.subscribe("otherboot-1").queue.empty()
+
+
+@pytest.mark.unit
+def test_event_bus_replays_history_larger_than_queue():
+    """履歴がキューの上限より多くても、再接続時に全件再送できることをテスト"""
+    bus = vps_monitor_api.EventBus(history_size=50, max_queue=5)
+    first = bus.subscribe().queue
+    bus.publish("block", {"ip_address": "1.1.1.1"})
+    last_id = first.get_nowait().id
+    for i in range(40):
+        bus.publish("block", {"ip_address": f"10.0.0.{i}"})
+
+    subscription = bus.subscribe(last_id)
+    assert subscription.queue.qsize() == 40
+
+    # 再送分とは別に、通常の上限まで新しいイベントを受け取れる
+    for i in range(5):
+        bus.publish("unblock", {"ip_address": f"10.0.0.{i}"})
+    assert subscription.closed is False
+    assert subscription.queue.qsize() == 45
+
+
+@pytest.mark.unit
+def test_event_bus_drops_slow_subscriber():
+    """受信が追いつかない購読者が切断されることをテスト"""
+    bus = vps_monitor_api.EventBus(max_queue=1)
+    subscription = bus.subscribe()
+    bus.publish("block", {"ip_address": "1.1.1.1"})
+    bus.publish("block", {"ip_address": "2.2.2.2"})
+
+    assert subscription.closed is True
+
+
+@pytest.mark.unit
+def test_auth_log_watcher_publishes_new_attacks(monkeypatch, auth_log, collector):
+    """auth.logに追記された攻撃がイベントとして配信されることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4"))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    bus = vps_monitor_api.EventBus()
+    watcher = vps_monitor_api.AuthLogWatcher(tailer, bus)
+    tailer.poll()
+    tailer.take_changes()  # 起動時の集計分は配信しない
+
+    subscription = bus.subscribe()
+    assert watcher.check() == 0
+
+    with open(log_path, "a") as f:
+        f.write(_ssh_failure("1.2.3.4") + _ssh_failure("5.6.7.8"))
+    assert watcher.check() == 2
+
+    events = {}
+    for _ in range(2):
+        event = subscription.queue.get_nowait()
+        events[event.data["ip_address"]] = event
+    assert events["1.2.3.4"].type == "attack"
+    assert events["1.2.3.4"].data["threat"]["attack_count"] == 2
+    assert events["1.2.3.4"].data["threat"]["blocked"] is True
+    assert events["5.6.7.8"].data["ssh_attacks_today"] == 3
+
+
+@pytest.mark.unit
+def test_block_publishes_event(collector, fake_firewall, client, monkeypatch):
+    """ブロック成功時にイベントが配信されることをテスト"""
+    bus = vps_monitor_api.EventBus()
+    monkeypatch.setattr(vps_monitor_api, "_events", bus)
+    subscription = bus.subscribe()
+
+    client.post("/api/block", json={"ip_address": "9.9.9.9"}, headers=AUTH_HEADERS)
+
+    event = subscription.queue.get_nowait()
+    assert (event.type, event.data) == ("block", {"ip_address": "9.9.9.9"})
+
+
+@pytest.mark.unit
+def test_events_endpoint_streams_sse(collector, client, monkeypatch):
+    """イベントがServer-Sent Events形式で配信されることをテスト"""
+    bus = vps_monitor_api.EventBus()
+    monkeypatch.setattr(vps_monitor_api, "_events", bus)
+    bus.publish("block", {"ip_address": "1.1.1.1"})
+    bus.publish("unblock", {"ip_address": "1.1.1.1"})
+    first_id = f"{vps_monitor_api.BOOT_ID}-1"
+
+    response = client.get("/api/events", headers={**AUTH_HEADERS, "Last-Event-ID": first_id})
+    assert response.mimetype == "text/event-stream"
+
+    chunks = response.response
+    assert next(chunks).startswith(b": connected")
+    assert next(chunks) == (
+        f"id: {vps_monitor_api.BOOT_ID}-2\nevent: unblock\n"
+        'data: {"ip_address": "1.1.1.1"}\n\n'
+    ).encode()
+    response.close()
+
+
+@pytest.mark.unit
+def test_response_compressed_by_accept_encoding(monkeypatch, collector, client):
+    """Accept-Encoding に応じて圧縮し、弱いETagで304を返すことをテスト"""
+    monkeypatch.setattr(vps_monitor_api, "COMPRESS_MIN_SIZE", 0)
+    plain = client.get("/api/threats", headers=AUTH_HEADERS)
+
+    for encoding, decompress in (("gzip", gzip.decompress), ("deflate", zlib.decompress)):
+        response = client.get("/api/threats", headers={**AUTH_HEADERS, "Accept-Encoding": encoding})
+        assert response.headers["Content-Encoding"] == encoding
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert decompress(response.data) == plain.data
+
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+    not_modified = client.get(
+        "/api/threats",
+        headers={**AUTH_HEADERS, "Accept-Encoding": "gzip", "If-None-Match": etag},
+    )
+    assert not_modified.status_code == 304
+
+
+@pytest.mark.unit
+def test_small_or_unaccepted_responses_not_compressed(collector, client):
+    """小さなレスポンスや圧縮非対応のクライアントには圧縮しないことをテスト"""
+    small = client.get("/api/status", headers={**AUTH_HEADERS, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+    identity = client.get("/api/threats", headers={**AUTH_HEADERS, "Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in identity.headers
+    assert identity.get_json()["total_threats"] == 2
+
+
+@pytest.mark.unit
+def test_binary_format_negotiated_by_accept(collector, client):
+    """Accept に応じてmsgpack/CBORで返し、既定はJSONであることをテスト"""
+    default = client.get("/api/threats", headers={**AUTH_HEADERS, "Accept": "*/*"})
+    assert default.mimetype == "application/json"
+
+    for mimetype, module_name, decode in (
+        ("application/msgpack", "msgpack", lambda m, data: m.unpackb(data, raw=False)),
+        ("application/cbor", "cbor2", lambda m, data: m.loads(data)),
+    ):
+        module = pytest.importorskip(module_name)
+        response = client.get(
+            "/api/threats",
+            headers={**AUTH_HEADERS, "Accept": f"{mimetype}, application/json;q=0.9"},
+        )
+        assert response.mimetype == mimetype
+        assert decode(module, response.data) == default.get_json()
+        assert response.headers["ETag"] != default.headers["ETag"]
+
+        not_modified = client.get("/api/threats", headers={
+            **AUTH_HEADERS, "Accept": mimetype, "If-None-Match": response.headers["ETag"],
+        })
+        assert not_modified.status_code == 304
+
+
+def _threat_table(count):
+    """query_threats() 用の脅威データ（攻撃回数の降順）"""
+    now = vps_monitor_api.datetime(2026, 10, 18, 12, 0, 0)
+    attack_ips = [
+        {"ip_address": f"10.0.0.{i}", "ssh_attempts": count - i, "vpn_attempts": 0,
+         "total_attempts": count - i,
+         "last_seen": (now - vps_monitor_api.timedelta(minutes=i)).isoformat()}
+        for i in range(count)
+    ]
+    return vps_monitor_api.build_threats_payload(
+        now,
+        {"blocked_ips": ["10.0.0.0", "10.0.0.2"]},
+        {"ssh_attacks_today": 0, "vpn_attacks_today": 0, "attack_ips": attack_ips},
+    )
+
+
+@pytest.mark.unit
+def test_query_threats_paging_and_filters():
+    """ページング・絞り込み・フィールド選択をテスト"""
+    threats = _threat_table(120)
+
+    first = vps_monitor_api.query_threats(threats, {})
+    assert len(first["threat_list"]) == vps_monitor_api.THREATS_DEFAULT_LIMIT
+    assert first["total_threats"] == 120
+    assert first["next_offset"] == 50
+
+    last = vps_monitor_api.query_threats(threats, {"limit": "50", "offset": "100"})
+    assert [t["ip_address"] for t in last["threat_list"]][:1] == ["10.0.0.100"]
+    assert last["next_offset"] is None
+
+    critical = vps_monitor_api.query_threats(threats, {"min_level": "critical"})
+    assert critical["matched"] == 21  # 攻撃回数 120..100
+
+    blocked = vps_monitor_api.query_threats(threats, {"blocked": "true", "fields": "ip_address"})
+    assert blocked["threat_list"] == [{"ip_address": "10.0.0.0"}, {"ip_address": "10.0.0.2"}]
+
+    recent = vps_monitor_api.query_threats(threats, {"since": "2026-10-18T11:58:00"})
+    assert recent["matched"] == 3
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("args", [
+    {"limit": "0"},
+    {"limit": "abc"},
+    {"offset": "-1"},
+    {"min_level": "severe"},
+    {"blocked": "maybe"},
+    {"since": "yesterday"},
+    {"fields": "ip_address,password"},
+])
+def test_query_threats_rejects_invalid_params(args):
+    """不正なパラメータでValueErrorになることをテスト"""
+    with pytest.raises(ValueError):
+        vps_monitor_api.query_threats(_threat_table(3), args)
+
+
+@pytest.mark.unit
+def test_threats_endpoint_query_params(collector, client):
+    """/api/threats がクエリパラメータを適用することをテスト"""
+    body = client.get("/api/threats?blocked=false&fields=ip_address,attack_count",
+                      headers=AUTH_HEADERS).get_json()
+    assert body["threat_list"] == [{"ip_address": "5.6.7.8", "attack_count": 20}]
+    assert body["total_threats"] == 2
+
+    assert client.get("/api/threats?limit=0", headers=AUTH_HEADERS).status_code == 400
+
+    response = client.get("/api/threats?offset=-1", headers=AUTH_HEADERS)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "offset must be >= 0"
+
+
+@pytest.mark.unit
+def test_tailer_stats_not_capped(auth_log):
+    """攻撃IPが50件を超えても全件集計されることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text("".join(_ssh_failure(f"10.0.1.{i}") for i in range(80)))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    assert len(tailer.stats()["attack_ips"]) == 80
+
+
+class FakeGeoReader:
+    """maxminddb.Reader の代わりに辞書から検索するリーダー"""
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def get(self, ip):
+        self.queries.append(ip)
+        return self.records.get(ip)
+
+
+def _geo_resolver(cache_size=100):
+    """フェイクのデータベースを使うGeoIPResolver"""
+    resolver = vps_monitor_api.GeoIPResolver(country_db=None, asn_db=None, cache_size=cache_size)
+    resolver._country_reader = FakeGeoReader({
+        "1.1.1.1": {"country": {"iso_code": "AU", "names": {"en": "Australia"}}},
+        "2.2.2.2": {"registered_country": {"iso_code": "FR", "names": {"en": "France"}}},
+    })
+    resolver._asn_reader = FakeGeoReader({
+        "1.1.1.1": {"autonomous_system_number": 13335, "autonomous_system_organization": "CLOUDFLARENET"},
+    })
+    return resolver
+
+
+@pytest.mark.unit
+def test_geoip_resolver_lru_cache():
+    """GeoIP検索結果がLRUキャッシュされ、上限で古いものから破棄されることをテスト"""
+    resolver = _geo_resolver(cache_size=2)
+
+    geo = resolver.lookup_many(["1.1.1.1", "2.2.2.2", "3.3.3.3"])
+    assert geo["1.1.1.1"] == {"country": "Australia", "country_code": "AU",
+                              "asn": 13335, "isp": "CLOUDFLARENET"}
+    assert geo["2.2.2.2"]["country"] == "France"
+    assert geo["3.3.3.3"]["country"] == "Unknown"
+
+    # 1.1.1.1 は上限を超えて破棄済み、3.3.3.3 はキャッシュから返る
+    resolver.lookup_many(["3.3.3.3", "1.1.1.1"])
+    assert resolver._country_reader.queries == ["1.1.1.1", "2.2.2.2", "3.3.3.3", "1.1.1.1"]
+    assert (resolver.hits, resolver.misses) == (1, 4)
+
+
+@pytest.mark.unit
+def test_geoip_resolver_without_database():
+    """データベースがない場合は 'Unknown' を返すことをテスト"""
+    resolver = vps_monitor_api.GeoIPResolver(country_db="/nonexistent.mmdb", asn_db=None)
+    assert resolver.available is False
+    assert resolver.lookup("1.1.1.1") == vps_monitor_api.UNKNOWN_GEO
+    # maxminddb の有無で理由が変わる
+    assert resolver.unavailable_reason() is not None
+
+
+@pytest.mark.unit
+def test_start_agent_warns_once_without_geoip(monkeypatch, caplog, fake_firewall):
+    """GeoIPを利用できない場合、起動時に1回だけ警告することをテスト"""
+
+    class FakeWorker:
+        def start(self):
+            pass
+
+    monkeypatch.setattr(vps_monitor_api, "maxminddb", None)
+    monkeypatch.setattr(vps_monitor_api, "_geoip", vps_monitor_api.GeoIPResolver())
+    monkeypatch.setattr(vps_monitor_api, "_agent_started", False)
+    for name in ("_collector", "_auth_watcher", "_block_expiry"):
+        monkeypatch.setattr(vps_monitor_api, name, FakeWorker())
+    monkeypatch.setattr(vps_monitor_api, "WHITELIST_FILE", os.devnull)
+
+    with caplog.at_level("WARNING", logger="vps_monitor_api"):
+        vps_monitor_api.start_agent()
+        vps_monitor_api.start_agent()
+
+    warnings = [r.getMessage() for r in caplog.records if "maxminddb" in r.getMessage()]
+    assert len(warnings) == 1
+
+
+@pytest.mark.unit
+def test_country_aggregator_incremental():
+    """国別統計が新しいIPと攻撃回数の増分で更新されることをテスト"""
+    geo = {"1.1.1.1": {"country": "Australia"}, "2.2.2.2": {"country": "France"},
+           "3.3.3.3": {"country": "France"}}
+    aggregator = vps_monitor_api.CountryAggregator()
+
+    def attacks(*counts):
+        return [{"ip_address": ip, "total_attempts": n} for ip, n in counts]
+
+    aggregator.update(attacks(("1.1.1.1", 5), ("2.2.2.2", 1)), geo)
+    aggregator.update(attacks(("1.1.1.1", 7), ("2.2.2.2", 1), ("3.3.3.3", 4)), geo)
+    assert aggregator.top() == [
+        {"country": "France", "count": 2, "attacks": 5},
+        {"country": "Australia", "count": 1, "attacks": 7},
+    ]
+
+    # 日付が変わってIPが減った場合は作り直す
+    aggregator.update(attacks(("3.3.3.3", 1)), geo)
+    assert aggregator.top() == [{"country": "France", "count": 1, "attacks": 1}]
+
+    # IP数が減らなくても、消えたIPの分は残さない
+    aggregator.update(attacks(("1.1.1.1", 50)), geo)
+    assert aggregator.top() == [{"country": "Australia", "count": 1, "attacks": 50}]
+    aggregator.update(attacks(("2.2.2.2", 3)), geo)
+    assert aggregator.top() == [{"country": "France", "count": 1, "attacks": 3}]
+
+
+@pytest.mark.unit
+def test_snapshot_enriched_with_geoip(monkeypatch, collector):
+    """スナップショットの脅威レコードと国別統計にGeoIP情報が入ることをテスト"""
+    resolver = _geo_resolver()
+    resolver._country_reader.records["1.2.3.4"] = {"country": {"iso_code": "JP", "names": {"en": "Japan"}}}
+    monkeypatch.setattr(vps_monitor_api, "_geoip", resolver)
+
+    threats = collector.refresh().threats
+
+    assert threats["threat_list"][0]["country"] == "Japan"
+    assert threats["threat_list"][0]["country_code"] == "JP"
+    assert threats["top_attack_countries"][0] == {"country": "Japan", "count": 1, "attacks": 100}
+
+    collector.refresh()
+    # 同じIPはキャッシュから解決される
+    assert resolver._country_reader.queries == ["1.2.3.4", "5.6.7.8"]
+
+
+@pytest.mark.unit
+def test_history_store_records_batches_idempotently(auth_log, tmp_path):
+    """履歴がまとめて書き込まれ、読み直しても回数が重複しないことをテスト"""
+    log_path, state_path = auth_log
+    today = vps_monitor_api.datetime.now().strftime("%Y-%m-%d")
+    log_path.write_text(
+        f"{today}T09:00:00.000000+09:00 vps sshd[1]: Failed password for root from 1.2.3.4 port 22 ssh2\n"
+        f"{today}T09:30:00.000000+09:00 vps sshd[1]: Failed password for root from 1.2.3.4 port 22 ssh2\n"
+    )
+    history = vps_monitor_api.AttackHistoryStore(str(tmp_path / "history.db"))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path), history=history)
+    tailer.poll()
+
+    # 状態ファイルを失って先頭から読み直しても回数は2のまま
+    os.remove(state_path)
+    vps_monitor_api.AuthLogTailer(str(log_path), str(state_path), history=history).poll()
+
+    record = history.ip_history("1.2.3.4")
+    assert record["first_seen"] == f"{today}T09:00:00"
+    assert record["last_seen"] == f"{today}T09:30:00"
+    assert record["daily"] == [{"date": today, "ssh": 2, "vpn": 0}]
+    assert history.ip_history("5.6.7.8") is None
+
+
+@pytest.mark.unit
+def test_history_store_keeps_past_days_and_prunes(tmp_path):
+    """過去の日の履歴が残り、保持期間を過ぎたものは削除されることをテスト"""
+    history = vps_monitor_api.AttackHistoryStore(str(tmp_path / "history.db"), retention_days=30)
+    today = vps_monitor_api.datetime.now().date()
+    old = (today - vps_monitor_api.timedelta(days=40)).isoformat()
+    recent = (today - vps_monitor_api.timedelta(days=3)).isoformat()
+
+    history.write([
+        ("1.2.3.4", old, "ssh", 9, f"{old}T01:00:00", f"{old}T02:00:00"),
+        ("1.2.3.4", recent, "vpn", 4, f"{recent}T05:00:00", f"{recent}T06:00:00"),
+    ])
+
+    record = history.ip_history("1.2.3.4")
+    assert record["daily"] == [{"date": recent, "ssh": 0, "vpn": 4}]
+    assert record["first_seen"] == f"{recent}T05:00:00"
+
+
+@pytest.mark.unit
+def test_ip_info_uses_history(monkeypatch, collector, client, auth_log, tmp_path):
+    """/api/ip_info が履歴ストアの初回/最終検出時刻を返すことをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4"))
+    history = vps_monitor_api.AttackHistoryStore(str(tmp_path / "history.db"))
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path), history=history)
+    tailer.poll()
+    monkeypatch.setattr(vps_monitor_api, "_history", history)
+    monkeypatch.setattr(vps_monitor_api, "_auth_tailer", tailer)
+
+    body = client.post("/api/ip_info", json={"ip_address": "1.2.3.4"}, headers=AUTH_HEADERS).get_json()
+    assert body["found"] is True
+    assert body["total_attacks"] == 1
+    assert body["first_seen"].endswith("T10:00:00")
+    assert body["daily_counts"][0]["ssh"] == 1
+    assert body["blocked"] is True
+
+    missing = client.post("/api/ip_info", json={"ip_address": "9.9.9.9"}, headers=AUTH_HEADERS).get_json()
+    assert missing["found"] is False
+
+
+@pytest.mark.unit
+def test_trend_ring_buckets_and_expiry():
+    """リングバッファがバケットごとに集計し、古いバケットを捨てることをテスト"""
+    ring = vps_monitor_api.TrendRing(width=60, size=3)
+    base = 1_000_000 * 60
+
+    ring.add(base, "ssh")
+    ring.add(base + 30, "vpn")
+    ring.add(base + 60, "ssh")
+    ring.add(base + 180, "ssh")   # base のスロットを再利用
+    ring.add(base - 60, "ssh")    # 範囲外（古い）
+
+    series = ring.series(base + 180)
+    assert [(b["ssh"], b["vpn"]) for b in series] == [(1, 0), (0, 0), (1, 0)]
+
+
+@pytest.mark.unit
+def test_attack_trend_survives_restart(auth_log):
+    """攻撃トレンドが状態ファイルから復元されることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 2)
+    now = vps_monitor_api.datetime.combine(
+        vps_monitor_api.datetime.now().date(), vps_monitor_api.datetime.min.time()
+    ).replace(hour=10, minute=30).timestamp()
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+    assert tailer.trend_series("hour", now)[-1]["ssh"] == 2
+    assert len(tailer.stats()["attack_trend"]) == vps_monitor_api.TREND_HOURS
+
+    restored = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    assert restored.trend_series("hour", now)[-1]["ssh"] == 2
+    assert restored.trend_series("minute", now)[-31]["ssh"] == 2
+
+
+@pytest.mark.unit
+def test_unidentified_rotation_keeps_trend(auth_log):
+    """前回のファイルを特定できないローテーションでも、保存済みのトレンドを失わないことをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("1.2.3.4") * 2)
+    now = vps_monitor_api.datetime.combine(
+        vps_monitor_api.datetime.now().date(), vps_monitor_api.datetime.min.time()
+    ).replace(hour=10, minute=30).timestamp()
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+
+    # 前回のファイルが消えた状態でローテーション（別inodeの新しいファイル）
+    new_path = log_path.with_name("auth.log.new")
+    new_path.write_text(_ssh_failure("5.6.7.8"))
+    os.replace(new_path, log_path)
+    tailer.poll()
+
+    assert tailer.ip_stats("1.2.3.4")["total_attempts"] == 0
+    assert tailer.ip_stats("5.6.7.8")["total_attempts"] == 1
+    assert tailer.trend_series("hour", now)[-1]["ssh"] == 3
+
+
+@pytest.mark.unit
+def test_trend_endpoint(client):
+    """/api/trend が解像度ごとのバケットを返すことをテスト"""
+    body = client.get("/api/trend?resolution=minute", headers=AUTH_HEADERS).get_json()
+    assert len(body["buckets"]) == vps_monitor_api.TREND_MINUTES
+    assert client.get("/api/trend?resolution=day", headers=AUTH_HEADERS).status_code == 400
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("line, expected", [
+    ("2025-11-13T05:56:27.584544+09:00 vps sshd[1]: x", (2025, 11, 13, 5, 56, 27)),
+    ("Nov 13 10:30:45 vps sshd[1]: x", (2026, 11, 13, 10, 30, 45)),
+    ("Feb  3 01:02:03 vps sshd[1]: x", (2026, 2, 3, 1, 2, 3)),
+    # 年明けに読んだ年末のログは前年
+    ("Dec 31 23:59:59 vps sshd[1]: x", (2025, 12, 31, 23, 59, 59)),
+    ("garbage", None),
+    ("Foo 13 10:30:45 vps", None),
+])
+def test_parse_log_time(line, expected):
+    """ISO 8601と旧syslog形式の時刻を切り出しで解析できることをテスト"""
+    now = vps_monitor_api.datetime(2026, 1, 1, 0, 5) if line.startswith("Dec") else \
+        vps_monitor_api.datetime(2026, 11, 14)
+    parsed = vps_monitor_api.parse_log_time(line, now)
+    assert (parsed and parsed.timetuple()[:6]) == expected
+
+
+@pytest.mark.unit
+def test_tailer_tracks_first_and_last_attack_time(auth_log):
+    """IPごとの初回/最終攻撃時刻がログの時刻から記録・復元されることをテスト"""
+    log_path, state_path = auth_log
+    today = vps_monitor_api.datetime.now().strftime("%Y-%m-%d")
+    log_path.write_text("".join(
+        f"{today}T{t}.000000+09:00 vps sshd[1]: Failed password for root from 1.2.3.4 port 22 ssh2\n"
+        for t in ("08:00:00", "08:15:30", "09:45:10")
+    ))
+
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+    attack = tailer.stats()["attack_ips"][0]
+    assert attack["first_seen"] == f"{today}T08:00:00"
+    assert attack["last_seen"] == f"{today}T09:45:10"
+
+    restored = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    assert restored.ip_stats("1.2.3.4")["last_seen"] == f"{today}T09:45:10"
+
+
+@pytest.mark.unit
+def test_threats_report_real_attack_times(collector, client):
+    """/api/threats が実際の初回/最終攻撃時刻を返すことをテスト"""
+    threats = client.get("/api/threats", headers=AUTH_HEADERS).get_json()
+
+    assert threats["threat_list"][0]["first_attack_time"] == "2026-10-18T01:00:00"
+    assert threats["threat_list"][0]["last_attack_time"] == "2026-10-18T09:00:00"
+
+
+@pytest.mark.unit
+def test_create_app_starts_agent_once(monkeypatch, fake_firewall):
+    """create_app()を何度呼んでもバックグラウンド処理の開始が1回だけであることをテスト"""
+    started = []
+
+    class FakeWorker:
+        def __init__(self, name):
+            self.name = name
+
+        def start(self):
+            started.append(self.name)
+
+    monkeypatch.setattr(vps_monitor_api, "_agent_started", False)
+    monkeypatch.setattr(vps_monitor_api, "_collector", FakeWorker("collector"))
+    monkeypatch.setattr(vps_monitor_api, "_auth_watcher", FakeWorker("watcher"))
+    monkeypatch.setattr(vps_monitor_api, "WHITELIST_FILE", os.devnull)
+
+    assert vps_monitor_api.create_app() is vps_monitor_api.app
+    assert vps_monitor_api.create_app() is vps_monitor_api.app
+    assert started == ["collector", "watcher"]
+
+
+@pytest.mark.unit
+def test_whitelist_cidr_and_ipv6(tmp_path):
+    """CIDR・IPv6のエントリで包含判定でき、ファイルが重複なく書き換わることをテスト"""
+    path = tmp_path / "whitelist.conf"
+    path.write_text("# 自宅\n192.168.1.10\n10.0.0.0/8\n10.0.0.0/8\nnot-an-ip\n")
+    whitelist = vps_monitor_api.Whitelist(str(path))
+
+    assert whitelist.entries() == ["192.168.1.10", "10.0.0.0/8"]
+    assert whitelist.match("10.20.30.40") == "10.0.0.0/8"
+    assert whitelist.contains("192.168.1.10")
+    assert not whitelist.contains("192.168.1.11")
+    assert not whitelist.contains("invalid")
+
+    assert whitelist.add("2001:db8::1/32") == ("2001:db8::/32", True)
+    assert whitelist.add("2001:db8::/32") == ("2001:db8::/32", False)
+    assert whitelist.add("192.168.1.10/32") == ("192.168.1.10", False)
+    assert whitelist.match("2001:db8:ffff::1") == "2001:db8::/32"
+    assert not whitelist.contains("2001:db9::1")
+
+    assert whitelist.remove("10.1.2.3/8") == ("10.0.0.0/8", True)
+    assert not whitelist.contains("10.20.30.40")
+    assert path.read_text() == "192.168.1.10\n2001:db8::/32\n"
+
+    with pytest.raises(ValueError):
+        whitelist.add("300.1.1.1")
+
+
+@pytest.mark.unit
+def test_block_refuses_whitelisted(monkeypatch, tmp_path, collector, fake_firewall, client):
+    """ホワイトリストのIPはブロックもバッチブロックもされないことをテスト"""
+    whitelist = vps_monitor_api.Whitelist(str(tmp_path / "whitelist.conf"))
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", whitelist)
+
+    response = client.post("/api/whitelist", json={"ip_address": "203.0.113.0/24"}, headers=AUTH_HEADERS)
+    assert response.get_json()["changed"] is True
+    response = client.post("/api/whitelist", json={"ip_address": "203.0.113.0/24"}, headers=AUTH_HEADERS)
+    assert response.get_json()["changed"] is False
+    response = client.post("/api/whitelist", json={"ip_address": "bogus"}, headers=AUTH_HEADERS)
+    assert response.status_code == 400
+
+    response = client.post("/api/block", json={"ip_address": "203.0.113.7"}, headers=AUTH_HEADERS)
+    assert response.status_code == 403
+    assert response.get_json()["whitelisted_by"] == "203.0.113.0/24"
+
+    response = client.post(
+        "/api/block/batch",
+        json={"ip_addresses": ["203.0.113.8", "5.6.7.8"]},
+        headers=AUTH_HEADERS,
+    )
+    statuses = {r["ip_address"]: r["status"] for r in response.get_json()["results"]}
+    assert statuses == {"203.0.113.8": "whitelisted", "5.6.7.8": "blocked"}
+    assert fake_firewall.transactions == [("block", ["5.6.7.8"])]
+
+    response = client.get("/api/whitelist", headers=AUTH_HEADERS)
+    assert response.get_json()["whitelist"] == ["203.0.113.0/24"]
+
+
+@pytest.mark.unit
+def test_plan_aggregation_collapses_dense_subnets(tmp_path):
+    """密集したサブネットがCIDRにまとめられ、ホワイトリストと重なるものは除外されることをテスト"""
+    whitelist = vps_monitor_api.Whitelist(str(tmp_path / "whitelist.conf"))
+    whitelist.add("198.51.100.200")
+
+    blocked = [f"203.0.113.{i}" for i in range(1, 7)]          # 6件ブロック済み
+    blocked += [f"203.0.112.{i}" for i in range(1, 11)]        # 隣接する/24
+    blocked += [f"198.51.100.{i}" for i in range(1, 11)]       # ホワイトリストと重なる
+    blocked += ["192.0.2.1", "10.9.0.0/16"]
+    attacking = [f"203.0.113.{i}" for i in range(50, 54)]     # 攻撃中で合計10件
+
+    plan = vps_monitor_api.plan_aggregation(
+        blocked, attacking, whitelist, prefixlen=24, min_hosts=10, min_blocked=5
+    )
+
+    assert plan["add"] == ["203.0.112.0/23"]
+    assert sorted(plan["remove"]) == sorted(blocked[:16])
+    clusters = {c["network"]: c for c in plan["clusters"]}
+    assert clusters["203.0.113.0/24"]["attacking"] == 4
+    assert clusters["198.51.100.0/24"]["whitelisted"] is True
+
+    sparse = vps_monitor_api.plan_aggregation(blocked[:6], [], whitelist, min_hosts=10, min_blocked=5)
+    assert sparse["add"] == [] and sparse["remove"] == []
+
+
+@pytest.mark.unit
+def test_aggregate_endpoint_applies_plan(monkeypatch, tmp_path, collector, fake_firewall, client):
+    """集約の適用でルールが置き換わり、サブネット内のIPがブロック済みと表示されることをテスト"""
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", vps_monitor_api.Whitelist(str(tmp_path / "wl.conf")))
+    monkeypatch.setattr(vps_monitor_api, "_aggregator", vps_monitor_api.SubnetAggregator(mode="propose"))
+    fake_firewall.blocked.update(f"1.2.3.{i}" for i in range(10, 20))
+    vps_monitor_api._firewall_state.load()
+
+    response = client.get("/api/aggregate", headers=AUTH_HEADERS)
+    plan = response.get_json()
+    assert plan["add"] == ["1.2.3.0/24"]
+    assert fake_firewall.transactions == []
+
+    response = client.post("/api/aggregate", json={}, headers=AUTH_HEADERS)
+    assert response.get_json()["success"] is True
+    assert fake_firewall.blocked == {"1.2.3.0/24"}
+    assert vps_monitor_api._firewall_state.is_covered("1.2.3.200")
+    assert not vps_monitor_api._firewall_state.is_blocked("1.2.3.4")
+
+    threats = vps_monitor_api._collector.refresh().threats
+    assert {t["ip_address"]: t["blocked"] for t in threats["threat_list"]} == {
+        "1.2.3.4": True, "5.6.7.8": False
+    }
+
+
+@pytest.mark.unit
+def test_aggregate_retires_rules_inside_existing_cidr(monkeypatch, tmp_path, collector, fake_firewall, client):
+    """既存の /24 に含まれる個別ルールが、追加なしの集約案でも削除されることをテスト"""
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", vps_monitor_api.Whitelist(str(tmp_path / "wl.conf")))
+    monkeypatch.setattr(vps_monitor_api, "_aggregator", vps_monitor_api.SubnetAggregator(mode="propose"))
+    leftovers = {f"1.2.3.{i}" for i in range(10, 20)}
+    fake_firewall.blocked = {"1.2.3.0/24"} | leftovers
+    vps_monitor_api._firewall_state.load()
+    triggered = []
+    monkeypatch.setattr(collector, "trigger", lambda: triggered.append(True))
+
+    response = client.post("/api/aggregate", json={}, headers=AUTH_HEADERS)
+    body = response.get_json()
+    assert body["success"] is True
+    assert body["add"] == []
+    assert set(body["remove"]) == leftovers
+    assert [(action, set(ips)) for action, ips in fake_firewall.transactions] == [("unblock", leftovers)]
+    assert fake_firewall.blocked == {"1.2.3.0/24"}
+    assert not vps_monitor_api._firewall_state.is_blocked("1.2.3.10")
+    assert vps_monitor_api._firewall_state.is_covered("1.2.3.10")
+    assert triggered
+
+
+@pytest.mark.unit
+def test_auto_blocker_sliding_window(tmp_path):
+    """時間窓内にしきい値回数の攻撃があったIPだけが検出されることをテスト"""
+    blocker = vps_monitor_api.AutoBlocker(max_retry=3, window=60, state_path=str(tmp_path / "ab.json"))
+    base = vps_monitor_api.datetime(2026, 10, 18, 10, 0, 0)
+    now = base.timestamp() + 300
+
+    def event(ip, seconds, kind="ssh"):
+        return vps_monitor_api.AuthEvent(base + vps_monitor_api.timedelta(seconds=seconds), kind, ip)
+
+    # 間隔が広いIPは検出されない
+    for seconds in (0, 100, 200):
+        blocker.observe(event("5.6.7.8", seconds), now=now)
+    # 時間窓より古いイベントは無視される
+    blocker.observe(event("9.9.9.9", -1000), now=now)
+
+    blocker.observe(event("1.2.3.4", 250), now=now)
+    blocker.observe(event("1.2.3.4", 260, "vpn"), now=now)
+    assert blocker._pending == {}
+    blocker.observe(event("1.2.3.4", 270), now=now)
+
+    assert list(blocker._pending) == ["1.2.3.4"]
+    reason = blocker._pending["1.2.3.4"]
+    assert (reason["attempts"], reason["ssh_attempts"], reason["vpn_attempts"]) == (3, 2, 1)
+    assert "1.2.3.4" not in blocker._recent
+    assert "9.9.9.9" not in blocker._recent
+
+
+@pytest.mark.unit
+def test_auth_log_watcher_auto_blocks(monkeypatch, tmp_path, auth_log, collector, fake_firewall):
+    """しきい値を超えたIPが監視スレッドの1回の確認でブロックされることをテスト"""
+    whitelist = vps_monitor_api.Whitelist(str(tmp_path / "whitelist.conf"))
+    whitelist.add("10.0.0.0/8")
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", whitelist)
+
+    log_path, state_path = auth_log
+    log_path.write_text("")
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    blocker = vps_monitor_api.AutoBlocker(max_retry=3, window=2 * 86400, state_path=str(tmp_path / "ab.json"))
+    monkeypatch.setattr(vps_monitor_api, "_auto_blocker", blocker)
+    tailer.listeners.append(blocker.observe)
+    bus = vps_monitor_api.EventBus()
+    monkeypatch.setattr(vps_monitor_api, "_events", bus)
+    watcher = vps_monitor_api.AuthLogWatcher(tailer, bus, blocker=blocker)
+    tailer.poll()
+
+    subscription = bus.subscribe()
+    with open(log_path, "a") as f:
+        f.write(_ssh_failure("203.0.113.5") * 3 + _ssh_failure("10.1.2.3") * 3 + _ssh_failure("5.6.7.8"))
+    watcher.check()
+
+    assert fake_firewall.transactions == [("block", ["203.0.113.5"])]
+    assert blocker.reason("203.0.113.5")["attempts"] == 3
+    assert blocker.reason("10.1.2.3") is None
+
+    events = [subscription.queue.get_nowait() for _ in range(4)]
+    assert events[0].type == "block"
+    assert events[0].data["reason"]["rule"] == "3 failures within 172800s"
+    threats = {e.data["ip_address"]: e.data["threat"] for e in events[1:]}
+    assert threats["203.0.113.5"]["blocked"] is True
+
+    # 状態ファイルから理由が復元され、解除で削除される
+    restored = vps_monitor_api.AutoBlocker(max_retry=3, state_path=str(tmp_path / "ab.json"))
+    assert restored.reason("203.0.113.5")["ssh_attempts"] == 3
+    blocker.forget(["203.0.113.5"])
+    assert vps_monitor_api.AutoBlocker(max_retry=3, state_path=str(tmp_path / "ab.json")).reasons == {}
+
+
+@pytest.mark.unit
+def test_block_expiry_batches_and_survives_restart(monkeypatch, tmp_path, collector, fake_firewall):
+    """期限が重なるブロックが1回で解除され、予定が再起動後も引き継がれることをテスト"""
+    state_path = str(tmp_path / "block_expiry.json")
+    scheduler = vps_monitor_api.BlockExpiryScheduler(state_path, batch_window=1)
+    monkeypatch.setattr(vps_monitor_api, "_block_expiry", scheduler)
+    fake_firewall.blocked.update(["5.6.7.8", "9.9.9.9", "8.8.4.4"])
+    vps_monitor_api._firewall_state.load()
+
+    scheduler.schedule(["5.6.7.8"], 60, now=1000)
+    scheduler.schedule(["9.9.9.9"], 60.5, now=1000)
+    scheduler.schedule(["8.8.4.4"], 600, now=1000)
+    scheduler.schedule(["1.2.3.4"], 60, now=1000)
+    scheduler.cancel(["1.2.3.4"])  # 無期限に変更
+    assert scheduler.remaining("9.9.9.9", now=1030) == 30
+
+    restored = vps_monitor_api.BlockExpiryScheduler(state_path, batch_window=1)
+    monkeypatch.setattr(vps_monitor_api, "_block_expiry", restored)
+    assert restored.expire(now=1050) == []
+    assert sorted(restored.expire(now=1060)) == ["5.6.7.8", "9.9.9.9"]
+
+    assert fake_firewall.transactions == [("unblock", ["5.6.7.8", "9.9.9.9"])]
+    assert fake_firewall.blocked == {"1.2.3.4", "8.8.4.4"}
+    assert restored.expiries() == {"8.8.4.4": 1600}
+    assert vps_monitor_api.BlockExpiryScheduler(state_path).expiries() == {"8.8.4.4": 1600}
+
+
+@pytest.mark.unit
+def test_block_expiry_retries_after_backend_error(monkeypatch, tmp_path, collector, fake_firewall):
+    """解除中にバックエンドが例外を出しても、予定が失われず間隔を延ばして再試行されることをテスト"""
+    fake_firewall.blocked.add("5.6.7.8")
+    vps_monitor_api._firewall_state.load()
+    scheduler = vps_monitor_api.BlockExpiryScheduler(str(tmp_path / "block_expiry.json"), batch_window=0)
+    monkeypatch.setattr(vps_monitor_api, "_block_expiry", scheduler)
+    scheduler.schedule(["5.6.7.8"], 60, now=1000)
+
+    def broken_unblock_many(ip_addresses):
+        raise subprocess.TimeoutExpired("ufw reload", 30)
+
+    monkeypatch.setattr(fake_firewall, "unblock_many", broken_unblock_many)
+    assert scheduler.expire(now=1060) == []
+    assert scheduler.expiries() == {"5.6.7.8": 1120}
+    assert scheduler.expire(now=1120) == []
+    assert scheduler.expiries() == {"5.6.7.8": 1240}
+
+    monkeypatch.setattr(fake_firewall, "unblock_many", FakeFirewallBackend.unblock_many.__get__(fake_firewall))
+    assert scheduler.expire(now=1240) == ["5.6.7.8"]
+    assert scheduler.expiries() == {}
+    assert "5.6.7.8" not in fake_firewall.blocked
+
+
+@pytest.mark.unit
+def test_block_with_duration_reports_ttl(monkeypatch, tmp_path, auth_log, collector, fake_firewall, client):
+    """期限付きブロックの残り時間が脅威リストとIP情報に含まれることをテスト"""
+    log_path, state_path = auth_log
+    log_path.write_text(_ssh_failure("5.6.7.8"))
+    tailer = vps_monitor_api.AuthLogTailer(str(log_path), str(state_path))
+    tailer.poll()
+    monkeypatch.setattr(vps_monitor_api, "_auth_tailer", tailer)
+    monkeypatch.setattr(vps_monitor_api, "_history", vps_monitor_api.AttackHistoryStore(str(tmp_path / "h.db")))
+    scheduler = vps_monitor_api.BlockExpiryScheduler(str(tmp_path / "block_expiry.json"))
+    monkeypatch.setattr(vps_monitor_api, "_block_expiry", scheduler)
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", vps_monitor_api.Whitelist(str(tmp_path / "wl.conf")))
+
+    response = client.post("/api/block", json={"ip_address": "5.6.7.8", "duration": "soon"}, headers=AUTH_HEADERS)
+    assert response.status_code == 400
+
+    response = client.post("/api/block", json={"ip_address": "5.6.7.8", "duration": 3600}, headers=AUTH_HEADERS)
+    assert response.get_json()["expires_at"] is not None
+
+    collector.refresh()
+    body = client.get("/api/threats", headers=AUTH_HEADERS).get_json()
+    threats = {t["ip_address"]: t for t in body["threat_list"]}
+    assert threats["5.6.7.8"]["block_expires_at"] is not None
+    assert 3590 <= threats["5.6.7.8"]["block_ttl"] <= 3600
+    assert threats["1.2.3.4"]["block_ttl"] is None
+
+    response = client.post("/api/ip_info", json={"ip_address": "5.6.7.8"}, headers=AUTH_HEADERS)
+    assert 3590 <= response.get_json()["block_ttl"] <= 3600
+
+    client.post("/api/unblock", json={"ip_address": "5.6.7.8"}, headers=AUTH_HEADERS)
+    assert scheduler.expiries() == {}
+
+
+@pytest.mark.unit
+def test_timed_block_keeps_etag_and_cursor_stable(monkeypatch, tmp_path, collector, client):
+    """期限付きブロックがあっても、残り時間の変化だけではETagとカーソルが変わらないことをテスト"""
+    scheduler = vps_monitor_api.BlockExpiryScheduler(str(tmp_path / "block_expiry.json"))
+    monkeypatch.setattr(vps_monitor_api, "_block_expiry", scheduler)
+    scheduler.schedule(["1.2.3.4"], 3600)
+    # システム統計のETag更新間隔をまたがないようにする
+    monkeypatch.setattr(vps_monitor_api, "SYSTEM_STATS_ETAG_INTERVAL", 10 ** 9)
+
+    offset = {"seconds": 0}
+    real_datetime = vps_monitor_api.datetime
+
+    class ShiftedDatetime(real_datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return real_datetime.now(tz) + vps_monitor_api.timedelta(seconds=offset["seconds"])
+
+    monkeypatch.setattr(vps_monitor_api, "datetime", ShiftedDatetime)
+
+    first = collector.refresh()
+    first_cursor = collector.changes.cursor()
+    first_ttl = client.get("/api/threats", headers=AUTH_HEADERS).get_json()["threat_list"]
+
+    offset["seconds"] = 120
+    second = collector.refresh()
+    assert second.etags == first.etags
+    assert collector.changes.cursor() == first_cursor
+
+    # 残り時間は読み出し時に計算される
+    ttl = {t["ip_address"]: t["block_ttl"] for t in first_ttl}
+    body = client.get("/api/threats?fields=ip_address,block_ttl", headers=AUTH_HEADERS).get_json()
+    later = {t["ip_address"]: t["block_ttl"] for t in body["threat_list"]}
+    assert ttl["1.2.3.4"] - later["1.2.3.4"] >= 119
+
+
+@pytest.mark.unit
+def test_lockdown_scripts():
+    """ロックダウン用スクリプトが既存ルールに依存しない固定の形になることをテスト"""
+    assert vps_monitor_api.split_networks(["10.0.0.0/8", "2001:db8::/32", "192.0.2.1"]) == (
+        ["10.0.0.0/8", "192.0.2.1"],
+        ["2001:db8::/32"],
+    )
+
+    chain = vps_monitor_api.LOCKDOWN_CHAIN
+    script = vps_monitor_api.build_iptables_lockdown(["10.0.0.0/8"])
+    lines = script.splitlines()
+    assert lines[0] == "*filter" and lines[-1] == "COMMIT"
+    assert f"-A {chain} -s 10.0.0.0/8 -j ACCEPT" in lines
+    assert lines.index(f"-A {chain} -j DROP") > lines.index(f"-A {chain} -s 10.0.0.0/8 -j ACCEPT")
+    assert f"-I INPUT 1 -j {chain}" in lines
+    assert "ipv6-icmp" not in script
+
+    # IPv6では近隣探索を最後のDROPより前で許可する
+    lines = vps_monitor_api.build_iptables_lockdown(["2001:db8::/32"], ipv6=True).splitlines()
+    for icmp_type in (133, 134, 135, 136):
+        rule = f"-A {chain} -p ipv6-icmp --icmpv6-type {icmp_type} -j ACCEPT"
+        assert lines.index(rule) < lines.index(f"-A {chain} -j DROP")
+    # 更新時はINPUTからの参照を重複させない
+    assert "INPUT" not in vps_monitor_api.build_iptables_lockdown(["10.0.0.0/8"], replace=True)
+    assert f"-X {chain}" in vps_monitor_api.build_iptables_release()
+
+    script = vps_monitor_api.build_nft_lockdown(["192.0.2.1", "10.0.0.0/8"])
+    assert "elements = { 192.0.2.1, 10.0.0.0/8 }" in script
+    assert "set allow6 { type ipv6_addr; flags interval; }" in script
+    assert "policy drop;" in script
+    assert "icmpv6 type { nd-router-solicit, nd-router-advert, nd-neighbor-solicit, nd-neighbor-advert } accept" in script
+
+
+@pytest.mark.unit
+def test_emergency_lockdown_endpoint(monkeypatch, tmp_path, collector, fake_firewall, client):
+    """ロックダウンの開始・ホワイトリスト変更の反映・解除が1回ずつの操作で行われることをテスト"""
+    whitelist = vps_monitor_api.Whitelist(str(tmp_path / "whitelist.conf"))
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", whitelist)
+    state_path = tmp_path / "emergency.json"
+    lockdown = vps_monitor_api.EmergencyLockdown(str(state_path))
+    monkeypatch.setattr(vps_monitor_api, "_lockdown", lockdown)
+
+    # 許可するアドレスがリクエスト元だけでも締め出されない
+    response = client.post(
+        "/api/emergency",
+        json={"reason": "brute force"},
+        headers=AUTH_HEADERS,
+        environ_base={"REMOTE_ADDR": ""},
+    )
+    assert response.status_code == 400
+    assert not lockdown.active
+
+    whitelist.add("192.168.1.0/24")
+    response = client.post("/api/emergency", json={"reason": "brute force"}, headers=AUTH_HEADERS)
+    body = response.get_json()
+    assert body["success"] is True
+    assert body["active"] is True
+    assert body["allowed"] == ["192.168.1.0/24", "127.0.0.1"]
+    assert fake_firewall.transactions == [("lockdown", ["192.168.1.0/24", "127.0.0.1"], False)]
+
+    # ロックダウン前のルールセットを含むため所有者のみ読み書きできる
+    assert stat.S_IMODE(state_path.stat().st_mode) == 0o600
+
+    # 再起動しても状態が残る
+    restored = vps_monitor_api.EmergencyLockdown(str(state_path))
+    assert restored.status()["reason"] == "brute force"
+
+    client.post("/api/whitelist", json={"ip_address": "203.0.113.5"}, headers=AUTH_HEADERS)
+    assert fake_firewall.transactions[-1] == (
+        "lockdown", ["192.168.1.0/24", "203.0.113.5", "127.0.0.1"], True
+    )
+
+    response = client.delete("/api/emergency", headers=AUTH_HEADERS)
+    assert response.get_json()["active"] is False
+    assert fake_firewall.transactions[-1] == ("release", {"iptables": "*filter\nCOMMIT\n"})
+    assert not state_path.exists()
+    assert client.get("/api/emergency", headers=AUTH_HEADERS).get_json()["active"] is False
+
+
+@pytest.mark.unit
+def test_emergency_lockdown_saves_state_before_swap(monkeypatch, tmp_path, fake_firewall, client):
+    """状態を保存できなければルールを切り替えず、保存は切り替えより先に行われることをテスト"""
+    whitelist = vps_monitor_api.Whitelist(str(tmp_path / "whitelist.conf"))
+    whitelist.add("192.168.1.0/24")
+    monkeypatch.setattr(vps_monitor_api, "_whitelist", whitelist)
+
+    # 保存先のディレクトリを作れない（ディスクフル・権限不足の代わり）
+    (tmp_path / "not-a-dir").write_text("")
+    broken = vps_monitor_api.EmergencyLockdown(str(tmp_path / "not-a-dir" / "emergency.json"))
+    monkeypatch.setattr(vps_monitor_api, "_lockdown", broken)
+    response = client.post("/api/emergency", json={"reason": "test"}, headers=AUTH_HEADERS)
+    assert response.status_code == 500
+    assert fake_firewall.transactions == []
+    assert not broken.active
+
+    # 切り替えの時点で、解除に必要な状態が保存済み
+    state_path = tmp_path / "emergency.json"
+    saved = []
+
+    def lockdown(networks, replace=False):
+        saved.append(json.loads(state_path.read_text()))
+        return True, ""
+
+    monkeypatch.setattr(fake_firewall, "lockdown", lockdown)
+    lockdown_manager = vps_monitor_api.EmergencyLockdown(str(state_path))
+    ok, _, _ = lockdown_manager.activate("test")
+    assert ok
+    assert saved[0]["activating"] is True
+    assert saved[0]["snapshot"] == fake_firewall.snapshot()
+    assert "activating" not in json.loads(state_path.read_text())
+
+    # 切り替え中に停止した場合も、再起動後に解除できる
+    state_path.write_text(json.dumps(saved[0]))
+    restored = vps_monitor_api.EmergencyLockdown(str(state_path))
+    assert restored.active
+    assert restored.release()[0]
+    assert fake_firewall.transactions[-1] == ("release", fake_firewall.snapshot())
+    assert not state_path.exists()
+
+    # 適用に失敗した場合は状態を残さない
+    monkeypatch.setattr(fake_firewall, "lockdown", lambda networks, replace=False: (False, "boom"))
+    failed = vps_monitor_api.EmergencyLockdown(str(state_path))
+    assert failed.activate("test")[:2] == (False, "boom")
+    assert not failed.active
+    assert not state_path.exists()
+
+
+@pytest.mark.unit
+def test_lockdown_release_falls_back_to_snapshot(monkeypatch):
+    """ロックダウン用チェーンを削除できない場合、保存したルールセットを復元することをテスト"""
+    calls = []
+
+    def fake_run_command(command, shell=False, input_text=None):
+        calls.append((command, input_text))
+        if "--noflush" in command and command[1] == "iptables-restore":
+            return "", "chain busy", 1
+        return "", "", 0
+
+    monkeypatch.setattr(vps_monitor_api, "run_command", fake_run_command)
+    backend = FakeFirewallBackend()
+    ok, error = vps_monitor_api.FirewallBackend.release(backend, {"iptables": "saved rules\n"})
+
+    assert ok, error
+    # iptablesは解除に失敗して丸ごと復元、ip6tablesは通常どおり解除
+    assert calls[1] == (["sudo", "iptables-restore"], "saved rules\n")
+    assert calls[2][0] == ["sudo", "ip6tables-restore", "--noflush"]
+    assert len(calls) == 3